@@ -0,0 +1,770 @@
+#!/usr/bin/env python3
+"""
+Benchmark Script for dMail
+This script measures the hot paths of the local SQLite storage layer and
+IMAP retrieval.
+
+Usage:
+    python benchmark.py            # run every benchmark
+    python benchmark.py database   # run a single benchmark
+
+The IMAP benchmark runs against the in-repo fake server; set
+BENCH_IMAP_MESSAGES and BENCH_IMAP_LATENCY to change the mailbox size and
+the simulated round trip time.
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+
+NUM_EMAILS = 5000
+NUM_READS = 2000
+NUM_THREADS = 4
+ACCOUNT = "bench@example.com"
+
+
+def make_email_row(i):
+    """Build a db row shaped like Email.to_db_dict() output."""
+    return {
+        'message_id': f'<bench-{i}@example.com>',
+        'subject': f'Benchmark subject {i}',
+        'body': 'Hello there, this is a benchmark body. ' * 20,
+        'full_body': 'Hello there, this is a benchmark body. ' * 40,
+        'html': '["<p>Hello there</p>"]',
+        'from_': '[["Sender", "sender@example.com"]]',
+        'to_': '[["Bench", "bench@example.com"]]',
+        'date': '2025-07-22 19:39:58',
+        'processed': i % 2 == 0,
+        'state': '[]',
+        'drafted_response': '',
+        'sent_response': '',
+        'sent_date': '',
+        'sent_to': '',
+        'sent_subject': '',
+        'sent_body': '',
+        'tags': '[]',
+    }
+
+
+def timed(label, func, count=None):
+    """Run func once and print its wall time (and rate when count is given)."""
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    if count:
+        print(f"   {label:<32} {elapsed * 1000:9.1f} ms  ({count / elapsed:,.0f} ops/s)")
+    else:
+        print(f"   {label:<32} {elapsed * 1000:9.1f} ms")
+    return result
+
+
+def bench_database():
+    """Benchmark get_email, scan_emails and bulk_put_emails."""
+    print("🏁 Benchmarking database...")
+    from database import DatabaseManager
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        rows = [make_email_row(i) for i in range(NUM_EMAILS)]
+
+        timed(f"bulk_put_emails x{NUM_EMAILS}", lambda: db.bulk_put_emails(rows, ACCOUNT), NUM_EMAILS)
+
+        def put_small_batches():
+            for i in range(100):
+                db.bulk_put_emails(rows[i * 50:(i + 1) * 50], ACCOUNT)
+
+        timed("bulk_put_emails 100 x50", put_small_batches, NUM_EMAILS)
+
+        def put_single():
+            for row in rows[:500]:
+                db.put_email(row, ACCOUNT)
+
+        timed("put_email x500", put_single, 500)
+
+        ids = [row['message_id'] for row in rows]
+
+        def read_serial():
+            for i in range(NUM_READS):
+                db.get_email(ids[i % NUM_EMAILS], ACCOUNT)
+
+        timed(f"get_email x{NUM_READS}", read_serial, NUM_READS)
+
+        def read_threaded():
+            per_thread = NUM_READS // NUM_THREADS
+            def worker(offset):
+                for i in range(per_thread):
+                    db.get_email(ids[(offset + i) % NUM_EMAILS], ACCOUNT)
+            threads = [threading.Thread(target=worker, args=(t * per_thread,)) for t in range(NUM_THREADS)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        timed(f"get_email x{NUM_READS} ({NUM_THREADS} threads)", read_threaded, NUM_READS)
+
+        def read_while_writing():
+            stop = threading.Event()
+            def writer():
+                while not stop.is_set():
+                    db.bulk_put_emails(rows[:50], ACCOUNT)
+            w = threading.Thread(target=writer)
+            w.start()
+            try:
+                read_serial()
+            finally:
+                stop.set()
+                w.join()
+
+        timed(f"get_email x{NUM_READS} (with writer)", read_while_writing, NUM_READS)
+        timed("scan_emails(account)", lambda: db.scan_emails({'account': ACCOUNT}))
+        timed("scan_emails(account, processed)", lambda: db.scan_emails({'account': ACCOUNT, 'processed': False}))
+    return True
+
+
+def bench_hydrate():
+    """Benchmark Inbox.hydrate with and without bodies."""
+    print("🏁 Benchmarking inbox hydration...")
+    import tracemalloc
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from database import DatabaseManager
+    from inbox import Inbox
+
+    num_emails = 20000
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        db.bulk_put_emails([make_email_row(i) for i in range(num_emails)], ACCOUNT)
+
+        for headers_only in (False, True):
+            inbox = Inbox()
+            inbox.db = db
+            inbox.user = ACCOUNT
+            inbox.HYDRATE_HEADERS_ONLY = headers_only
+            label = "headers only" if headers_only else "full"
+            timed(f"hydrate x{num_emails} ({label})", inbox.hydrate, num_emails)
+            timed(f"email_dicts x{num_emails} ({label})", inbox.email_dicts, num_emails)
+
+            # Measure memory on a separate run, tracemalloc slows hydration down
+            inbox.emails = {}
+            tracemalloc.start()
+            inbox.hydrate()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print(f"   {'memory':<32} {current / 2**20:9.1f} MB held, {peak / 2**20:.1f} MB peak")
+    return True
+
+
+def bench_email_memory():
+    """Measure the memory held by 100k header-only Email objects."""
+    print("🏁 Benchmarking Email memory...")
+    import json
+    import tracemalloc
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from inbox import Email, NOT_LOADED
+
+    num_emails = 100000
+    # Rows decoded per email the way hydrate does, so senders and tags
+    # arrive as fresh (non-shared) strings.
+    rows = [(
+        f'<bench-{i}@example.com>',
+        f'Benchmark subject {i}',
+        json.dumps([[f"Sender {i % 500}", f"sender{i % 500}@example.com"]]),
+        json.dumps([["Bench", ACCOUNT]]),
+        f'2025-07-{1 + i % 28:02d} 19:39:58',
+        json.dumps(["drafted_response"] if i % 3 == 0 else []),
+        json.dumps([f"tag{i % 10}"]),
+    ) for i in range(num_emails)]
+
+    def build():
+        return [Email(
+            id=message_id, subject=subject, body=NOT_LOADED, full_body=NOT_LOADED, html=NOT_LOADED,
+            from_=json.loads(from_), to=json.loads(to), date=date, processed=True,
+            state=json.loads(state), drafted_response='', tags=json.loads(tags),
+        ) for message_id, subject, from_, to, date, state, tags in rows]
+
+    timed(f"build Email x{num_emails}", build, num_emails)
+    tracemalloc.start()
+    emails = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"   {'memory':<32} {current / 2**20:9.1f} MB ({current / num_emails:,.0f} bytes/email)")
+    del emails
+    return True
+
+
+def bench_imap():
+    """Measure messages/sec fetched from a fake IMAP server."""
+    print("🏁 Benchmarking IMAP retrieval...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    import gmail
+    from fake_mail_server import FakeImapServer, generate_mailbox, make_message
+
+    num_messages = int(os.getenv('BENCH_IMAP_MESSAGES', '1000'))
+    latency = float(os.getenv('BENCH_IMAP_LATENCY', '0.005'))  # seconds per round trip
+    messages = generate_mailbox(num_messages)
+
+    async def fetch_one_by_one(client, email_ids):
+        # The pre-batching loop: one FETCH round trip per message
+        emails = []
+        for email_id in email_ids:
+            result = await client.uid('fetch', email_id.decode(), 'BODY.PEEK[]')
+            emails.append(gmail.email_from_bytes(result.lines[1], email_id))
+        return emails
+
+    async def run(fetch):
+        server = FakeImapServer(messages, latency=latency)
+        port = await server.start()
+        try:
+            client = gmail.aioimaplib.IMAP4(host='127.0.0.1', port=port)
+            await client.wait_hello_from_server()
+            await client.login(server.user, server.password)
+            await client.select('INBOX')
+            email_ids = (await client.uid_search('ALL')).lines[0].split()
+            start = time.perf_counter()
+            emails = await fetch(client, email_ids)
+            elapsed = time.perf_counter() - start
+            await client.logout()
+        finally:
+            await server.stop()
+        return len(email_ids), len(emails), elapsed, server.commands
+
+    async def keep_one_sender(email):
+        return email.from_[0][1] == 'sender0@example.com'
+
+    async def fetch_header_first(client, email_ids):
+        # Whitelist on headers first, then download 1 in 50 bodies
+        matched_ids = await gmail.filter_by_headers(client, email_ids, keep_one_sender)
+        return await gmail.fetch_emails(client, matched_ids)
+
+    for label, fetch in (("per message", fetch_one_by_one), ("batched", gmail.fetch_emails),
+                         ("header-first", fetch_header_first)):
+        scanned, kept, elapsed, commands = asyncio.run(run(fetch))
+        print(f"   {'fetch x' + str(scanned) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+              f"({scanned / elapsed:,.0f} msgs/s, {kept} kept, {commands} commands)")
+
+    async def poll():
+        # A full first sync, then polls with the stored UID position
+        server = FakeImapServer(messages, latency=latency)
+        port = await server.start()
+        sync_state = {}
+        try:
+            retrieve = lambda: gmail.retrieve_emails('ALL', server.user, server.password, host='127.0.0.1',
+                                                     port=port, use_ssl=False, sync_state=sync_state)
+            await retrieve()
+            start = time.perf_counter()
+            unchanged = await retrieve()
+            unchanged_elapsed = time.perf_counter() - start
+            server.add_message(make_message(num_messages))
+            start = time.perf_counter()
+            one_new = await retrieve()
+            one_new_elapsed = time.perf_counter() - start
+        finally:
+            await server.stop()
+        return (len(unchanged), unchanged_elapsed), (len(one_new), one_new_elapsed)
+
+    for label, (count, elapsed) in zip(("unchanged", "1 new"), asyncio.run(poll())):
+        print(f"   {'incremental poll (' + label + ')':<32} {elapsed * 1000:9.1f} ms  ({count} fetched)")
+
+    async def repeated_polls(pooled, num_polls=20):
+        # Polls with nothing new, on a fresh login each time or a kept session
+        from imap_sessions import SessionManager
+        server = FakeImapServer(messages[:10], latency=latency)
+        port = await server.start()
+        sync_state = {}
+        manager = SessionManager('127.0.0.1', port, use_ssl=False) if pooled else None
+        try:
+            for i in range(num_polls + 1):
+                if i == 1:
+                    start = time.perf_counter()
+                if pooled:
+                    await manager.retrieve_emails('ALL', server.user, server.password, sync_state=sync_state)
+                else:
+                    await gmail.retrieve_emails('ALL', server.user, server.password, host='127.0.0.1',
+                                                port=port, use_ssl=False, sync_state=sync_state)
+            elapsed = time.perf_counter() - start
+        finally:
+            if manager:
+                manager.stop(server.user)
+            await server.stop()
+        return elapsed, num_polls, server.commands
+
+    for label, pooled in (("new connection", False), ("pooled session", True)):
+        elapsed, num_polls, commands = asyncio.run(repeated_polls(pooled))
+        print(f"   {'poll x' + str(num_polls) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+              f"({elapsed / num_polls * 1000:.1f} ms/poll, {commands} commands)")
+
+    async def fetch_with_attachments(text_only, num_attached=200):
+        # Half the messages carry a 500 KB attachment
+        server = FakeImapServer([make_message(i, attachment_size=500000 if i % 2 else 0) for i in range(num_attached)],
+                                latency=latency)
+        port = await server.start()
+        try:
+            client = await gmail.connect_imap(server.user, server.password, '127.0.0.1', port, use_ssl=False)
+            await client.select('INBOX')
+            start = time.perf_counter()
+            emails = await gmail.fetch_emails(client, server.uids, text_only=text_only)
+            elapsed = time.perf_counter() - start
+            await client.logout()
+        finally:
+            await server.stop()
+        return len(emails), elapsed, server.bytes_fetched
+
+    for label, text_only in (("whole messages", False), ("text parts only", True)):
+        count, elapsed, fetched = asyncio.run(fetch_with_attachments(text_only))
+        print(f"   {'fetch x' + str(count) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+              f"({fetched / 2**20:.1f} MB transferred)")
+    return True
+
+
+def bench_parse():
+    """Measure MIME parsing throughput inline and with 1 to N worker processes."""
+    print("🏁 Benchmarking MIME parsing...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from fake_mail_server import make_message
+    from mime_parser import MimeParser
+
+    # HTML-heavy newsletters, every fourth one with a 200 KB attachment
+    corpus = [(str(i), make_message(i, body_size=20000, attachment_size=200000 if i % 4 == 0 else 0))
+              for i in range(200)]
+    print(f"   corpus: {len(corpus)} messages, {sum(len(m) for _, m in corpus) / 2**20:.1f} MB, {os.cpu_count()} cores")
+
+    async def run(parser):
+        # A ticker measures how long the event loop is blocked while parsing
+        lag = [0.0]
+        done = asyncio.Event()
+
+        async def ticker():
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lag[0] = max(lag[0], time.perf_counter() - start - 0.01)
+
+        tick = asyncio.ensure_future(ticker())
+        await asyncio.sleep(0.005)
+        start = time.perf_counter()
+        emails = await parser.parse(corpus)
+        elapsed = time.perf_counter() - start
+        done.set()
+        await tick
+        return len(emails), elapsed, lag[0]
+
+    max_workers = max(2, os.cpu_count() or 1)
+    for workers in range(0, max_workers + 1):
+        parser = MimeParser(workers)
+        # Warm up (and start the workers) outside the timed run
+        asyncio.run(parser.parse(corpus[:max(workers, 1)]))
+        count, elapsed, lag = asyncio.run(run(parser))
+        parser.close()
+        label = f"{workers} workers" if workers else "inline"
+        print(f"   {'parse x' + str(count) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+              f"({count / elapsed:,.0f} msgs/s, loop blocked up to {lag * 1000:.0f} ms)")
+    return True
+
+
+def bench_smtp():
+    """Compare a new SMTP connection per reply with the queued outbox."""
+    print("🏁 Benchmarking SMTP sending...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    import gmail
+    from database import DatabaseManager
+    from fake_mail_server import FakeSmtpServer
+    from inbox import Email
+    from smtp_outbox import Outbox
+
+    num_replies = 100
+    latency = 0.005  # seconds per round trip
+    emails = [Email(f'<bench-{i}@example.com>', f'Subject {i}', 'Hello',
+                    from_=[('Sender', f'sender{i}@example.com')]) for i in range(num_replies)]
+
+    # smtplib blocks, so the server runs on its own loop thread
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    server = FakeSmtpServer(latency=latency)
+    port = asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+
+    def send_each():
+        # The old send_email: connect, STARTTLS, log in and quit for every reply
+        for email in emails:
+            msg, _ = gmail.build_reply(email, 'Thanks!', server.user)
+            smtp = gmail.connect_smtp(server.user, server.password, '127.0.0.1', port, use_tls=False)
+            smtp.send_message(msg)
+            smtp.quit()
+
+    timed(f"send x{num_replies} (new connection)", send_each, num_replies)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        outbox = Outbox(db, '127.0.0.1', port, use_tls=False)
+        delivered = threading.Semaphore(0)
+        outbox.on_delivery = lambda account, message_id, ok: delivered.release()
+        outbox.start()
+        start = time.perf_counter()
+        for email in emails:
+            outbox.send(email, 'Thanks!', server.user, server.password)
+        queued = time.perf_counter() - start
+        for _ in emails:
+            delivered.acquire()
+        elapsed = time.perf_counter() - start
+        outbox.stop()
+        print(f"   {'send x' + str(num_replies) + ' (outbox)':<32} {elapsed * 1000:9.1f} ms  "
+              f"({num_replies / elapsed:,.0f} ops/s, callers blocked {queued / num_replies * 1000:.1f} ms/reply, "
+              f"{outbox.stats()['connects']} connects)")
+
+    asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    return True
+
+
+def bench_sync():
+    """Sync several accounts one after another and with the sync coordinator."""
+    print("🏁 Benchmarking multi-account sync...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    import gmail
+    from database import DatabaseManager
+    from fake_mail_server import FakeImapServer, make_message
+    from sync_coordinator import SyncCoordinator
+
+    num_accounts = 8
+    messages = [make_message(i) for i in range(100)]
+    # One mailbox answers every command 300 ms late, the rest 5 ms
+    latencies = [0.3] + [0.005] * (num_accounts - 1)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    servers = []
+    for i, latency in enumerate(latencies):
+        server = FakeImapServer(messages, user=f'user{i}@example.com', latency=latency)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        servers.append(server)
+
+    async def sequential():
+        finished = []
+        start = time.perf_counter()
+        for server in servers:
+            await gmail.retrieve_emails('ALL', server.user, server.password, host='127.0.0.1',
+                                        port=server.port, use_ssl=False)
+            finished.append(time.perf_counter() - start)
+        return finished
+
+    finished = asyncio.run(sequential())
+    print(f"   {'sync x' + str(num_accounts) + ' (one by one)':<32} {finished[-1] * 1000:9.1f} ms  "
+          f"(fast accounts done after {max(finished[1:]) * 1000:.0f} ms)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        for server in servers:
+            # each fake server is its own host as far as connection limits go
+            db.put_user(server.user, f'127.0.0.1:{server.port}', server.password)
+        coordinator = SyncCoordinator(db, use_ssl=False)
+        start = time.perf_counter()
+        stats = coordinator.sync_all()
+        elapsed = time.perf_counter() - start
+        fast = max(stats[server.user]['last_duration'] for server in servers[1:])
+        print(f"   {'sync x' + str(num_accounts) + ' (coordinator)':<32} {elapsed * 1000:9.1f} ms  "
+              f"(fast accounts done after {fast * 1000:.0f} ms, slow one {stats[servers[0].user]['last_duration'] * 1000:.0f} ms)")
+        for manager in coordinator.sessions.values():
+            for server in servers:
+                manager.stop(server.user)
+
+    for server in servers:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    return True
+
+
+def bench_filter():
+    """Compare per-rule coroutines with the compiled whitelist matcher."""
+    print("🏁 Benchmarking whitelist filtering...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from inbox import Email, FilterList
+
+    num_emails = 5000
+    rules = ([{'type': 'email', 'value': f'person{i}@example.com'} for i in range(300)] +
+             [{'type': 'email', 'value': f'@partner{i}.com'} for i in range(20)] +
+             [{'type': 'subject', 'value': f'project code {i}'} for i in range(200)])
+    whitelist = FilterList()
+    whitelist.update_from_json({'rules': rules})
+    # about a third of the senders and a tenth of the subjects are whitelisted
+    emails = [Email(str(i), f'Weekly update {i}' + (f' for Project Code {i % 300}' if i % 5 == 0 else ''), '',
+                    from_=[('Someone', f'person{i % 1000}@example.com')]) for i in range(num_emails)]
+
+    async def per_rule():
+        # The old FilterList.filter: one coroutine per rule, gathered per email
+        kept = 0
+        for email in emails:
+            results = await asyncio.gather(*(rule.matches(email) for rule in whitelist.filters.values()))
+            kept += any(results)
+        return kept
+
+    async def compiled():
+        return sum(await whitelist.filter_many(emails))
+
+    for label, run in (("per-rule coroutines", per_rule), ("compiled", compiled)):
+        start = time.perf_counter()
+        kept = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        print(f"   {'filter x' + str(num_emails) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+              f"({num_emails / elapsed:,.0f} emails/s, {kept} kept, {len(rules)} rules)")
+    return True
+
+
+class SlowAgent:
+    """Stands in for the LLM in whitelist AI rules, with a fixed round trip time."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def cache_key(self, template, instructions, body):
+        return None
+
+    async def get_openai_response(self, prompt, cache_key=None):
+        import asyncio
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return {'tool_calls': [], 'text': 'True' if 'Subject: Your invoice' in prompt else 'False'}
+
+
+def bench_ai_filter():
+    """Compare asking AI rules one email at a time with the bounded, cached path."""
+    print("🏁 Benchmarking AI whitelist rules...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from database import DatabaseManager
+    from inbox import Email, FilterList, VerdictCache
+
+    num_emails = 200
+
+    emails = [Email(f'<{i}@example.com>', 'Your invoice' if i % 4 == 0 else f'Hello {i}', f'Body {i}',
+                    from_=[('Someone', f'someone{i}@example.com')]) for i in range(num_emails)]
+    rules = {'rules': [{'type': 'classification', 'value': 'Keep invoices and receipts'}]}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        agent = SlowAgent(0.05)
+        whitelist = FilterList(agent, VerdictCache(db, ACCOUNT))
+        whitelist.update_from_json(rules)
+        rule = next(iter(whitelist.filters.values()))
+
+        async def one_at_a_time():
+            # The old resync: every email asked in turn, every time
+            return sum([await rule.matches(email) for email in emails])
+
+        async def bounded():
+            return sum(await whitelist.filter_many(emails))
+
+        for label, run in (("one at a time", one_at_a_time), ("bounded, cold", bounded), ("bounded, cached", bounded)):
+            agent.calls = 0
+            start = time.perf_counter()
+            kept = asyncio.run(run())
+            elapsed = time.perf_counter() - start
+            print(f"   {'resync x' + str(num_emails) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+                  f"({agent.calls} llm calls, {kept} kept)")
+        db.close()
+    return True
+
+
+def bench_resync():
+    """Compare full whitelist resyncs with ones driven by the rule changes."""
+    print("🏁 Benchmarking whitelist resync...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from database import DatabaseManager
+    from inbox import Inbox, Email
+
+    num_emails = 20000
+    rules = [{'type': 'email', 'value': f'person{i}@example.com'} for i in range(200)]
+
+    def make_email(i):
+        return Email(f'<{i}@example.com>', f'Update {i}', '', from_=[('Someone', f'person{i % 250}@example.com')])
+
+    # (label, rules before, rules after): dropping ten senders, then adding one
+    scenarios = (("remove 10 senders", rules, rules[10:]),
+                 ("add 1 sender", rules, rules + [{'type': 'email', 'value': 'person220@example.com'}]))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        for label, before, after in scenarios:
+            for mode in ("full", "incremental"):
+                downloads = 0
+
+                async def retrieve(query, user, password, header_filter=None, sync_state=None):
+                    # Stands in for the server: bodies are fetched for what header_filter keeps
+                    nonlocal downloads
+                    kept = [email for email in map(make_email, range(num_emails)) if await header_filter(email)]
+                    downloads += len(kept)
+                    return kept
+
+                inbox = Inbox()
+                inbox.db = db
+                inbox.user = f"{label}-{mode}@example.com"
+                inbox.retrieve_function = retrieve
+                inbox.whitelist.update_from_json({'rules': before})
+                for i in range(num_emails):
+                    email = make_email(i)
+                    if inbox.whitelist.compiled.matches_headers(email):
+                        inbox.emails[email.id] = email
+                        inbox.unprocessed_message_ids.append(email.id)
+                inbox.save_emails()
+                changes = inbox.whitelist.update_from_json({'rules': after})
+                start = time.perf_counter()
+                asyncio.run(inbox.resync(changes if mode == "incremental" else None))
+                elapsed = time.perf_counter() - start
+                print(f"   {label + ' (' + mode + ')':<32} {elapsed * 1000:9.1f} ms  "
+                      f"({downloads} bodies downloaded, {len(inbox.emails)} kept)")
+        db.close()
+    return True
+
+
+def bench_ingest():
+    """Compare checking fetched mail one email at a time with chunked ingest."""
+    print("🏁 Benchmarking inbox ingest...")
+    import asyncio
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from database import DatabaseManager
+    from inbox import Inbox, Email
+
+    num_emails = 200
+    rules = {'rules': [{'type': 'email', 'value': 'boss@example.com'},
+                       {'type': 'classification', 'value': 'Keep invoices and receipts'}]}
+
+    def make_emails():
+        return [Email(f'<{i}@example.com>', 'Your invoice' if i % 4 == 0 else f'Hello {i}', f'Body {i}',
+                      from_=[('Someone', 'boss@example.com' if i % 10 == 0 else f'someone{i}@example.com')])
+                for i in range(num_emails)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        for label in ("one at a time", "chunked"):
+            inbox = Inbox()
+            inbox.db = db
+            inbox.user = f"{label}@example.com"
+            inbox.whitelist.agent = SlowAgent(0.05)
+            inbox.whitelist.update_from_json(rules)
+            emails = make_emails()
+            start = time.perf_counter()
+            first = None
+            if label == "chunked":
+                asyncio.run(inbox.ingest(emails))
+                first = inbox.filter_stats['first_result_seconds']
+            else:
+                async def one_at_a_time():
+                    # The old Inbox.update loop: await the whitelist per email
+                    nonlocal first
+                    for email in emails:
+                        if await inbox.whitelist.filter(email):
+                            inbox.emails[email.id] = email
+                            if first is None:
+                                first = time.perf_counter() - start
+                    inbox.save_emails()
+                asyncio.run(one_at_a_time())
+            elapsed = time.perf_counter() - start
+            print(f"   {'ingest x' + str(num_emails) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+                  f"({num_emails / elapsed:,.0f} emails/s, first kept after {first * 1000:.0f} ms, "
+                  f"{len(inbox.emails)} kept)")
+        db.close()
+    return True
+
+
+def bench_processing():
+    """Compare one processing batch per request with the background worker."""
+    print("🏁 Benchmarking email processing...")
+    import asyncio
+    import random
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+    from database import DatabaseManager
+    from inbox import Inbox, Email
+    from processing_worker import ProcessingWorker
+
+    num_emails = 100
+    round_trip = 0.02
+
+    class VariableAgent:
+        # Stands in for the LLM, with call times between 20 and 200 ms
+        async def process_email(self, email):
+            await asyncio.sleep(random.Random(email.id).uniform(0.02, 0.2))
+            email.processed = True
+            email.add_state('tagged')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'bench.db'))
+        for label in ("batch per request", "background worker"):
+            inbox = Inbox()
+            inbox.db = db
+            inbox.user = f"{label}@example.com"
+            inbox.agent = VariableAgent()
+            for i in range(num_emails):
+                email = Email(f'<{label}-{i}@example.com>', f'Hello {i}', f'Body {i}')
+                inbox.emails[email.id] = email
+                inbox.unprocessed_message_ids.append(email.id)
+            inbox.save_emails()
+            inbox.state = inbox.State.HYDRATED
+            requests = 0
+            start = time.perf_counter()
+            if label == "batch per request":
+                # The old /api/process_emails loop: a batch of BATCH_SIZE per call
+                while inbox.unprocessed_message_ids:
+                    time.sleep(round_trip)
+                    inbox.update_state(inbox.State.PROCESSING)
+                    requests += 1
+            else:
+                worker = ProcessingWorker(inbox)
+                inbox.process_function = worker.start
+                inbox.update_state(inbox.State.PROCESSING)
+                # The first poll comes straight after the start, as the ui's does
+                while True:
+                    requests += 1
+                    if not worker.collect(10) and not worker.busy:
+                        break
+                    time.sleep(round_trip)
+                worker.cancel()
+            elapsed = time.perf_counter() - start
+            processed = sum(email.processed for email in inbox.emails.values())
+            print(f"   {'process x' + str(num_emails) + ' (' + label + ')':<32} {elapsed * 1000:9.1f} ms  "
+                  f"({processed / elapsed * 60:,.0f} emails/min, {requests} requests, {processed} processed)")
+        db.close()
+    return True
+
+
+BENCHMARKS = {
+    'database': bench_database,
+    'hydrate': bench_hydrate,
+    'email': bench_email_memory,
+    'imap': bench_imap,
+    'parse': bench_parse,
+    'smtp': bench_smtp,
+    'sync': bench_sync,
+    'filter': bench_filter,
+    'ai_filter': bench_ai_filter,
+    'resync': bench_resync,
+    'ingest': bench_ingest,
+    'processing': bench_processing,
+}
+
+
+def main():
+    """Main benchmark function."""
+    print("⏱️  dMail Benchmarks")
+    print("===================")
+
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"❌ Unknown benchmark: {name} (choose from {', '.join(BENCHMARKS)})")
+            return False
+        print()
+        BENCHMARKS[name]()
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -1,9 +1,201 @@
 import sqlite3
 import json
 import os
+import time
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Iterator
+from contextlib import contextmanager
 import threading
+import queue
+
+# Pragmas applied to every pooled connection. WAL lets readers run alongside
+# the single writer, and synchronous=NORMAL is safe in WAL mode.
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA mmap_size = 268435456',
+    'PRAGMA cache_size = -65536',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# Schema migrations run by init_db, in order. Each entry is the schema
+# version (stored in PRAGMA user_version) and the statements that bring the
+# database to it. Append new entries; never edit one that has shipped.
+MIGRATIONS = [
+    (1, [
+        # message_id stays the primary key here; migration 9 rebuilds the
+        # table keyed by (account, message_id).
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_emails_account_message_id ON emails (account, message_id)',
+        'CREATE INDEX IF NOT EXISTS idx_emails_account_processed ON emails (account, processed)',
+        'CREATE INDEX IF NOT EXISTS idx_emails_account_date ON emails (account, date)',
+    ]),
+    (2, [
+        '''
+        CREATE TABLE IF NOT EXISTS llm_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT,
+            response TEXT,
+            size INTEGER,
+            created_at REAL,
+            last_used REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_llm_cache_last_used ON llm_cache (last_used)',
+    ]),
+    (3, [
+        # Hash of the prompt inputs that produced an email's processing result
+        "ALTER TABLE emails ADD COLUMN fingerprint TEXT DEFAULT ''",
+    ]),
+    (4, [
+        '''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            account TEXT NOT NULL,
+            mailbox TEXT NOT NULL,
+            uidvalidity INTEGER,
+            last_uid INTEGER,
+            highest_modseq INTEGER,
+            updated_at REAL,
+            PRIMARY KEY (account, mailbox)
+        )
+        ''',
+    ]),
+    (5, [
+        # JSON list of attachment name, type and size; the content is not downloaded
+        "ALTER TABLE emails ADD COLUMN attachments TEXT DEFAULT ''",
+    ]),
+    (6, [
+        '''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account TEXT NOT NULL,
+            message_id TEXT,
+            sender TEXT,
+            recipients TEXT,
+            message BLOB,
+            status TEXT DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            last_error TEXT,
+            created_at REAL,
+            sent_at REAL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_outbox_status_next_attempt ON outbox (status, next_attempt_at)',
+    ]),
+    (7, [
+        # Whitelist AI rule answers; rule_hash covers the rule text and prompt
+        '''
+        CREATE TABLE IF NOT EXISTS filter_verdicts (
+            account TEXT NOT NULL,
+            rule_hash TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            verdict INTEGER,
+            created_at REAL,
+            PRIMARY KEY (account, rule_hash, message_id)
+        )
+        ''',
+    ]),
+    (8, [
+        # Start of the body for the list view, so it can be shown without loading
+        # bodies. NULL until backfill_previews fills it in after the migration.
+        'ALTER TABLE emails ADD COLUMN preview TEXT',
+    ]),
+    (9, [
+        # Key emails by (account, message_id) so two accounts can hold the same
+        # message. SQLite cannot change a primary key in place, so the table is
+        # rebuilt; the migration transaction makes the copy and rename atomic.
+        '''
+        CREATE TABLE emails_new (
+            message_id TEXT NOT NULL,
+            subject TEXT,
+            body TEXT,
+            full_body TEXT,
+            html TEXT,
+            from_ TEXT,
+            to_ TEXT,
+            date TEXT,
+            processed BOOLEAN DEFAULT FALSE,
+            state TEXT,
+            drafted_response TEXT,
+            sent_response TEXT,
+            sent_date TEXT,
+            sent_to TEXT,
+            sent_subject TEXT,
+            sent_body TEXT,
+            tags TEXT,
+            account TEXT NOT NULL DEFAULT '',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            fingerprint TEXT DEFAULT '',
+            attachments TEXT DEFAULT '',
+            preview TEXT,
+            PRIMARY KEY (account, message_id)
+        )
+        ''',
+        '''
+        INSERT OR IGNORE INTO emails_new
+        (message_id, subject, body, full_body, html, from_, to_, date, processed, state, drafted_response, sent_response,
+         sent_date, sent_to, sent_subject, sent_body, tags, account, created_at, updated_at, fingerprint, attachments, preview)
+        SELECT message_id, subject, body, full_body, html, from_, to_, date, processed, state, drafted_response, sent_response,
+         sent_date, sent_to, sent_subject, sent_body, tags, coalesce(account, ''), created_at, updated_at, fingerprint, attachments, preview
+        FROM emails
+        ''',
+        'DROP TABLE emails',
+        'ALTER TABLE emails_new RENAME TO emails',
+        # The primary key now covers (account, message_id)
+        'CREATE INDEX IF NOT EXISTS idx_emails_account_processed ON emails (account, processed)',
+        'CREATE INDEX IF NOT EXISTS idx_emails_account_date ON emails (account, date)',
+    ]),
+]
+
+# The list view preview computed from a stored body, for rows written before
+# the preview column existed
+PREVIEW_SQL = "substr(trim(replace(replace(body, char(13), ' '), char(10), ' ')), 1, 200)"
+
+class ConnectionPool:
+    """A fixed-size pool of persistent SQLite connections shared across threads."""
+
+    def __init__(self, db_path: str, size: int = 4):
+        self.db_path = db_path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        # Connections move between threads (the Flask dev server runs each
+        # request on a fresh thread), so they are handed out one at a time
+        # instead of being pinned to the thread that opened them.
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """Take an idle connection, opening a new one while under the size limit."""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._connections) < self.size:
+                conn = self.connect()
+                self._connections.append(conn)
+                return conn
+        return self._idle.get()
+
+    def release(self, conn: sqlite3.Connection):
+        """Return a connection to the pool."""
+        self._idle.put(conn)
+
+    def close(self):
+        """Close every connection the pool has opened."""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._idle = queue.LifoQueue()
 
 class DatabaseManager:
     def __init__(self, db_path: str = None):
@@ -20,13 +212,15 @@ class DatabaseManager:
                 db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dmail.db')
         
         self.db_path = db_path
+        # Only writes are serialized; reads go through the pool concurrently.
         self.lock = threading.Lock()
+        self.pool = ConnectionPool(db_path)
+        self._write_conn = self.pool.connect()
         self.init_db()
     
     def init_db(self):
         """Initialize the SQLite database with required tables."""
-        with self.lock:
-            conn = sqlite3.connect(self.db_path)
+        with self.write_connection() as conn:
             cursor = conn.cursor()
             
             # Create emails table
@@ -79,13 +273,76 @@ class DatabaseManager:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
-                        
             conn.commit()
-            conn.close()
-    
-    def get_connection(self):
-        """Get a database connection."""
-        return sqlite3.connect(self.db_path)
+
+            self.migrate(conn)
+            self.email_columns = {row[1] for row in conn.execute('PRAGMA table_info(emails)')}
+        self.backfill_previews()
+
+    def migrate(self, conn):
+        """Apply any migrations newer than the database's schema version."""
+        # IMMEDIATE takes the write lock before reading the version, so two
+        # processes opening the same file cannot both apply a migration.
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            for target_version, statements in MIGRATIONS:
+                if target_version <= version:
+                    continue
+                print(f"Migrating database to schema version {target_version}")
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f'PRAGMA user_version = {target_version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def backfill_previews(self, batch_size: int = 500):
+        """Fill in missing email previews, one short write transaction per batch.
+
+        Kept out of the migrations so an upgrade does not rewrite every row
+        while holding the write lock; other writers get in between batches.
+        """
+        last_rowid = 0
+        while True:
+            with self.write_connection() as conn:
+                # Walk forward by rowid so each batch starts where the last one ended
+                end_rowid, count = conn.execute(
+                    'SELECT max(rowid), count(*) FROM (SELECT rowid FROM emails WHERE rowid > ? AND preview IS NULL ORDER BY rowid LIMIT ?)',
+                    (last_rowid, batch_size)).fetchone()
+                if not count:
+                    return
+                conn.execute(f'UPDATE emails SET preview = {PREVIEW_SQL} WHERE rowid > ? AND rowid <= ? AND preview IS NULL',
+                             (last_rowid, end_rowid))
+            last_rowid = end_rowid
+
+    @contextmanager
+    def read_connection(self):
+        """Borrow a pooled connection for reading."""
+        conn = self.pool.acquire()
+        try:
+            yield conn
+        finally:
+            self.pool.release(conn)
+
+    @contextmanager
+    def write_connection(self):
+        """Hold the write lock and yield the writer connection, committing on success."""
+        with self.lock:
+            conn = self._write_conn
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def close(self):
+        """Close all open connections."""
+        with self.lock:
+            self._write_conn.close()
+        self.pool.close()
     
     def dict_factory(self, cursor, row):
         """Convert row to dictionary."""
@@ -96,26 +353,23 @@ class DatabaseManager:
 
     def reset_emails(self, user: str):
         """Reset all emails for a user."""
-        with self.lock:
-            conn = self.get_connection()
+        with self.write_connection() as conn:
             cursor = conn.cursor()
             cursor.execute('DELETE FROM emails WHERE account = ?', (user,))
-            conn.commit()
-            conn.close()
+            cursor.execute('DELETE FROM sync_state WHERE account = ?', (user,))
 
 
     # Email operations
     def put_email(self, email_data: Dict[str, Any], account: str) -> bool:
         """Store an email in the database."""
         try:
-            with self.lock:
-                conn = self.get_connection()
+            with self.write_connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
                     INSERT OR REPLACE INTO emails 
-                    (message_id, subject, body, full_body, html, from_, to_, date, processed, state, drafted_response, sent_response, sent_date, sent_to, sent_subject, sent_body, tags, account)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    (message_id, subject, body, full_body, html, from_, to_, date, processed, state, drafted_response, sent_response, sent_date, sent_to, sent_subject, sent_body, tags, fingerprint, attachments, preview, account)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 ''', (
                         email_data['message_id'] or '',
                         email_data['subject'] or '',
@@ -134,35 +388,43 @@ class DatabaseManager:
                         email_data['sent_subject'] or '',
                         email_data['sent_body'] or '',
                         email_data['tags'] or '',
+                        email_data.get('fingerprint') or '',
+                        email_data.get('attachments') or '',
+                        email_data.get('preview') or '',
                         account
                 ))
-                
-                conn.commit()
-                conn.close()
                 return True
         except Exception as e:
             print(f"Error storing email: {e}")
             return False
 
     def bulk_delete_emails(self, message_ids: List[str], account: str) -> bool:
-        """Bulk delete emails from the database."""
+        """Bulk delete emails from the database in one statement."""
         try:
-            with self.lock:
-                conn = self.get_connection()
-                cursor = conn.cursor()
-                for message_id in message_ids:
-                    cursor.execute('DELETE FROM emails WHERE message_id = ? AND account = ?', (message_id, account))
-                conn.commit()
-                conn.close()
+            with self.write_connection() as conn:
+                conn.execute(
+                    'DELETE FROM emails WHERE account = ? AND message_id IN (SELECT value FROM json_each(?))',
+                    (account, json.dumps(list(message_ids)))
+                )
             return True
         except Exception as e:
             print(f"Error deleting emails: {e}")
+            return False
+
+    def bulk_put_emails(self, emails: List[Dict[str, Any]], account: str, replace: bool = True) -> bool:
+        """Bulk store emails in the database.
+
+        With replace=False emails that are already stored are left as they are.
+        """
+        return self.store_emails(emails, account, replace) is not None
 
-    def bulk_put_emails(self, emails: List[Dict[str, Any]], account: str) -> bool:
-        """Bulk store emails in the database."""
+    def store_emails(self, emails: List[Dict[str, Any]], account: str, replace: bool = True) -> Optional[int]:
+        """Bulk store emails, returning how many rows were written or None on failure.
+
+        With replace=False emails that are already stored are skipped and not counted.
+        """
         try:
-            with self.lock:
-                conn = self.get_connection()
+            with self.write_connection() as conn:
                 cursor = conn.cursor()
 
                 # Create a list of tuples for bulk insertion
@@ -186,36 +448,59 @@ class DatabaseManager:
                         email['sent_subject'] or '',
                         email['sent_body'] or '',
                         email['tags'] or '',
+                        email.get('fingerprint') or '',
+                        email.get('attachments') or '',
+                        email.get('preview') or '',
                         account
                     ))
-                # Execute the bulk insert
-                try:
-                    cursor.executemany('''
-                        INSERT OR REPLACE INTO emails 
-                        (message_id, subject, body, full_body, html, from_, to_, date, processed, state, drafted_response, sent_response, sent_date, sent_to, sent_subject, sent_body, tags, account)
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    ''', values)
-                except Exception as e:
-                    print(f"Error executing bulk insert: {e}")
-                    print(f"Values: {values}")
-                conn.commit()
-                conn.close()
-                return True
+                # Execute the bulk insert, a failure rolls back the whole batch
+                cursor.executemany(f'''
+                    INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO emails 
+                    (message_id, subject, body, full_body, html, from_, to_, date, processed, state, drafted_response, sent_response, sent_date, sent_to, sent_subject, sent_body, tags, fingerprint, attachments, preview, account)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', values)
+                return cursor.rowcount
         except Exception as e:
             print(f"Error storing emails: {e}")
-            return False
+            return None
     
-    def get_email(self, message_id: str) -> Optional[Dict[str, Any]]:
-        """Get an email by message_id."""
+    def bulk_update_emails(self, updates: List[Dict[str, Any]], account: str) -> bool:
+        """Update only the given columns of existing emails.
+
+        Each update holds a message_id plus the changed columns. Updates that
+        touch the same set of columns are sent in a single executemany.
+        """
+        try:
+            groups = {}
+            for update in updates:
+                columns = tuple(k for k in update.keys() if k != 'message_id')
+                if columns:
+                    groups.setdefault(columns, []).append(update)
+
+            updated_at = datetime.now().isoformat()
+            with self.write_connection() as conn:
+                cursor = conn.cursor()
+                for columns, group in groups.items():
+                    set_clause = ", ".join([f"{k} = ?" for k in columns] + ["updated_at = ?"])
+                    values = [
+                        tuple(update[k] for k in columns) + (updated_at, update['message_id'], account)
+                        for update in group
+                    ]
+                    cursor.executemany(f'UPDATE emails SET {set_clause} WHERE message_id = ? AND account = ?', values)
+                return True
+        except Exception as e:
+            print(f"Error updating emails: {e}")
+            return False
+
+    def get_email(self, message_id: str, account: str) -> Optional[Dict[str, Any]]:
+        """Get an account's email by message_id."""
         try:
-            with self.lock:
-                conn = self.get_connection()
-                conn.row_factory = self.dict_factory
+            with self.read_connection() as conn:
                 cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
                 
-                cursor.execute('SELECT * FROM emails WHERE message_id = ?', (message_id,))
+                cursor.execute('SELECT * FROM emails WHERE account = ? AND message_id = ?', (account, message_id))
                 result = cursor.fetchone()
-                conn.close()
                 return result
         except Exception as e:
             print(f"Error getting email: {e}")
@@ -224,10 +509,9 @@ class DatabaseManager:
     def scan_emails(self, filter_condition: Optional[Dict] = None) -> List[Dict[str, Any]]:
         """Get all emails with optional filtering."""
         try:
-            with self.lock:
-                conn = self.get_connection()
-                conn.row_factory = self.dict_factory
+            with self.read_connection() as conn:
                 cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
                 
                 if filter_condition:
                     # Simple filtering support (can be extended)
@@ -237,17 +521,85 @@ class DatabaseManager:
                     cursor.execute('SELECT * FROM emails')
                 
                 results = cursor.fetchall()
-                conn.close()
                 return results
         except Exception as e:
             print(f"Error scanning emails: {e}")
             return []
     
-    def update_email(self, message_id: str, update_data: Dict[str, Any]) -> bool:
-        """Update an email record."""
+    def email_column_sql(self, columns: Optional[List[str]] = None) -> str:
+        """Build a select list for the given email columns, always including message_id."""
+        if columns is None:
+            return '*'
+        unknown = set(columns) - self.email_columns
+        if unknown:
+            raise ValueError(f"Unknown email columns: {sorted(unknown)}")
+        if 'message_id' not in columns:
+            columns = ['message_id'] + list(columns)
+        return ', '.join(columns)
+
+    def get_emails(self, message_ids: List[str], account: str,
+                   columns: Optional[List[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """Get several emails of an account at once, keyed by message_id."""
+        column_sql = self.email_column_sql(columns)
+        results = {}
+        try:
+            with self.read_connection() as conn:
+                cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
+                # Stay well under SQLite's bound parameter limit
+                for start in range(0, len(message_ids), 500):
+                    chunk = message_ids[start:start + 500]
+                    placeholders = ", ".join("?" for _ in chunk)
+                    cursor.execute(f'SELECT {column_sql} FROM emails WHERE account = ? AND message_id IN ({placeholders})',
+                                   [account] + list(chunk))
+                    for row in cursor.fetchall():
+                        results[row['message_id']] = row
+            return results
+        except Exception as e:
+            print(f"Error getting emails: {e}")
+            return results
+
+    def iter_emails(self, account: str, after: Optional[str] = None, limit: Optional[int] = None,
+                    columns: Optional[List[str]] = None, page_size: int = 500) -> Iterator[sqlite3.Row]:
+        """Stream an account's emails in message_id order.
+
+        Rows are read in keyset pages of page_size, each one a fresh query
+        resuming after the last message_id seen, so no connection is held
+        between pages and only one page is in memory at a time. after skips
+        to the emails following that message_id, limit caps the total rows
+        and columns selects a subset of columns (message_id is always
+        included). Rows are sqlite3.Row objects.
+        """
+        column_sql = self.email_column_sql(columns)
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = page_size if remaining is None else min(page_size, remaining)
+            try:
+                with self.read_connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.row_factory = sqlite3.Row
+                    if after is None:
+                        cursor.execute(f'SELECT {column_sql} FROM emails WHERE account = ? ORDER BY message_id LIMIT ?',
+                                       (account, size))
+                    else:
+                        cursor.execute(f'SELECT {column_sql} FROM emails WHERE account = ? AND message_id > ? ORDER BY message_id LIMIT ?',
+                                       (account, after, size))
+                    rows = cursor.fetchall()
+            except Exception as e:
+                print(f"Error iterating emails: {e}")
+                return
+
+            yield from rows
+            if len(rows) < size:
+                return
+            after = rows[-1]['message_id']
+            if remaining is not None:
+                remaining -= len(rows)
+
+    def update_email(self, message_id: str, account: str, update_data: Dict[str, Any]) -> bool:
+        """Update an account's email record."""
         try:
-            with self.lock:
-                conn = self.get_connection()
+            with self.write_connection() as conn:
                 cursor = conn.cursor()
                 
                 # Automatically set updated_at timestamp
@@ -255,28 +607,290 @@ class DatabaseManager:
                 update_data_with_timestamp['updated_at'] = datetime.now().isoformat()
                 
                 set_clause = ", ".join([f"{k} = ?" for k in update_data_with_timestamp.keys()])
-                values = list(update_data_with_timestamp.values()) + [message_id]
+                values = list(update_data_with_timestamp.values()) + [account, message_id]
                 
-                cursor.execute(f'UPDATE emails SET {set_clause} WHERE message_id = ?', values)
-                conn.commit()
-                conn.close()
+                cursor.execute(f'UPDATE emails SET {set_clause} WHERE account = ? AND message_id = ?', values)
                 return True
         except Exception as e:
             print(f"Error updating email: {e}")
             return False
     
+    # LLM response cache operations
+    def get_llm_response(self, key: str, max_age: float) -> Optional[str]:
+        """Get a cached LLM response no older than max_age seconds, marking it used."""
+        try:
+            now = time.time()
+            with self.read_connection() as conn:
+                row = conn.execute('SELECT response FROM llm_cache WHERE key = ? AND created_at >= ?',
+                                   (key, now - max_age)).fetchone()
+            if row is None:
+                return None
+            with self.write_connection() as conn:
+                conn.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (now, key))
+            return row[0]
+        except Exception as e:
+            print(f"Error getting cached response: {e}")
+            return None
+
+    def put_llm_response(self, key: str, model: str, response: str) -> bool:
+        """Store an LLM response in the cache."""
+        try:
+            now = time.time()
+            with self.write_connection() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO llm_cache (key, model, response, size, created_at, last_used)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (key, model, response, len(response), now, now))
+            return True
+        except Exception as e:
+            print(f"Error caching response: {e}")
+            return False
+
+    def evict_llm_responses(self, max_age: float, max_bytes: int) -> int:
+        """Drop expired cache entries, then the least recently used ones beyond max_bytes."""
+        try:
+            with self.write_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('DELETE FROM llm_cache WHERE created_at < ?', (time.time() - max_age,))
+                removed = cursor.rowcount
+                cursor.execute('''
+                    DELETE FROM llm_cache WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS running
+                            FROM llm_cache
+                        ) WHERE running > ?
+                    )
+                ''', (max_bytes,))
+                return removed + cursor.rowcount
+        except Exception as e:
+            print(f"Error evicting cached responses: {e}")
+            return 0
+
+    def llm_cache_size(self) -> Dict[str, int]:
+        """Get the number of cached responses and their total size."""
+        try:
+            with self.read_connection() as conn:
+                entries, size = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+                return {'entries': entries, 'bytes': size}
+        except Exception as e:
+            print(f"Error sizing response cache: {e}")
+            return {'entries': 0, 'bytes': 0}
+
+    # Sync state operations
+    def get_sync_state(self, account: str, mailbox: str = 'INBOX') -> Optional[Dict[str, Any]]:
+        """Get the IMAP sync position of an account's mailbox, if it has one."""
+        try:
+            with self.read_connection() as conn:
+                cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
+                cursor.execute(
+                    'SELECT uidvalidity, last_uid, highest_modseq FROM sync_state WHERE account = ? AND mailbox = ?',
+                    (account, mailbox)
+                )
+                return cursor.fetchone()
+        except Exception as e:
+            print(f"Error getting sync state: {e}")
+            return None
+
+    def put_sync_state(self, account: str, state: Dict[str, Any], mailbox: str = 'INBOX') -> bool:
+        """Store the IMAP sync position of an account's mailbox."""
+        try:
+            with self.write_connection() as conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO sync_state
+                    (account, mailbox, uidvalidity, last_uid, highest_modseq, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (
+                    account,
+                    mailbox,
+                    state.get('uidvalidity'),
+                    state.get('last_uid'),
+                    state.get('highest_modseq'),
+                    time.time()
+                ))
+                return True
+        except Exception as e:
+            print(f"Error storing sync state: {e}")
+            return False
+
+    def reset_sync_state(self, account: str) -> bool:
+        """Forget the sync position of an account so the next poll does a full search."""
+        try:
+            with self.write_connection() as conn:
+                conn.execute('DELETE FROM sync_state WHERE account = ?', (account,))
+                return True
+        except Exception as e:
+            print(f"Error resetting sync state: {e}")
+            return False
+
+    # Outbox operations
+    def enqueue_outbox(self, account: str, message_id: str, sender: str, recipients: List[str], message: bytes) -> Optional[int]:
+        """Queue a message for the background sender and return its outbox id."""
+        try:
+            now = time.time()
+            with self.write_connection() as conn:
+                cursor = conn.execute('''
+                    INSERT INTO outbox (account, message_id, sender, recipients, message, status, attempts, next_attempt_at, created_at)
+                    VALUES (?, ?, ?, ?, ?, 'queued', 0, ?, ?)
+                ''', (account, message_id, sender, json.dumps(recipients), message, now, now))
+                return cursor.lastrowid
+        except Exception as e:
+            print(f"Error queueing outbox message: {e}")
+            return None
+
+    def claim_outbox(self, limit: int) -> List[Dict[str, Any]]:
+        """Mark up to limit queued messages that are due as sending and return them.
+
+        Messages are claimed inside one write transaction, so a message is
+        never handed out twice.
+        """
+        try:
+            with self.write_connection() as conn:
+                cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
+                cursor.execute(
+                    "SELECT * FROM outbox WHERE status = 'queued' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                    (time.time(), limit)
+                )
+                rows = cursor.fetchall()
+                cursor.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", [(row['id'],) for row in rows])
+                for row in rows:
+                    row['recipients'] = json.loads(row['recipients'] or '[]')
+                return rows
+        except Exception as e:
+            print(f"Error claiming outbox messages: {e}")
+            return []
+
+    def next_outbox_attempt(self) -> Optional[float]:
+        """Get the time the next queued message is due, if any are queued."""
+        try:
+            with self.read_connection() as conn:
+                return conn.execute("SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'queued'").fetchone()[0]
+        except Exception as e:
+            print(f"Error reading outbox: {e}")
+            return None
+
+    def finish_outbox(self, outbox_id: int, status: str, error: str = None, next_attempt_at: float = None) -> bool:
+        """Record the result of a send attempt.
+
+        status is 'sent', 'failed', or 'queued' to retry at next_attempt_at.
+        """
+        try:
+            with self.write_connection() as conn:
+                conn.execute('''
+                    UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ?,
+                        next_attempt_at = COALESCE(?, next_attempt_at), sent_at = ?
+                    WHERE id = ?
+                ''', (status, error, next_attempt_at, time.time() if status == 'sent' else None, outbox_id))
+                return True
+        except Exception as e:
+            print(f"Error updating outbox message: {e}")
+            return False
+
+    def requeue_outbox(self) -> int:
+        """Put messages left in 'sending' by a previous run back in the queue."""
+        try:
+            with self.write_connection() as conn:
+                return conn.execute("UPDATE outbox SET status = 'queued' WHERE status = 'sending'").rowcount
+        except Exception as e:
+            print(f"Error requeueing outbox messages: {e}")
+            return 0
+
+    def retry_outbox(self, outbox_id: int, account: str) -> bool:
+        """Queue a failed message to be sent again now, with a fresh set of attempts."""
+        try:
+            with self.write_connection() as conn:
+                cursor = conn.execute(
+                    "UPDATE outbox SET status = 'queued', attempts = 0, next_attempt_at = ? WHERE id = ? AND account = ? AND status = 'failed'",
+                    (time.time(), outbox_id, account)
+                )
+                return cursor.rowcount > 0
+        except Exception as e:
+            print(f"Error retrying outbox message: {e}")
+            return False
+
+    def get_outbox(self, account: str, statuses: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Get an account's outbox entries without the message content, newest first."""
+        try:
+            with self.read_connection() as conn:
+                cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
+                query = '''
+                    SELECT id, message_id, recipients, status, attempts, next_attempt_at, last_error, created_at, sent_at
+                    FROM outbox WHERE account = ?
+                '''
+                params = [account]
+                if statuses:
+                    query += f" AND status IN ({', '.join('?' for _ in statuses)})"
+                    params.extend(statuses)
+                cursor.execute(query + ' ORDER BY id DESC', params)
+                rows = cursor.fetchall()
+                for row in rows:
+                    row['recipients'] = json.loads(row['recipients'] or '[]')
+                return rows
+        except Exception as e:
+            print(f"Error getting outbox: {e}")
+            return []
+
+    def outbox_counts(self) -> Dict[str, int]:
+        """Count outbox entries by status."""
+        try:
+            with self.read_connection() as conn:
+                return dict(conn.execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+        except Exception as e:
+            print(f"Error counting outbox: {e}")
+            return {}
+
+    # Filter verdict operations
+    def get_filter_verdicts(self, account: str, rule_hash: str, message_ids: List[str]) -> Dict[str, bool]:
+        """Get the stored verdicts of one AI rule for the given emails, by message id."""
+        try:
+            with self.read_connection() as conn:
+                cursor = conn.execute('''
+                    SELECT message_id, verdict FROM filter_verdicts
+                    WHERE account = ? AND rule_hash = ? AND message_id IN (SELECT value FROM json_each(?))
+                ''', (account, rule_hash, json.dumps(message_ids)))
+                return {message_id: bool(verdict) for message_id, verdict in cursor.fetchall()}
+        except Exception as e:
+            print(f"Error getting filter verdicts: {e}")
+            return {}
+
+    def put_filter_verdicts(self, account: str, rule_hash: str, verdicts: Dict[str, bool]) -> bool:
+        """Store verdicts of one AI rule, keyed by message id."""
+        try:
+            now = time.time()
+            with self.write_connection() as conn:
+                conn.executemany('''
+                    INSERT OR REPLACE INTO filter_verdicts (account, rule_hash, message_id, verdict, created_at)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(account, rule_hash, message_id, int(verdict), now) for message_id, verdict in verdicts.items()])
+                return True
+        except Exception as e:
+            print(f"Error storing filter verdicts: {e}")
+            return False
+
+    def prune_filter_verdicts(self, account: str, rule_hashes: List[str]) -> int:
+        """Drop an account's verdicts for rules other than rule_hashes."""
+        try:
+            with self.write_connection() as conn:
+                return conn.execute(
+                    'DELETE FROM filter_verdicts WHERE account = ? AND rule_hash NOT IN (SELECT value FROM json_each(?))',
+                    (account, json.dumps(rule_hashes))
+                ).rowcount
+        except Exception as e:
+            print(f"Error pruning filter verdicts: {e}")
+            return 0
+
     # Metadata operations
     def get_metadata(self, user: str, key: str = None) -> Optional[Any]:
         """Get metadata for a user."""
         try:
-            with self.lock:
-                conn = self.get_connection()
-                conn.row_factory = self.dict_factory
+            with self.read_connection() as conn:
                 cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
                 
                 cursor.execute('SELECT * FROM metadata WHERE user = ?', (user,))
                 result = cursor.fetchone()
-                conn.close()
                 
                 if result:
                     if key:
@@ -297,8 +911,7 @@ class DatabaseManager:
     def put_metadata(self, user: str, data: Dict[str, Any]) -> bool:
         """Store metadata for a user."""
         try:
-            with self.lock:
-                conn = self.get_connection()
+            with self.write_connection() as conn:
                 cursor = conn.cursor()
                 
                 # First, get existing metadata to preserve values not being updated
@@ -343,9 +956,6 @@ class DatabaseManager:
                     final_data['rules'],
                     datetime.now().isoformat()
                 ))
-                
-                conn.commit()
-                conn.close()
                 return True
         except Exception as e:
             print(f"Error storing metadata: {e}")
@@ -355,14 +965,12 @@ class DatabaseManager:
     def get_users(self) -> List[Dict[str, Any]]: 
         """Get all users."""
         try:
-            with self.lock:
-                conn = self.get_connection()
-                conn.row_factory = self.dict_factory
+            with self.read_connection() as conn:
                 cursor = conn.cursor()
+                cursor.row_factory = self.dict_factory
                 
                 cursor.execute('SELECT * FROM users')
                 results = cursor.fetchall()
-                conn.close()
                 return results
         except Exception as e:
             print(f"Error getting users: {e}")
@@ -371,17 +979,13 @@ class DatabaseManager:
     def put_user(self, user: str, host: str, password: str) -> bool:
         """Store a user account."""
         try:
-            with self.lock:
-                conn = self.get_connection()
+            with self.write_connection() as conn:
                 cursor = conn.cursor()
                 
                 cursor.execute('''
                     INSERT OR REPLACE INTO users (user, host, password, active)
                     VALUES (?, ?, ?, TRUE)
                 ''', (user, host, password))
-                
-                conn.commit()
-                conn.close()
                 return True
         except Exception as e:
             print(f"Error storing user: {e}")
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Mail Import Utility
+Load an account's history from an mbox file or Maildir directory straight
+into the dMail database, instead of downloading it over IMAP.
+
+Usage:
+    python import_mail.py user@gmail.com ~/Takeout/All\ mail.mbox
+    python import_mail.py user@gmail.com ~/Maildir --unprocessed
+
+Messages are read and parsed a batch at a time (parsing runs in worker
+processes while the next batch is read), filtered with the account's
+whitelist rules and stored with one transaction per batch, so memory use
+stays flat however large the mailbox is. Messages already in the database
+are left untouched, so an import can be re-run after an interruption.
+"""
+
+import os
+import re
+import sys
+import time
+import asyncio
+import hashlib
+import argparse
+import mailbox
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web-app', 'api'))
+
+MESSAGE_ID_RE = re.compile(rb'^Message-ID:\s*(<[^>\r\n]+>)', re.IGNORECASE | re.MULTILINE)
+
+
+def open_mailbox(path, mailbox_format='auto'):
+    """Open path as an mbox file or a Maildir directory."""
+    if mailbox_format == 'auto':
+        mailbox_format = 'maildir' if os.path.isdir(path) else 'mbox'
+    if mailbox_format == 'maildir':
+        return mailbox.Maildir(path, factory=None, create=False)
+    return mailbox.mbox(path, factory=None, create=False)
+
+
+def message_id(email_data):
+    """The Message-ID header, or a hash of the message when it has none."""
+    header_end = email_data.find(b'\n\n')
+    match = MESSAGE_ID_RE.search(email_data, 0, header_end if header_end != -1 else len(email_data))
+    if match:
+        return match.group(1).decode('ascii', 'replace')
+    return f"<import-{hashlib.sha1(email_data).hexdigest()}>"
+
+
+def iter_batches(box, batch_size):
+    """Yield lists of (message id, raw message) read from the mailbox."""
+    batch = []
+    for key in box.iterkeys():
+        try:
+            email_data = box.get_bytes(key)
+        except Exception as e:
+            print(f"⚠️  Could not read message {key}: {e}")
+            continue
+        batch.append((message_id(email_data), email_data))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def keep(whitelist, emails):
+    """The emails the whitelist keeps; ones an AI rule fails on are kept."""
+    verdicts = await whitelist.filter_many(emails)
+    return [email for email, passed in zip(emails, verdicts) if passed]
+
+
+async def import_mailbox(box, account, db, whitelist, parser, batch_size, processed):
+    """Import every message in box, returning (read, stored) counts."""
+    read = stored = 0
+    start = time.perf_counter()
+    pending = None
+
+    def store(emails):
+        for email in emails:
+            email.processed = processed
+        if not emails:
+            return 0
+        # Messages already in the database are skipped, only new rows are counted
+        inserted = db.store_emails([email.to_db_dict() for email in emails], account, replace=False)
+        if inserted is None:
+            raise RuntimeError("Failed to store a batch of emails")
+        return inserted
+
+    for batch in iter_batches(box, batch_size):
+        read += len(batch)
+        # Parse this batch in the pool while the previous one is filtered and stored
+        task = asyncio.ensure_future(parser.parse(batch))
+        if pending is not None:
+            stored += store(await keep(whitelist, await pending))
+            elapsed = time.perf_counter() - start
+            print(f"   {read:,} read, {stored:,} stored ({read / elapsed:,.0f} msgs/s)")
+        pending = task
+    if pending is not None:
+        stored += store(await keep(whitelist, await pending))
+    return read, stored
+
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Import an mbox file or Maildir into dMail.")
+    parser.add_argument('account', help="account the mail belongs to, as added with add_user.py")
+    parser.add_argument('path', help="mbox file or Maildir directory")
+    parser.add_argument('--format', choices=('auto', 'mbox', 'maildir'), default='auto')
+    parser.add_argument('--batch-size', type=int, default=1000, help="messages per parse batch and transaction")
+    parser.add_argument('--workers', type=int, default=None, help="parser processes (0 parses inline)")
+    parser.add_argument('--no-filter', action='store_true', help="import everything, ignoring the whitelist")
+    parser.add_argument('--unprocessed', action='store_true',
+                        help="leave imported mail unprocessed so the agent works through it")
+    parser.add_argument('--db', help="database file (default: the configured dmail.db)")
+    args = parser.parse_args()
+
+    print("📥 Import Mail into dMail")
+    print("========================")
+
+    from database import DatabaseManager, db
+    from inbox import FilterList, VerdictCache
+    from mime_parser import MimeParser
+
+    if args.db:
+        db = DatabaseManager(args.db)
+
+    if not any(user.get('user') == args.account for user in db.get_users()):
+        print(f"⚠️  {args.account} is not a known user, add it with add_user.py to sync it later")
+
+    whitelist = FilterList(verdicts=VerdictCache(db, args.account))
+    metadata = db.get_metadata(args.account) or {}
+    if metadata.get('rules') and not args.no_filter:
+        whitelist.update_from_json(metadata['rules'])
+    if whitelist.compiled.ai_filters:
+        from agent import Agent
+        whitelist.agent = Agent("openai")
+    print(f"🔎 {len(whitelist.filters)} whitelist rules")
+
+    try:
+        box = open_mailbox(args.path, args.format)
+    except Exception as e:
+        print(f"❌ Could not open {args.path}: {e}")
+        return False
+
+    mime_parser = MimeParser(args.workers)
+    start = time.perf_counter()
+    try:
+        read, stored = asyncio.run(import_mailbox(box, args.account, db, whitelist, mime_parser,
+                                                  args.batch_size, not args.unprocessed))
+    except KeyboardInterrupt:
+        print("🛑 Interrupted, batches stored so far are kept")
+        return False
+    finally:
+        mime_parser.close()
+        box.close()
+    elapsed = time.perf_counter() - start
+    print(f"✅ Read {read:,} messages and stored {stored:,} in {elapsed:.1f}s "
+          f"({read / elapsed if elapsed else 0:,.0f} msgs/s, {mime_parser.failed} could not be parsed)")
+    return True
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
@@ -92,7 +92,7 @@ def test_database():
         print("✅ Test email added successfully")
         
         # Get test email
-        email = db.get_email('test-123')
+        email = db.get_email('test-123', test_email)
         if not email:
             print("❌ Test email not found")
             return False
@@ -100,7 +100,7 @@ def test_database():
         print("✅ Test email retrieved successfully")
         
         # Update test email
-        success = db.update_email('test-123', {'processed': True, 'action': 'tested'})
+        success = db.update_email('test-123', test_email, {'processed': True, 'action': 'tested'})
         if not success:
             print("❌ Failed to update test email")
             return False
@@ -197,6 +197,314 @@ def test_imports():
     
     return True
 
+def test_rate_limiter():
+    """Test that cancelled LLM calls give their concurrency slot back."""
+    print("🧪 Testing the rate limiter...")
+
+    api_dir = Path(__file__).resolve().parent / "web-app" / "api"
+    sys.path.insert(0, str(api_dir))
+
+    try:
+        import asyncio
+        from rate_limiter import RateLimiter
+    except ImportError as e:
+        print(f"❌ Failed to import rate_limiter: {e}")
+        return False
+
+    async def check():
+        limiter = RateLimiter(requests_per_minute=6000, tokens_per_minute=60000, max_concurrency=2)
+        calls = [asyncio.ensure_future(limiter.run(lambda: asyncio.sleep(10))) for _ in range(2)]
+        await asyncio.sleep(0.1)
+        for call in calls:
+            call.cancel()
+        await asyncio.gather(*calls, return_exceptions=True)
+        if limiter.concurrency.in_flight != 0:
+            print(f"❌ {limiter.concurrency.in_flight} slots still held after cancelling")
+            return False
+        async def answer():
+            return 42
+        try:
+            result = await asyncio.wait_for(limiter.run(answer), 2)
+        except asyncio.TimeoutError:
+            print("❌ A call after cancelled ones never ran")
+            return False
+        if result != 42:
+            print(f"❌ Unexpected result: {result}")
+            return False
+        print("✅ Cancelled calls released their slots")
+        return True
+
+    try:
+        return asyncio.run(check())
+    except Exception as e:
+        print(f"❌ Rate limiter test failed: {e}")
+        return False
+
+def test_account_emails():
+    """Test that two accounts can store the same message independently."""
+    print("🧪 Testing per-account email storage...")
+
+    try:
+        import tempfile
+        from database import DatabaseManager
+    except ImportError as e:
+        print(f"❌ Failed to import database: {e}")
+        return False
+
+    email = {
+        'message_id': '<shared@example.com>', 'subject': 'Shared', 'body': 'Hello', 'full_body': 'Hello',
+        'html': '[]', 'from_': '[]', 'to_': '[]', 'date': '2024-01-01 00:00:00', 'processed': False,
+        'state': '[]', 'drafted_response': '', 'sent_response': '', 'sent_date': '', 'sent_to': '',
+        'sent_subject': '', 'sent_body': '', 'tags': '[]',
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'test.db'))
+        try:
+            if not db.bulk_put_emails([email], 'a@example.com'):
+                print("❌ Failed to store the email for the first account")
+                return False
+            if db.store_emails([email], 'b@example.com', replace=False) != 1:
+                print("❌ The second account's copy was skipped")
+                return False
+            db.bulk_put_emails([email], 'b@example.com')
+            db.update_email(email['message_id'], 'b@example.com', {'subject': 'Changed'})
+            first = db.get_email(email['message_id'], 'a@example.com')
+            second = db.get_email(email['message_id'], 'b@example.com')
+        finally:
+            db.close()
+    if first is None or second is None:
+        print("❌ Storing the message for one account removed it from the other")
+        return False
+    if (first['subject'], second['subject']) != ('Shared', 'Changed'):
+        print(f"❌ Updates were not scoped to the account: {first['subject']}, {second['subject']}")
+        return False
+    print("✅ Each account keeps its own copy of a shared message")
+    return True
+
+def test_processing_worker():
+    """Test that a poll made right after starting the worker sees it running."""
+    print("🧪 Testing the processing worker...")
+
+    api_dir = Path(__file__).resolve().parent / "web-app" / "api"
+    sys.path.insert(0, str(api_dir))
+
+    try:
+        import asyncio
+        import tempfile
+        from database import DatabaseManager
+        from inbox import Inbox, Email
+        from processing_worker import ProcessingWorker
+    except ImportError as e:
+        print(f"❌ Failed to import the processing worker: {e}")
+        return False
+
+    class SlowAgent:
+        async def process_email(self, email):
+            await asyncio.sleep(0.2)
+            email.processed = True
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'test.db'))
+        inbox = Inbox()
+        inbox.db = db
+        inbox.user = 'worker@example.com'
+        inbox.agent = SlowAgent()
+        for i in range(3):
+            email = Email(f'<worker-{i}@example.com>', f'Hello {i}', f'Body {i}')
+            inbox.emails[email.id] = email
+            inbox.unprocessed_message_ids.append(email.id)
+        inbox.save_emails()
+        inbox.state = inbox.State.HYDRATED
+        worker = ProcessingWorker(inbox)
+        inbox.process_function = worker.start
+        try:
+            # the same check /api/process_emails makes before answering
+            inbox.update_state(inbox.State.PROCESSING)
+            if not worker.busy and not worker.collect(0):
+                print("❌ The first poll after starting reported done")
+                return False
+            collected = []
+            while worker.busy or len(collected) < 3:
+                finished = worker.collect(5)
+                if not finished and not worker.busy:
+                    break
+                collected += finished
+        finally:
+            worker.cancel()
+            db.close()
+    if sorted(collected) != sorted(inbox.emails):
+        print(f"❌ The worker reported {len(collected)} of 3 emails")
+        return False
+    print("✅ Polls see the worker as soon as it is started")
+    return True
+
+def test_mail_server():
+    """Test IMAP sync and SMTP sending against the in-repo fake mail servers."""
+    print("🧪 Testing mail sync against the fake servers...")
+
+    api_dir = Path(__file__).resolve().parent / "web-app" / "api"
+    sys.path.insert(0, str(api_dir))
+
+    try:
+        import asyncio
+        import tempfile
+        import threading
+        import time
+        import gmail
+        from database import DatabaseManager
+        from fake_mail_server import FakeImapServer, FakeSmtpServer, generate_mailbox, make_message
+        from imap_sessions import ImapSession
+        from inbox import Email
+        from smtp_outbox import Outbox
+    except ImportError as e:
+        print(f"❌ Failed to import mail modules: {e}")
+        return False
+
+    async def check_imap():
+        # every 10th message carries an attachment that should not be downloaded
+        server = FakeImapServer(generate_mailbox(200, attachment_every=10, days=1), latency=0.001)
+        port = await server.start()
+        sync_state = {}
+        retrieve = lambda **kwargs: gmail.retrieve_emails('ALL', server.user, server.password, host='127.0.0.1',
+                                                          port=port, use_ssl=False, sync_state=sync_state, **kwargs)
+        try:
+            start = time.perf_counter()
+            emails = await retrieve()
+            elapsed = time.perf_counter() - start
+            if len(emails) != 200:
+                print(f"❌ Full sync returned {len(emails)} of 200 emails")
+                return False
+            print(f"✅ Full sync fetched 200 emails ({200 / elapsed:,.0f} msgs/s)")
+
+            by_subject = {email.subject: email for email in emails}
+            with_attachment = by_subject.get('Fake message 10')
+            if with_attachment is None or not with_attachment.body.startswith('Hello, this is fake message 10'):
+                print("❌ Email contents do not match the mailbox")
+                return False
+            if [a['filename'] for a in with_attachment.attachments] != ['attachment-10.bin']:
+                print(f"❌ Attachment metadata missing: {with_attachment.attachments}")
+                return False
+            print("✅ Bodies parsed and attachments recorded without downloading them")
+
+            if await retrieve():
+                print("❌ An unchanged mailbox returned emails")
+                return False
+            server.add_message(make_message(200))
+            emails = await retrieve()
+            if [email.subject for email in emails] != ['Fake message 200']:
+                print(f"❌ Incremental sync returned {[email.subject for email in emails]}")
+                return False
+            print("✅ Incremental sync fetched only the new email")
+
+            # a failed fetch must not mark the new uids as seen
+            server.add_message(make_message(201))
+            server.add_message(make_message(202))
+            server.failed_fetches = 1
+            if await retrieve():
+                print("❌ A failed fetch returned emails")
+                return False
+            emails = await retrieve()
+            if sorted(email.subject for email in emails) != ['Fake message 201', 'Fake message 202']:
+                print(f"❌ Poll after a failed fetch returned {[email.subject for email in emails]}")
+                return False
+            print("✅ Emails from a failed fetch were fetched on the next poll")
+
+            # a message left out of the fetch response holds the sync position below it
+            server.add_message(make_message(203))
+            server.unreadable.add(server.uids[-1])
+            server.add_message(make_message(204))
+            emails = await retrieve()
+            if [email.subject for email in emails] != ['Fake message 204']:
+                print(f"❌ Poll with an unreadable email returned {[email.subject for email in emails]}")
+                return False
+            server.unreadable.clear()
+            emails = await retrieve()
+            if 'Fake message 203' not in [email.subject for email in emails]:
+                print(f"❌ Poll after an unreadable email returned {[email.subject for email in emails]}")
+                return False
+            print("✅ An email missing from the fetch response was retried on the next poll")
+
+            # a retrieve cancelled part way must not leave its connection in use
+            session = ImapSession(server.user, server.password, '127.0.0.1', port, False)
+            await session.retrieve('ALL', sync_state={})
+            server.latency = 1.0
+            try:
+                await asyncio.wait_for(session.retrieve('ALL', sync_state={}), 0.2)
+            except asyncio.TimeoutError:
+                pass
+            server.latency = 0.001
+            if session.client is not None:
+                print("❌ A cancelled retrieve kept its connection")
+                return False
+            if len(await session.retrieve('ALL', sync_state={})) != 205:
+                print("❌ Retrieve after a cancelled one did not reconnect")
+                return False
+            await session.close()
+            print("✅ A cancelled retrieve dropped its connection")
+
+            server.reset_uids(uidvalidity=2)
+            if len(await retrieve()) != 205:
+                print("❌ A UIDVALIDITY change did not trigger a full sync")
+                return False
+            print("✅ UIDVALIDITY change triggered a full sync")
+
+            async def from_sender_one(email):
+                return email.from_[0][1] == 'sender1@example.com'
+            sync_state.clear()
+            emails = await retrieve(header_filter=from_sender_one)
+            if len(emails) != 5 or any(email.from_[0][1] != 'sender1@example.com' for email in emails):
+                print(f"❌ Header filter kept {len(emails)} emails")
+                return False
+            print("✅ Header filter downloaded only whitelisted bodies")
+            return True
+        finally:
+            await server.stop()
+
+    def check_smtp():
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        server = FakeSmtpServer(reject={'nobody@example.com'})
+        port = asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        delivered = {}
+        done = threading.Event()
+
+        def on_delivery(account, message_id, ok):
+            delivered[message_id] = ok
+            if len(delivered) == 2:
+                done.set()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            outbox = Outbox(DatabaseManager(os.path.join(tmp, 'test.db')), '127.0.0.1', port, use_tls=False)
+            outbox.on_delivery = on_delivery
+            outbox.start()
+            try:
+                for message_id, sender in (('<ok@example.com>', 'friend@example.com'), ('<bad@example.com>', 'nobody@example.com')):
+                    email = Email(message_id, 'Hello', 'Hi there', from_=[('Someone', sender)])
+                    outbox.send(email, 'Thanks!', server.user, server.password)
+                if not done.wait(10):
+                    print(f"❌ Outbox did not finish: {delivered}")
+                    return False
+            finally:
+                outbox.stop()
+                asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+                loop.call_soon_threadsafe(loop.stop)
+
+        if delivered != {'<ok@example.com>': True, '<bad@example.com>': False}:
+            print(f"❌ Unexpected delivery results: {delivered}")
+            return False
+        sender, recipients, message = server.messages[0]
+        if recipients != ['friend@example.com'] or b'Subject: Re: Hello' not in message:
+            print(f"❌ Sent message does not match the reply: {recipients}")
+            return False
+        print("✅ Outbox delivered the reply and gave up on the refused recipient")
+        return True
+
+    try:
+        return asyncio.run(check_imap()) and check_smtp()
+    except Exception as e:
+        print(f"❌ Mail server test failed: {e}")
+        return False
+
 def main():
     """Main test function."""
     print("🧪 dMail SQLite Setup Test")
@@ -207,6 +515,10 @@ def main():
         ("Import Test", test_imports),
         ("Configuration Test", test_config),
         ("Database Test", test_database),
+        ("Rate Limiter Test", test_rate_limiter),
+        ("Account Emails Test", test_account_emails),
+        ("Processing Worker Test", test_processing_worker),
+        ("Mail Server Test", test_mail_server),
     ]
     
     passed = 0
@@ -1,10 +1,17 @@
 from openai import OpenAI
+import openai
 import config_reader
+from rate_limiter import RateLimiter
+from llm_cache import LLMCache
 
 OPENAI_API_KEY = config_reader.OPENAI_API_KEY
 
 import asyncio
+import functools
 import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
 PROMPT_TEMPLATE = Template("""
 You are a helpful assistant that can help with email.
@@ -115,10 +122,16 @@ DEFAULT_TOOLS = [
     }
   ]
 
+MODEL = "gpt-4.1"
+
+#output tokens budgeted per request when estimating token usage
+RESPONSE_TOKEN_ALLOWANCE = 512
+
 class Agent:
     def __init__(self, client_type):
         if client_type == "openai":
-            self.client = OpenAI(api_key=OPENAI_API_KEY)
+            #retries are handled by the rate limiter instead of the client
+            self.client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
         else:
             raise ValueError(f"Invalid client type: {client_type}")
         
@@ -126,31 +139,74 @@ class Agent:
         self.writing_prompt = DEFAULT_RESPONSE_PROMPT
         self.research_prompt = DEFAULT_RESEARCH_PROMPT
 
+        #requests go through the sync client on a shared thread pool, each flask
+        #request runs its own event loop so a loop-bound async client can't be reused
+        self.max_concurrency = config_reader.LLM_MAX_CONCURRENCY
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='llm')
+        self.limiter = RateLimiter(
+            requests_per_minute=config_reader.LLM_REQUESTS_PER_MINUTE,
+            tokens_per_minute=config_reader.LLM_TOKENS_PER_MINUTE,
+            max_concurrency=self.max_concurrency,
+            max_retries=config_reader.LLM_MAX_RETRIES,
+            target_latency=config_reader.LLM_TARGET_LATENCY,
+            retry_on=(openai.APIConnectionError, openai.InternalServerError),
+            throttle_on=(openai.RateLimitError,),
+        )
+        self.call_times = deque(maxlen=500)
+        self.total_calls = 0
+        #set to an LLMCache to answer repeated requests without calling the api
+        self.cache = None
+
+    def fingerprint(self, email):
+        #hash of everything that decides process_email's result for this email
+        return LLMCache.make_key(MODEL, PROMPT_TEMPLATE.template, [self.instructions, self.writing_prompt, DEFAULT_TOOLS], email.body or email.full_body)
+
+    def cache_key(self, template, instructions, body):
+        if self.cache is None:
+            return None
+        return LLMCache.make_key(MODEL, template, instructions, body)
+
+    def stats(self):
+        times = sorted(self.call_times)
+        return {
+            "total_calls": self.total_calls,
+            "max_concurrency": self.max_concurrency,
+            "avg_seconds": sum(times) / len(times) if times else 0,
+            "p50_seconds": times[len(times) // 2] if times else 0,
+            "p95_seconds": times[int(len(times) * 0.95)] if times else 0,
+            **self.limiter.stats(),
+        }
+
     async def process_email(self, email):
         #get the email content
         if not email.body:
             email.body = email.full_body
         email_content = email.body
         prompt = PROMPT_TEMPLATE.substitute(instructions=self.instructions, email=email_content, response_prompt=self.writing_prompt)
+        #the fingerprint is taken before the call so a prompt edited mid-call is not recorded
+        fingerprint = self.fingerprint(email)
+        cache_key = fingerprint if self.cache is not None else None
 
-        response = await self.get_openai_response(prompt)
+        response = await self.get_openai_response(prompt, cache_key)
         email.processed = True
+        email.fingerprint = fingerprint
         if response:
             for action in response["tool_calls"]:
                 if action["name"] == "draft_response":
-                    email.state.append('drafted_response')
+                    email.add_state('drafted_response')
                     email.drafted_response = action["arguments"]["draft_email_body"]
                 elif action["name"] == "add_tags":
-                    email.state.append('tagged')
+                    email.add_state('tagged')
                     email.tags = action["arguments"]["tags"]
                 elif action["name"]== "archive_email":
-                    email.state.append('archived')
+                    email.add_state('archived')
         return email
         
     async def generate_draft(self, email):
         if not email.body:
             email.body = email.full_body
         prompt = DRAFT_PROMPT_TEMPLATE.substitute(instructions=self.writing_prompt, email=email.body)
+        #not cached, a draft is only asked for to get a new one
         response = await self.get_openai_response(prompt)
         response_text = ""
         if response:
@@ -160,16 +216,113 @@ class Agent:
             response_text = ""
         return response_text
 
-    async def get_openai_response(self, prompt):
-        model = "gpt-4.1"
+    async def run_request(self, create, estimated_tokens):
+        #run a blocking client call on the executor, through the rate limiter
+        async def timed_create():
+            start = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, create)
+            finally:
+                self.total_calls += 1
+                self.call_times.append(time.perf_counter() - start)
+
+        #call times are in stats() for /api/metrics rather than printed per call
+        return await self.limiter.run(timed_create, tokens=estimated_tokens)
+
+    async def research_sender(self, research_prompt, user_input):
+        cache_key = self.cache_key('research', research_prompt, user_input)
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                print('Using cached research')
+                return cached
+
+        create = functools.partial(
+            self.client.responses.create,
+            model=MODEL,
+            input=[
+                {
+                    "role": "system",
+                    "content": [
+                        {
+                            "type": "input_text",
+                            "text": research_prompt
+                        }
+                    ]
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "input_text",
+                            "text": user_input
+                        }
+                    ]
+                }
+            ],
+            text={
+                "format": {
+                    "type": "text"
+                }
+            },
+            reasoning={},
+            tools=[
+                {
+                    "type": "web_search_preview",
+                    "user_location": {
+                        "type": "approximate"
+                    },
+                    "search_context_size": "medium"
+                }
+            ],
+            temperature=1,
+            max_output_tokens=2048,
+            top_p=1
+        )
+        estimated_tokens = (len(research_prompt) + len(user_input)) // 4 + 2048
+        response = await self.run_request(create, estimated_tokens)
+
+        # Process the response to extract summary and annotations
+        summary = ""
+        annotations = []
+        
+        for output in response.output:
+            if output.type == "message":
+                # Extract the text content
+                if hasattr(output, 'content') and output.content:
+                    for content in output.content:
+                        if hasattr(content, 'text'):
+                            summary = content.text
+                        # Extract URL citations/annotations
+                        if hasattr(content, 'annotations'):
+                            for annotation in content.annotations:
+                                if annotation.type == "url_citation":
+                                    annotations.append({
+                                        'url': annotation.url,
+                                        'title': getattr(annotation, 'title', ''),
+                                        'description': getattr(annotation, 'title', '')
+                                    })
+        research = {"summary": summary, "annotations": annotations}
+        if cache_key and summary:
+            self.cache.put(cache_key, MODEL, research)
+        return research
+
+    async def get_openai_response(self, prompt, cache_key=None):
+        #cache_key (from cache_key()) lets an identical earlier response be reused
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                print('Using cached response')
+                return cached
+
         messages = [
             {"role": "system", "content": "You are a helpful assistant that can help with email."},
             {"role": "user", "content": prompt}
         ]
 
-        #wrap in asyncio to_thread
-        response = self.client.responses.create(
-                model=model,
+        create = functools.partial(
+            self.client.responses.create,
+                model=MODEL,
                 input = messages,
                 text = {
                     "format": {
@@ -178,8 +331,9 @@ class Agent:
                 },
                 tools=DEFAULT_TOOLS,
             )
-        
-        
+        #roughly 4 characters per token
+        estimated_tokens = sum(len(m["content"]) for m in messages) // 4 + RESPONSE_TOKEN_ALLOWANCE
+        response = await self.run_request(create, estimated_tokens)
 
         print("--------------------------------")
         print(len(response.output))
@@ -210,5 +364,7 @@ class Agent:
                     action["text"] = output.text 
                 except:
                     action["text"] = ''
+        if cache_key:
+            self.cache.put(cache_key, MODEL, action)
         return action
 
@@ -1,7 +1,14 @@
 from inbox import Inbox
 from flask import Flask, jsonify, request
-from gmail import retrieve_emails, send_email
+from smtp_outbox import Outbox
+from llm_cache import LLMCache
+from imap_sessions import SessionManager
+from sync_coordinator import SyncCoordinator
+from processing_worker import ProcessingWorker
+import gmail
+import mime_parser
 from flask_cors import CORS
+import config_reader
 import asyncio
 import os
 import sys
@@ -24,13 +31,43 @@ app = Flask(__name__)
 CORS(app)
 
 inbox = None
+sessions = None
+outbox = None
+coordinator = None
+worker = None
+
+def on_new_mail(account):
+    #called from the imap session thread when IDLE reports new mail
+    if inbox.user == account:
+        inbox.update_state(inbox.State.UPDATING)
+
+def on_delivery(account, message_id, delivered):
+    #called from the outbox thread once a queued reply is sent or given up on
+    if inbox.user == account:
+        inbox.mark_delivery(message_id, delivered)
 
 def before_first_request():
-    global inbox
+    global inbox, sessions, outbox, coordinator, worker
     inbox = Inbox()
-    inbox.retrieve_function = retrieve_emails
-    inbox.send_function = send_email
+    #keeps imap connections open between polls instead of logging in each time
+    sessions = SessionManager()
+    sessions.on_new_mail = on_new_mail
+    inbox.retrieve_function = sessions.retrieve_emails
     inbox.db = db
+    #replies are queued and sent in the background over pooled smtp connections
+    outbox = Outbox(db)
+    outbox.on_delivery = on_delivery
+    outbox.start()
+    inbox.send_function = outbox.send
+    #unprocessed emails are drained in the background once processing starts
+    worker = ProcessingWorker(inbox)
+    inbox.process_function = worker.start
+    #polls every active account, not just the one open in the ui
+    if config_reader.SYNC_ENABLED:
+        coordinator = SyncCoordinator(db, {(gmail.HOST, gmail.PORT): sessions}, agent=inbox.agent)
+        coordinator.start()
+    if config_reader.LLM_CACHE_ENABLED:
+        inbox.agent.cache = LLMCache(db, config_reader.LLM_CACHE_TTL, config_reader.LLM_CACHE_MAX_BYTES)
 
 with app.app_context():
     before_first_request()
@@ -43,7 +80,9 @@ def get_updates():
     inbox.update_state(inbox.State.UPDATING)
     print('updates done')
 
-    return jsonify([email.to_dict() for email in inbox.emails.values()])
+    #summary=true leaves out body, html and full_body, as for /api/emails
+    include_bodies = request.args.get('summary', 'false').lower() != 'true'
+    return jsonify(inbox.email_dicts(include_bodies))
 
 @app.route('/api/users', methods=['GET'])
 def get_users():
@@ -57,27 +96,64 @@ def get_users():
 
 @app.route('/api/emails', methods=['GET'])
 def get_emails():
-    results = []
+    #summary=true leaves out body, html and full_body
+    include_bodies = request.args.get('summary', 'false').lower() != 'true'
     try:
-        for email in inbox.emails.values():
-            results.append(email.to_dict())
-        return jsonify(results)
+        return jsonify(inbox.email_dicts(include_bodies))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def processing_delta():
+    #the emails processed since the last call, waiting a while for some if
+    #the worker is still busy. "done" once there is nothing left to report
+    email_ids = worker.collect(config_reader.PROCESSING_POLL_SECONDS)
+    with inbox.lock:
+        emails = [inbox.emails[email_id] for email_id in email_ids if email_id in inbox.emails]
+    batch = [email.to_dict() for email in emails]
+    return {"batch": batch, "state": "processed" if batch or worker.busy else "done"}
+
 @app.route('/api/process_emails', methods=['GET'])
 def process_emails():
     inbox.update_state(inbox.State.PROCESSING)
-    return jsonify(inbox.update_delta)
+    return jsonify(processing_delta())
 
 @app.route('/api/reprocess_all', methods=['GET'])
 def reprocess_all():
     inbox.update_state(inbox.State.REPROCESSING)
-    return jsonify(inbox.update_delta)
+    return jsonify(processing_delta())
+
+@app.route('/api/processing', methods=['GET', 'POST'])
+def processing():
+    #GET reports progress, POST {"action": "start" | "pause" | "resume" |
+    #"cancel", "concurrency": n} controls the background worker
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        action = data.get('action')
+        if action == 'start':
+            inbox.update_state(inbox.State.PROCESSING)
+        elif action == 'pause':
+            worker.pause()
+        elif action == 'resume':
+            worker.resume()
+        elif action == 'cancel':
+            worker.cancel()
+        elif action is not None:
+            return jsonify({'error': f'Unknown action: {action}'}), 400
+        if data.get('concurrency') is not None:
+            try:
+                worker.set_concurrency(int(data['concurrency']))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'concurrency must be a number'}), 400
+        return jsonify({'success': True})
+    return jsonify(worker.stats())
 
-@app.route('/api/emails/<message_id>', methods=['GET'])
+@app.route('/api/emails/<path:message_id>', methods=['GET'])
 def get_email(message_id):
-    return jsonify(inbox.emails[message_id].to_dict())
+    #the whole email including bodies, loaded when the ui opens it
+    email = inbox.emails.get(message_id)
+    if email is None:
+        return jsonify({'error': 'Email not found'}), 404
+    return jsonify(email.to_dict())
 
 @app.route('/api/send', methods=['POST'])
 def send_email():
@@ -85,8 +161,20 @@ def send_email():
     email_id = data.get('id')
     draft_text = data.get('draft')
     print(f"Sending email: {email_id} {draft_text}")
-    inbox.send(email_id, draft_text)
-    return jsonify({'success': True})
+    outbox_id = inbox.send(email_id, draft_text)
+    return jsonify({'success': True, 'outbox_id': outbox_id})
+
+@app.route('/api/outbox', methods=['GET', 'POST'])
+def get_outbox():
+    #GET lists queued and failed replies (?all=true includes sent ones),
+    #POST {"id": n} sends a failed reply again
+    if request.method == 'POST':
+        outbox_id = request.get_json().get('id')
+        if not outbox.retry(outbox_id, inbox.user):
+            return jsonify({'error': 'No failed outbox message with that id'}), 404
+        return jsonify({'success': True})
+    statuses = None if request.args.get('all', 'false').lower() == 'true' else ['queued', 'sending', 'failed']
+    return jsonify(db.get_outbox(inbox.user, statuses))
 
 @app.route('/api/generate_draft', methods=['POST'])
 def generate_draft():
@@ -123,6 +211,8 @@ def get_user_profile():
             return jsonify({'error': 'User not found'}), 404
 
         # Get user metadata
+        if coordinator is not None and inbox.user and inbox.user != email:
+            coordinator.detach(inbox.user)
         inbox.user = email
         app_password = user.get('password')
         if type(app_password) == bytes:
@@ -149,6 +239,11 @@ def get_user_profile():
                 print(f"Loading prompts: {prompts}")
                 inbox.load_prompts(prompts)
         inbox.update_state(inbox.State.HYDRATING)
+        if coordinator is not None:
+            #the open account syncs through the inbox so it sees the new mail
+            coordinator.attach(email, lambda: inbox.update_state(inbox.State.UPDATING))
+        if config_reader.IMAP_IDLE_ENABLED:
+            sessions.watch(email, app_password)
         return jsonify(profile)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -202,10 +297,10 @@ def get_whitelist():
     if request.method == 'POST':
         data = request.json
         print(f"Received whitelist: {data}")
-        inbox.whitelist.update_from_json(data)
+        changes = inbox.whitelist.update_from_json(data)
         inbox.save_whitelist()
         print('resyncing')
-        asyncio.run(inbox.resync())
+        asyncio.run(inbox.resync(changes))
         print('resync done')
         return jsonify({'success': True})
     else:
@@ -216,6 +311,17 @@ def get_whitelist():
         except Exception as e:
             return jsonify({'error': str(e)}), 500
 
+@app.route('/api/sync', methods=['GET', 'POST'])
+def sync_accounts():
+    #GET reports each account's sync lag, POST {"account": ...} syncs one
+    #account (or every account without one) now
+    if coordinator is None:
+        return jsonify({'error': 'Background sync is disabled'}), 404
+    if request.method == 'POST':
+        coordinator.sync_now((request.get_json(silent=True) or {}).get('account'))
+        return jsonify({'success': True})
+    return jsonify(coordinator.stats())
+
 @app.route('/api/research_sender', methods=['POST'])
 def research_sender():
     """Research information about an email sender."""
@@ -240,79 +346,12 @@ def research_sender():
         else:
             user_input = f"{sender_email}\n\n"
         
-        # Use OpenAI to research the sender
-        from openai import OpenAI
-        import config_reader
-        
-        client = OpenAI(api_key=config_reader.OPENAI_API_KEY)
-        
-        # Use the saved research prompt from database
-        response = client.responses.create(
-            model="gpt-4.1",
-            input=[
-                {
-                    "role": "system",
-                    "content": [
-                        {
-                            "type": "input_text",
-                            "text": research_prompt
-                        }
-                    ]
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "input_text",
-                            "text": user_input
-                        }
-                    ]
-                }
-            ],
-            text={
-                "format": {
-                    "type": "text"
-                }
-            },
-            reasoning={},
-            tools=[
-                {
-                    "type": "web_search_preview",
-                    "user_location": {
-                        "type": "approximate"
-                    },
-                    "search_context_size": "medium"
-                }
-            ],
-            temperature=1,
-            max_output_tokens=2048,
-            top_p=1
-        )
-        # Process the response to extract summary and annotations
-        summary = ""
-        annotations = []
-        
-        for output in response.output:
-            if output.type == "message":
-                # Extract the text content
-                if hasattr(output, 'content') and output.content:
-                    for content in output.content:
-                        if hasattr(content, 'text'):
-                            summary = content.text
-                        # Extract URL citations/annotations
-                        if hasattr(content, 'annotations'):
-                            for annotation in content.annotations:
-                                if annotation.type == "url_citation":
-                                    annotations.append({
-                                        'url': annotation.url,
-                                        'title': getattr(annotation, 'title', ''),
-                                        'description': getattr(annotation, 'title', '')
-                                    })
+        research = asyncio.run(inbox.agent.research_sender(research_prompt, user_input))
         
         return jsonify({
             'success': True,
-            'summary': summary,
-            'annotations': annotations,
+            'summary': research['summary'],
+            'annotations': research['annotations'],
             'search_query': user_input.strip()
         })
         
@@ -351,6 +390,23 @@ def get_emails_status():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Get performance counters for the current inbox."""
+    return jsonify({
+        'llm': inbox.agent.stats(),
+        'llm_cache': inbox.agent.cache.stats() if inbox.agent.cache else None,
+        'last_batch': inbox.batch_stats,
+        'last_filter': inbox.filter_stats,
+        'processing': worker.stats(),
+        'body_cache': inbox.body_cache.stats() if inbox.body_cache else None,
+        'filter_verdicts': inbox.whitelist.verdicts.stats() if inbox.whitelist.verdicts else None,
+        'imap': sessions.stats(),
+        'mime_parser': mime_parser.parser.stats(),
+        'outbox': outbox.stats(),
+        'sync': coordinator.stats() if coordinator else None,
+    })
+
 @app.route('/api/signout', methods=['POST'])
 def signout():
     """Sign out user."""
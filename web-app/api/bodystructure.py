@@ -0,0 +1,182 @@
+import re
+import uuid
+
+# Helpers for fetching only the text parts of a message: parsing FETCH
+# responses that carry several items, reading the BODYSTRUCTURE tree into
+# a flat list of parts, and rebuilding a text-only MIME message that
+# mailparser can read like the original.
+
+#the untagged line that starts a FETCH response
+FETCH_START_RE = re.compile(rb'^(\d+) FETCH \(')
+LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"\[]+(?:\[[^\]]*\][^\s()"]*)?))')
+
+def tokenize(chunks):
+    #tokens of a response made of text chunks and the literals between them.
+    #literals and quoted strings become bytes, parentheses become '(' and ')'
+    #and atoms become str
+    for chunk in chunks:
+        if isinstance(chunk, bytearray):
+            yield bytes(chunk)
+            continue
+        text = LITERAL_RE.sub(b'', chunk)
+        position = 0
+        while position < len(text):
+            match = TOKEN_RE.match(text, position)
+            if not match or match.end() == position:
+                break
+            position = match.end()
+            if match.group(1):
+                yield '('
+            elif match.group(2):
+                yield ')'
+            elif match.group(3) is not None:
+                yield re.sub(rb'\\(.)', rb'\1', match.group(3))
+            elif match.group(4):
+                yield match.group(4).decode()
+
+def parse_tokens(tokens):
+    #nest the tokens of a parenthesized list into python lists
+    stack = [[]]
+    for token in tokens:
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) > 1:
+                finished = stack.pop()
+                stack[-1].append(finished)
+        else:
+            stack[-1].append(None if token == 'NIL' else token)
+    while len(stack) > 1:
+        finished = stack.pop()
+        stack[-1].append(finished)
+    return stack[0]
+
+def iter_fetch_items(lines):
+    #yield a dict of item name to value for each message in a FETCH response
+    #(e.g. {'UID': '12', 'BODYSTRUCTURE': [...], 'BODY[1]': b'...'})
+    chunks = []
+    for line in lines:
+        if isinstance(line, bytes) and FETCH_START_RE.match(line):
+            if chunks:
+                yield fetch_items(chunks)
+            chunks = [FETCH_START_RE.sub(b'(', line)]
+        elif chunks:
+            chunks.append(line)
+    if chunks:
+        yield fetch_items(chunks)
+
+def fetch_items(chunks):
+    parsed = parse_tokens(tokenize(chunks))
+    values = parsed[0] if parsed and isinstance(parsed[0], list) else []
+    items = {}
+    for index in range(0, len(values) - 1, 2):
+        name = values[index]
+        if isinstance(name, str):
+            #BODY.PEEK[x] is answered as BODY[x]
+            items[name.upper().replace('BODY.PEEK[', 'BODY[')] = values[index + 1]
+    return items
+
+def as_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value or ''
+
+def param_dict(params):
+    #('CHARSET' 'utf-8' 'NAME' 'x') -> {'charset': 'utf-8', 'name': 'x'}
+    if not isinstance(params, list):
+        return {}
+    return {as_text(params[i]).lower(): as_text(params[i + 1]) for i in range(0, len(params) - 1, 2)}
+
+def flatten(structure, prefix=''):
+    #the leaf parts of a BODYSTRUCTURE with their part numbers, nested
+    #messages are treated as a single attachment
+    if structure and isinstance(structure[0], list):
+        parts = []
+        number = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            number += 1
+            parts.extend(flatten(child, f"{prefix}.{number}" if prefix else str(number)))
+        return parts
+    content_type = f"{as_text(structure[0])}/{as_text(structure[1])}".lower()
+    params = param_dict(structure[2])
+    #extension fields come after the type specific ones
+    if content_type.startswith('text/'):
+        disposition_index = 9
+    elif content_type == 'message/rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    disposition_type = ''
+    if isinstance(disposition, list) and disposition:
+        disposition_type = as_text(disposition[0]).lower()
+        params.update({f"disposition_{key}": value for key, value in param_dict(disposition[1] if len(disposition) > 1 else None).items()})
+    size = structure[6] if len(structure) > 6 else 0
+    return [{
+        'part': prefix or '1',
+        'content_type': content_type,
+        'charset': params.get('charset', ''),
+        'encoding': as_text(structure[5]).lower() or '7bit',
+        'size': int(size) if isinstance(size, str) and size.isdigit() else 0,
+        'filename': params.get('disposition_filename') or params.get('name', ''),
+        'disposition': disposition_type,
+    }]
+
+def is_text_part(part):
+    return (part['content_type'] in ('text/plain', 'text/html')
+            and part['disposition'] != 'attachment' and not part['filename'])
+
+def split_parts(structure):
+    #(text parts to download, attachment metadata to record instead)
+    text_parts = []
+    attachments = []
+    for part in flatten(structure):
+        if is_text_part(part):
+            text_parts.append(part)
+        else:
+            attachments.append({
+                'filename': part['filename'],
+                'content_type': part['content_type'],
+                'size': part['size'],
+            })
+    return text_parts, attachments
+
+def strip_headers(header, names):
+    #the header block without the named fields (and their continuation lines)
+    names = {name.lower() for name in names}
+    kept = []
+    skipping = False
+    for line in header.splitlines(keepends=True):
+        if line[:1] in (b' ', b'\t'):
+            if not skipping:
+                kept.append(line)
+            continue
+        if not line.strip():
+            continue
+        skipping = line.split(b':', 1)[0].strip().lower().decode('latin-1') in names
+        if not skipping:
+            kept.append(line)
+    return b''.join(kept)
+
+def rebuild_message(header, text_parts, bodies):
+    #a multipart message holding only the downloaded text parts, with the
+    #original headers so the parsed Email matches one parsed from the full message
+    boundary = f"text-parts-{uuid.uuid4().hex}"
+    header = strip_headers(header, ('content-type', 'content-transfer-encoding', 'mime-version'))
+    if header and not header.endswith(b'\n'):
+        header += b'\r\n'
+    message = [header, b'MIME-Version: 1.0\r\n',
+               f'Content-Type: multipart/alternative; boundary="{boundary}"\r\n\r\n'.encode()]
+    for part in text_parts:
+        content_type = part['content_type']
+        if part['charset']:
+            content_type += f'; charset="{part["charset"]}"'
+        message.append(f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                       f'Content-Transfer-Encoding: {part["encoding"]}\r\n\r\n'.encode())
+        message.append(bodies.get(part['part']) or b'')
+        message.append(b'\r\n')
+    message.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(message)
@@ -20,5 +20,72 @@ DATABASE_PATH = os.getenv('DATABASE_PATH', os.path.join(PROJECT_ROOT, 'dmail.db'
 # if no previous timestamp is stored.
 LOOKBACK_DAYS = int(os.getenv('LOOKBACK_DAYS', '1'))
 
+# Hydrate the inbox with list-view columns only and load email bodies on
+# first access, keeping up to BODY_CACHE_BYTES of them in an LRU cache.
+HYDRATE_HEADERS_ONLY = os.getenv('HYDRATE_HEADERS_ONLY', 'true').lower() == 'true'
+BODY_CACHE_BYTES = int(os.getenv('BODY_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+# Maximum number of LLM requests in flight at once
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '5'))
+
+# Provider quota for LLM requests, and how failed requests are retried.
+# Concurrency backs off when calls are throttled or slower than the target.
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', '500'))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '30000'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '5'))
+LLM_TARGET_LATENCY = float(os.getenv('LLM_TARGET_LATENCY', '20'))
+
+# Identical LLM requests are answered from a cache in the database.
+# Entries expire after LLM_CACHE_TTL seconds, and the least recently used
+# ones are dropped once the cache grows past LLM_CACHE_MAX_BYTES.
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', str(7 * 24 * 3600)))
+LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+
+# IMAP connections are kept open between polls and checked with a NOOP
+# after IMAP_KEEPALIVE_SECONDS unused. With IMAP_IDLE_ENABLED a second
+# connection per account waits in IDLE and triggers an update on new mail,
+# re-issuing IDLE every IMAP_IDLE_SECONDS. Failed connects back off up to
+# IMAP_RECONNECT_MAX_SECONDS.
+IMAP_IDLE_ENABLED = os.getenv('IMAP_IDLE_ENABLED', 'true').lower() == 'true'
+IMAP_IDLE_SECONDS = int(os.getenv('IMAP_IDLE_SECONDS', '600'))
+IMAP_KEEPALIVE_SECONDS = int(os.getenv('IMAP_KEEPALIVE_SECONDS', '120'))
+IMAP_RECONNECT_MAX_SECONDS = int(os.getenv('IMAP_RECONNECT_MAX_SECONDS', '300'))
+
+# Worker processes used to parse downloaded messages, 0 parses them on
+# the event loop.
+MIME_PARSER_WORKERS = int(os.getenv('MIME_PARSER_WORKERS', str(os.cpu_count() or 1)))
+
+# Replies are queued in the outbox table and sent by a background thread,
+# OUTBOX_BATCH_SIZE at a time over a pooled SMTP connection per account that
+# is closed after SMTP_IDLE_SECONDS unused. Failed sends are retried with
+# backoff of up to OUTBOX_RETRY_MAX_SECONDS, OUTBOX_MAX_ATTEMPTS times.
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '6'))
+OUTBOX_RETRY_MAX_SECONDS = int(os.getenv('OUTBOX_RETRY_MAX_SECONDS', '900'))
+SMTP_IDLE_SECONDS = int(os.getenv('SMTP_IDLE_SECONDS', '120'))
+
+# Every active account in the users table is polled in the background every
+# SYNC_INTERVAL_SECONDS, with at most SYNC_MAX_CONNECTIONS_PER_HOST accounts
+# of one server syncing at once. A sync taking longer than
+# SYNC_ACCOUNT_TIMEOUT_SECONDS is abandoned and retried later.
+SYNC_ENABLED = os.getenv('SYNC_ENABLED', 'true').lower() == 'true'
+SYNC_INTERVAL_SECONDS = int(os.getenv('SYNC_INTERVAL_SECONDS', '300'))
+SYNC_MAX_CONNECTIONS_PER_HOST = int(os.getenv('SYNC_MAX_CONNECTIONS_PER_HOST', '4'))
+SYNC_ACCOUNT_TIMEOUT_SECONDS = int(os.getenv('SYNC_ACCOUNT_TIMEOUT_SECONDS', '120'))
+
+# Whitelist AI rules ask about at most AI_FILTER_MAX_CONCURRENCY emails at
+# once. Their answers are stored per rule and email and reused on resync.
+# Fetched mail is filtered in chunks of WHITELIST_CHUNK_SIZE, each chunk's
+# kept emails appearing in the inbox as soon as it is decided.
+AI_FILTER_MAX_CONCURRENCY = int(os.getenv('AI_FILTER_MAX_CONCURRENCY', '5'))
+WHITELIST_CHUNK_SIZE = int(os.getenv('WHITELIST_CHUNK_SIZE', '50'))
+
+# Unprocessed emails are worked through by a background worker with up to
+# PROCESSING_CONCURRENCY of them with the agent at once. /api/process_emails
+# waits up to PROCESSING_POLL_SECONDS for newly processed emails to return.
+PROCESSING_CONCURRENCY = int(os.getenv('PROCESSING_CONCURRENCY', str(LLM_MAX_CONCURRENCY)))
+PROCESSING_POLL_SECONDS = float(os.getenv('PROCESSING_POLL_SECONDS', '10'))
+
 # OpenAI API Key
 OPENAI_API_KEY = credentials.OPENAI_API_KEY
\ No newline at end of file
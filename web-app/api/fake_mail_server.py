@@ -0,0 +1,456 @@
+import asyncio
+import base64
+import re
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.policy import SMTP, compat32
+from email.utils import format_datetime, parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
+
+# A small in-process IMAP server for benchmarks and tests. It speaks just
+# enough IMAP4rev1 for gmail.retrieve_emails: LOGIN, SELECT, SEARCH and
+# FETCH of whole messages, their headers, BODYSTRUCTURE or single parts,
+# plus their UID forms and the UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ
+# (CONDSTORE) select codes, and IDLE, which reports messages added with
+# add_message. latency is added before every tagged response to stand in
+# for the network round trip. FakeSmtpServer does the same for sending.
+
+def make_message(i, user='test@example.com', body_size=2000, date=None, attachment_size=0):
+    #an rfc822 message shaped like a typical plain text plus html email,
+    #optionally with a binary attachment
+    msg = EmailMessage()
+    msg['Message-ID'] = f'<fake-{i}@example.com>'
+    msg['From'] = f'Sender {i % 50} <sender{i % 50}@example.com>'
+    msg['To'] = user
+    msg['Subject'] = f'Fake message {i}'
+    msg['Date'] = format_datetime(date or datetime.now(timezone.utc) - timedelta(minutes=i))
+    text = (f'Hello, this is fake message {i}. ' * (body_size // 32 + 1))[:body_size]
+    msg.set_content(text)
+    msg.add_alternative(f'<html><body><p>{text}</p></body></html>', subtype='html')
+    if attachment_size:
+        msg.add_attachment(bytes(range(256)) * (attachment_size // 256 + 1), maintype='application',
+                           subtype='octet-stream', filename=f'attachment-{i}.bin')
+    return msg.as_bytes(policy=SMTP)
+
+def generate_mailbox(count, user='test@example.com', body_size=2000, attachment_every=0, attachment_size=100000, days=30):
+    #count messages spread evenly over the last days, newest last like a real
+    #mailbox, with an attachment on every attachment_every-th one
+    now = datetime.now(timezone.utc)
+    step = timedelta(days=days) / max(count, 1)
+    return [
+        make_message(i, user, body_size, date=now - step * (count - i),
+                     attachment_size=attachment_size if attachment_every and i % attachment_every == 0 else 0)
+        for i in range(count)
+    ]
+
+def parse_sequence_set(sequence_set, largest):
+    #the (start, end) ranges of an imap sequence set like 1:3,7,9:*
+    ranges = []
+    for part in sequence_set.split(','):
+        start, _, end = part.partition(':')
+        start = largest if start == '*' else int(start)
+        end = start if not end else largest if end == '*' else int(end)
+        ranges.append((min(start, end), max(start, end)))
+    return ranges
+
+def in_sequence_set(value, ranges):
+    return any(start <= value <= end for start, end in ranges)
+
+class FakeImapServer:
+    COMMAND_RE = re.compile(r'^(\S+) (\S+)(?: (.*))?$')
+
+    def __init__(self, messages=(), user='test@example.com', password='password', latency=0.0, uidvalidity=1):
+        #uids start above 1 and skip values so tests notice sequence numbers used as uids
+        self.messages = []
+        self.uids = []
+        self.uidvalidity = uidvalidity
+        self.uidnext = 101
+        #the next failed_fetches FETCH commands get a NO
+        self.failed_fetches = 0
+        #uids left out of every FETCH response, like messages a server cannot read
+        self.unreadable = set()
+        self.modseq = 1
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.server = None
+        self.port = None
+        self.commands = 0
+        self.connections = 0
+        self.bytes_fetched = 0
+        #writers of open connections, and of those currently in IDLE
+        self.writers = set()
+        self.idling = set()
+        self.handlers = set()
+        #messages parsed for BODYSTRUCTURE and part fetches, by message number
+        self.parsed_messages = {}
+        for message in messages:
+            self.add_message(message)
+
+    def add_message(self, message):
+        self.messages.append(message)
+        self.uids.append(self.uidnext)
+        self.uidnext += 2
+        self.modseq += 1
+        for writer in self.idling:
+            writer.write(f'* {len(self.messages)} EXISTS\r\n'.encode())
+
+    def drop_connections(self):
+        #simulate the network dropping every open connection
+        for writer in list(self.writers):
+            writer.transport.abort()
+
+    def reset_uids(self, uidvalidity):
+        #what a server does when a mailbox is recreated, every uid changes
+        self.uidvalidity = uidvalidity
+        self.uids = [1000 + 2 * i for i in range(len(self.messages))]
+        self.uidnext = 1000 + 2 * len(self.messages)
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        #close open connections first so their handlers finish
+        for writer in list(self.writers):
+            writer.close()
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=1)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        self.handlers.add(asyncio.current_task())
+        writer.write(b'* OK IMAP4rev1 fake server ready\r\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                match = self.COMMAND_RE.match(line.decode().rstrip('\r\n'))
+                if not match:
+                    writer.write(b'* BAD unparseable command\r\n')
+                    continue
+                tag, command, args = match.group(1), match.group(2).upper(), match.group(3) or ''
+                self.commands += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if command == 'IDLE':
+                    await self.idle(tag, reader, writer)
+                    continue
+                handler = getattr(self, f'do_{command.lower()}', None)
+                if handler is None:
+                    writer.write(f'{tag} BAD unknown command {command}\r\n'.encode())
+                else:
+                    done = handler(tag, args, writer)
+                    if done:
+                        await writer.drain()
+                        break
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.idling.discard(writer)
+            self.writers.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
+
+    async def idle(self, tag, reader, writer):
+        writer.write(b'+ idling\r\n')
+        self.idling.add(writer)
+        try:
+            line = await reader.readline()
+        finally:
+            self.idling.discard(writer)
+        if line.strip().upper() == b'DONE':
+            writer.write(f'{tag} OK IDLE terminated\r\n'.encode())
+        else:
+            writer.write(f'{tag} BAD expected DONE\r\n'.encode())
+        await writer.drain()
+
+    def do_capability(self, tag, args, writer):
+        writer.write(b'* CAPABILITY IMAP4rev1 CONDSTORE IDLE\r\n')
+        writer.write(f'{tag} OK CAPABILITY completed\r\n'.encode())
+
+    def do_noop(self, tag, args, writer):
+        writer.write(f'{tag} OK NOOP completed\r\n'.encode())
+
+    def do_login(self, tag, args, writer):
+        user, _, password = args.partition(' ')
+        if user == self.user and password.strip('"') == self.password:
+            writer.write(f'{tag} OK LOGIN completed\r\n'.encode())
+        else:
+            writer.write(f'{tag} NO LOGIN failed\r\n'.encode())
+
+    def do_select(self, tag, args, writer):
+        writer.write(f'* {len(self.messages)} EXISTS\r\n'.encode())
+        writer.write(b'* 0 RECENT\r\n')
+        writer.write(f'* OK [UIDVALIDITY {self.uidvalidity}] UIDs valid\r\n'.encode())
+        writer.write(f'* OK [UIDNEXT {self.uidnext}] Predicted next UID\r\n'.encode())
+        if 'CONDSTORE' in args.upper():
+            writer.write(f'* OK [HIGHESTMODSEQ {self.modseq}] Highest\r\n'.encode())
+        writer.write(f'{tag} OK [READ-WRITE] SELECT completed\r\n'.encode())
+
+    def do_uid(self, tag, args, writer):
+        command, _, args = args.partition(' ')
+        if command.upper() == 'SEARCH':
+            self.do_search(tag, args, writer, by_uid=True)
+        elif command.upper() == 'FETCH':
+            self.do_fetch(tag, args, writer, by_uid=True)
+        else:
+            writer.write(f'{tag} BAD unknown UID command {command}\r\n'.encode())
+
+    def do_search(self, tag, args, writer, by_uid=False):
+        #supports SINCE "dd-Mon-yyyy" and UID sets, anything else matches every message
+        numbers = list(range(1, len(self.messages) + 1))
+        since = re.search(r'SINCE "?(\d{1,2}-\w{3}-\d{4})"?', args, re.IGNORECASE)
+        if since:
+            since_date = datetime.strptime(since.group(1), '%d-%b-%Y').date()
+            numbers = [n for n in numbers if self.message_date(n) >= since_date]
+        uid_set = re.search(r'\bUID (\S+)', args, re.IGNORECASE)
+        if uid_set:
+            ranges = parse_sequence_set(uid_set.group(1), self.uids[-1] if self.uids else 0)
+            numbers = [n for n in numbers if in_sequence_set(self.uids[n - 1], ranges)]
+        results = [self.uids[n - 1] if by_uid else n for n in numbers]
+        writer.write(('* SEARCH ' + ' '.join(str(r) for r in results)).rstrip().encode() + b'\r\n')
+        writer.write(f'{tag} OK SEARCH completed\r\n'.encode())
+
+    def do_fetch(self, tag, args, writer, by_uid=False):
+        #supports UID, BODYSTRUCTURE, BODY[], BODY[HEADER], BODY[HEADER.FIELDS (...)]
+        #and numbered parts like BODY[1.2], with or without .PEEK
+        if self.failed_fetches:
+            self.failed_fetches -= 1
+            writer.write(f'{tag} NO FETCH temporarily unavailable\r\n'.encode())
+            return
+        sequence_set, _, items = args.partition(' ')
+        names = re.findall(r'[^\s()\[]+(?:\[[^\]]*\])?', items)
+        if by_uid:
+            ranges = parse_sequence_set(sequence_set, self.uids[-1] if self.uids else 0)
+            numbers = [n for n, uid in enumerate(self.uids, 1) if in_sequence_set(uid, ranges)]
+            if 'UID' not in (name.upper() for name in names):
+                names.insert(0, 'UID')
+        else:
+            ranges = parse_sequence_set(sequence_set, len(self.messages))
+            numbers = [n for n in range(1, len(self.messages) + 1) if in_sequence_set(n, ranges)]
+        for number in numbers:
+            if self.uids[number - 1] in self.unreadable:
+                continue
+            message = self.messages[number - 1]
+            response = [f'* {number} FETCH ('.encode()]
+            for i, name in enumerate(names):
+                if i:
+                    response.append(b' ')
+                if name.upper() == 'UID':
+                    response.append(f'UID {self.uids[number - 1]}'.encode())
+                elif name.upper() == 'BODYSTRUCTURE':
+                    response.append(b'BODYSTRUCTURE ' + self.body_structure(self.parsed(number)).encode())
+                else:
+                    section = re.search(r'\[([^\]]*)\]', name).group(1)
+                    data = self.section(number, section)
+                    response.append(f'BODY[{section}] {{{len(data)}}}\r\n'.encode())
+                    response.append(data)
+            response.append(b')\r\n')
+            response = b''.join(response)
+            self.bytes_fetched += len(response)
+            writer.write(response)
+        writer.write(f'{tag} OK FETCH completed\r\n'.encode())
+
+    def section(self, number, section):
+        message = self.messages[number - 1]
+        fields = re.match(r'HEADER\.FIELDS \(([^)]*)\)', section, re.IGNORECASE)
+        if fields:
+            return self.header_fields(message, fields.group(1).split())
+        if section.upper() == 'HEADER':
+            return self.header_block(message)
+        if not section:
+            return message
+        part = self.parsed(number)
+        for index in section.split('.'):
+            if part.is_multipart():
+                part = part.get_payload()[int(index) - 1]
+        return self.part_bytes(part)
+
+    def parsed(self, number):
+        if number not in self.parsed_messages:
+            self.parsed_messages[number] = message_from_bytes(self.messages[number - 1], policy=compat32)
+        return self.parsed_messages[number]
+
+    @staticmethod
+    def part_bytes(part):
+        #the part's body as sent, still transfer encoded
+        return part.get_payload().encode('ascii', 'surrogateescape')
+
+    @classmethod
+    def body_structure(cls, part):
+        #the BODYSTRUCTURE of multipart and single part messages, nested
+        #message/rfc822 parts are not described in full
+        if part.is_multipart() and part.get_content_maintype() == 'multipart':
+            children = ''.join(cls.body_structure(child) for child in part.get_payload())
+            return f'({children} "{part.get_content_subtype().upper()}" ("BOUNDARY" "{part.get_boundary()}") NIL NIL NIL)'
+        params = (part.get_params() or [])[1:]
+        param_text = '(' + ' '.join(f'"{key.upper()}" "{value}"' for key, value in params) + ')' if params else 'NIL'
+        body = cls.part_bytes(part) if not part.is_multipart() else b''
+        encoding = (part.get('Content-Transfer-Encoding') or '7bit').upper()
+        fields = f'"{part.get_content_maintype().upper()}" "{part.get_content_subtype().upper()}" {param_text} NIL NIL "{encoding}" {len(body)}'
+        if part.get_content_maintype() == 'text':
+            lines = body.count(b'\n')
+            fields += f' {lines}'
+        disposition = 'NIL'
+        if part.get_content_disposition():
+            filename = part.get_filename()
+            disposition_params = f'("FILENAME" "{filename}")' if filename else 'NIL'
+            disposition = f'("{part.get_content_disposition().upper()}" {disposition_params})'
+        return f'({fields} NIL {disposition} NIL NIL)'
+
+    @staticmethod
+    def header_block(message):
+        #the header including the blank line that ends it
+        end = message.find(b'\r\n\r\n')
+        if end != -1:
+            return message[:end + 4]
+        end = message.find(b'\n\n')
+        return message[:end + 2] if end != -1 else message
+
+    @classmethod
+    def header_fields(cls, message, names):
+        wanted = {name.lower().encode() for name in names}
+        lines = []
+        keep = False
+        for line in cls.header_block(message).splitlines(keepends=True):
+            if line[:1] in (b' ', b'\t'):
+                if keep:
+                    lines.append(line.rstrip(b'\r\n') + b'\r\n')
+                continue
+            keep = line.split(b':', 1)[0].strip().lower() in wanted
+            if keep:
+                lines.append(line.rstrip(b'\r\n') + b'\r\n')
+        return b''.join(lines) + b'\r\n'
+
+    def do_logout(self, tag, args, writer):
+        writer.write(b'* BYE logging out\r\n')
+        writer.write(f'{tag} OK LOGOUT completed\r\n'.encode())
+        return True
+
+    def message_date(self, number):
+        header = re.search(rb'^Date: (.*)$', self.messages[number - 1], re.MULTILINE | re.IGNORECASE)
+        if not header:
+            return datetime.now(timezone.utc).date()
+        return parsedate_to_datetime(header.group(1).decode().strip()).date()
+
+class FakeSmtpServer:
+    #just enough SMTP for smtplib: EHLO, AUTH PLAIN, MAIL, RCPT, DATA, RSET,
+    #NOOP and QUIT. recipients in reject are refused with a 550, and the next
+    #temporary_failures MAIL commands get a 451
+    def __init__(self, user='test@example.com', password='password', latency=0.0, reject=()):
+        self.user = user
+        self.password = password
+        self.latency = latency
+        self.reject = set(reject)
+        self.temporary_failures = 0
+        #(sender, recipients, message) for each accepted message
+        self.messages = []
+        self.server = None
+        self.port = None
+        self.commands = 0
+        self.connections = 0
+        self.logins = 0
+        self.writers = set()
+        self.handlers = set()
+
+    def drop_connections(self):
+        for writer in list(self.writers):
+            writer.transport.abort()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self):
+        for writer in list(self.writers):
+            writer.close()
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=1)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        self.writers.add(writer)
+        self.handlers.add(asyncio.current_task())
+        writer.write(b'220 fake.example.com ESMTP ready\r\n')
+        sender, recipients = None, []
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, args = line.decode().rstrip('\r\n').partition(' ')
+                command = command.upper()
+                self.commands += 1
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                if command in ('EHLO', 'HELO'):
+                    writer.write(b'250-fake.example.com\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n')
+                elif command == 'AUTH':
+                    mechanism, _, credentials = args.partition(' ')
+                    try:
+                        _, user, password = base64.b64decode(credentials).decode().split('\0')
+                    except ValueError:
+                        user = password = None
+                    if mechanism.upper() == 'PLAIN' and (user, password) == (self.user, self.password):
+                        self.logins += 1
+                        writer.write(b'235 Authentication succeeded\r\n')
+                    else:
+                        writer.write(b'535 Authentication failed\r\n')
+                elif command == 'MAIL':
+                    if self.temporary_failures:
+                        self.temporary_failures -= 1
+                        writer.write(b'451 Try again later\r\n')
+                    else:
+                        sender, recipients = args.partition(':')[2].strip('<> '), []
+                        writer.write(b'250 OK\r\n')
+                elif command == 'RCPT':
+                    recipient = args.partition(':')[2].strip('<> ')
+                    if recipient in self.reject:
+                        writer.write(b'550 No such user\r\n')
+                    else:
+                        recipients.append(recipient)
+                        writer.write(b'250 OK\r\n')
+                elif command == 'DATA':
+                    writer.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+                    await writer.drain()
+                    lines = []
+                    while True:
+                        data_line = await reader.readline()
+                        if not data_line or data_line == b'.\r\n':
+                            break
+                        lines.append(data_line[1:] if data_line.startswith(b'..') else data_line)
+                    self.messages.append((sender, recipients, b''.join(lines)))
+                    sender, recipients = None, []
+                    writer.write(b'250 OK queued\r\n')
+                elif command == 'RSET':
+                    sender, recipients = None, []
+                    writer.write(b'250 OK\r\n')
+                elif command == 'NOOP':
+                    writer.write(b'250 OK\r\n')
+                elif command == 'QUIT':
+                    writer.write(b'221 Bye\r\n')
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b'502 Command not implemented\r\n')
+                await writer.drain()
+        except (ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            self.handlers.discard(asyncio.current_task())
+            writer.close()
@@ -1,9 +1,17 @@
 import smtplib
 import aioimaplib
-import mailparser
+import mime_parser
+import bodystructure
+from bodystructure import iter_fetch_items, FETCH_START_RE
+from mime_parser import parse_fields, build_email
 import asyncio
+import re
 from inbox import Email
 from email.message import EmailMessage
+from email.parser import BytesParser
+from email.policy import compat32
+from email.header import decode_header, make_header
+from email.utils import getaddresses, parsedate_to_datetime
 
 
 PORT = 993
@@ -11,58 +19,225 @@ HOST = 'imap.gmail.com'
 SMTP_HOST = 'smtp.gmail.com'
 SMTP_PORT = 587
 
-async def retrieve_emails(query, user, password):
-    imap_client = aioimaplib.IMAP4_SSL(host=HOST)
-    await imap_client.wait_hello_from_server()
+#messages requested per FETCH command
+FETCH_BATCH_SIZE = 200
+#the UID item within a FETCH response
+FETCH_UID_RE = re.compile(rb'UID (\d+)')
 
-    await imap_client.login(user, password)
-    await imap_client.select('INBOX')
+def message_sets(email_ids, batch_size=FETCH_BATCH_SIZE):
+    #split message numbers or uids into imap message sets, writing consecutive runs as ranges
+    numbers = sorted(int(email_id) for email_id in email_ids)
+    for start in range(0, len(numbers), batch_size):
+        batch = numbers[start:start + batch_size]
+        ranges = []
+        first = last = batch[0]
+        for number in batch[1:]:
+            if number == last + 1:
+                last = number
+                continue
+            ranges.append(f"{first}:{last}" if first != last else str(first))
+            first = last = number
+        ranges.append(f"{first}:{last}" if first != last else str(first))
+        yield ",".join(ranges)
 
-    #imap_client = await initialize_imap_client(user, password)
-    print("imap client retrieved")
+def iter_fetched_messages(lines):
+    #yield (uid, literal) for each message in a multi-message UID FETCH response.
+    #servers may send the UID item before or after the literal
+    uid = None
+    literal = None
+    for line in lines:
+        if isinstance(line, bytearray):
+            literal = bytes(line)
+            continue
+        if FETCH_START_RE.match(line):
+            if uid is not None and literal is not None:
+                yield uid, literal
+            uid = literal = None
+        match = FETCH_UID_RE.search(line)
+        if match:
+            uid = int(match.group(1))
+    if uid is not None and literal is not None:
+        yield uid, literal
+
+#headers fetched before deciding whether to download a message body
+HEADER_FIELDS = 'MESSAGE-ID FROM TO SUBJECT DATE'
 
-    search_result = await imap_client.search(query)
-    print("search result retrieved")
+def email_from_bytes(email_data, fallback_id):
+    return build_email(parse_fields(email_data), fallback_id)
+
+async def fetch_emails(imap_client, email_ids, batch_size=FETCH_BATCH_SIZE, parser=None, text_only=True, failed=None):
+    #one FETCH per message set instead of one per message. parsing happens in
+    #the parser's worker processes, so the next set downloads meanwhile.
+    #text_only skips attachments, see fetch_text_parts. uids of messages the
+    #server left out of its response or that did not parse are added to failed
+    parser = parser or mime_parser.parser
+    uids = sorted(int(email_id) for email_id in email_ids)
+    #a failed set is raised rather than skipped, so the caller does not
+    #record its uids as seen and the next poll fetches them again
+    parse_tasks = []
+    try:
+        for start in range(0, len(uids), batch_size):
+            batch = uids[start:start + batch_size]
+            if text_only:
+                messages, missing = await fetch_text_parts(imap_client, batch)
+            else:
+                messages, missing = await fetch_whole(imap_client, batch)
+            if failed is not None:
+                failed.extend(missing)
+            parse_tasks.append(asyncio.ensure_future(parser.parse(messages, failed)))
+    except Exception:
+        for task in parse_tasks:
+            task.cancel()
+        raise
     emails = []
-    
-    if search_result.result == 'OK':
-        email_ids = search_result.lines[0].split()
-        if email_ids:
-            
-            # Fetch and parse each email
-            for email_id in email_ids:
-                try:
-                    # Convert bytes to string if needed
-                    if isinstance(email_id, bytes):
-                        email_id = email_id.decode('utf-8')
-                    
-                    fetch_result = await imap_client.fetch(email_id, 'BODY.PEEK[]')
-                    if fetch_result.result == 'OK':
-                        email_data = fetch_result.lines[1]
-                        
-                        # Parse the email
-                        parsed_email = mailparser.parse_from_bytes(email_data)
-                        # Create Email object
-                        email_obj = Email(
-                            id=parsed_email.id or email_id,
-                            subject=parsed_email.subject or '',
-                            body=parsed_email.text_plain[0] if parsed_email.text_plain else '',
-                            full_body=parsed_email.body,
-                            html=parsed_email.text_html,
-                            from_=parsed_email.from_,
-                            to=parsed_email.to,
-                            date=parsed_email.date
-                        )
-                        emails.append(email_obj)
-                        
-                except Exception as e:
-                    print(f'Error processing email {email_id}: {e}')
-                    continue
-        else:
-            print("No emails found matching the query")
+    for parsed in await asyncio.gather(*parse_tasks):
+        emails.extend(parsed)
+    return emails
+
+async def uid_fetch(imap_client, uids, items):
+    message_set = next(message_sets(uids, len(uids)))
+    fetch_result = await imap_client.uid('fetch', message_set, items)
+    if fetch_result.result != 'OK':
+        raise ValueError(f"Fetch failed for {message_set}: {fetch_result.result}")
+    return fetch_result.lines
+
+async def fetch_whole(imap_client, uids):
+    #[(uid, raw message)] for the whole of each message, and the uids missing
+    #from the response
+    lines = await uid_fetch(imap_client, uids, 'BODY.PEEK[]')
+    messages = [(str(uid), email_data) for uid, email_data in iter_fetched_messages(lines)]
+    fetched = {int(uid) for uid, _ in messages}
+    return messages, [uid for uid in uids if uid not in fetched]
+
+async def fetch_text_parts(imap_client, uids):
+    #read each message's BODYSTRUCTURE first. messages that are only text are
+    #downloaded whole, the rest as their header and text/plain and text/html
+    #parts, with the attachments recorded from the structure instead.
+    #returns the messages and the uids that could not be fetched
+    lines = await uid_fetch(imap_client, uids, '(UID BODYSTRUCTURE)')
+    structures = {}
+    for items in iter_fetch_items(lines):
+        if str(items.get('UID', '')).isdigit() and isinstance(items.get('BODYSTRUCTURE'), list):
+            structures[int(items['UID'])] = items['BODYSTRUCTURE']
+    whole = []
+    #messages with the same text part numbers are fetched together
+    by_sections = {}
+    for uid in uids:
+        try:
+            text_parts, attachments = bodystructure.split_parts(structures[uid])
+        except Exception:
+            #no usable structure, fall back to the whole message
+            whole.append(uid)
+            continue
+        if not attachments:
+            whole.append(uid)
+            continue
+        sections = tuple(part['part'] for part in text_parts)
+        by_sections.setdefault(sections, []).append((uid, text_parts, attachments))
+    messages, failed = await fetch_whole(imap_client, whole) if whole else ([], [])
+    for sections, group in by_sections.items():
+        items = ' '.join(['UID', 'BODY.PEEK[HEADER]'] + [f'BODY.PEEK[{section}]' for section in sections])
+        lines = await uid_fetch(imap_client, [uid for uid, _, _ in group], f'({items})')
+        fetched = {int(items['UID']): items for items in iter_fetch_items(lines) if str(items.get('UID', '')).isdigit()}
+        for uid, text_parts, attachments in group:
+            items = fetched.get(uid)
+            if items is None or not isinstance(items.get('BODY[HEADER]'), bytes):
+                failed.append(uid)
+                continue
+            bodies = {section: items.get(f'BODY[{section}]') for section in sections}
+            email_data = bodystructure.rebuild_message(items['BODY[HEADER]'], text_parts, bodies)
+            messages.append((str(uid), email_data, {'attachments': attachments}))
+    return messages, failed
+
+def email_from_headers(header_data, fallback_id):
+    #a header-only Email, parsed with the stdlib since mailparser is built for whole messages
+    headers = BytesParser(policy=compat32).parsebytes(header_data, headersonly=True)
+    def decoded(name):
+        value = headers.get(name)
+        return str(make_header(decode_header(value))) if value else ''
+    try:
+        date = parsedate_to_datetime(headers.get('Date'))
+    except (TypeError, ValueError):
+        date = None
+    return Email(
+        id=headers.get('Message-ID') or fallback_id,
+        subject=decoded('Subject'),
+        body='',
+        from_=getaddresses([decoded('From')]),
+        to=getaddresses([decoded('To')]),
+        date=date
+    )
+
+async def filter_by_headers(imap_client, email_ids, header_filter, batch_size=FETCH_BATCH_SIZE):
+    #fetch only the headers the cheap whitelist rules need and return the
+    #uids that header_filter keeps
+    #a failed fetch is raised, like in fetch_emails, and uids missing from the
+    #response are kept so fetch_emails reports them
+    keep = []
+    fetched = set()
+    for message_set in message_sets(email_ids, batch_size):
+        fetch_result = await imap_client.uid('fetch', message_set, f'BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})]')
+        if fetch_result.result != 'OK':
+            raise ValueError(f"Header fetch failed for {message_set}: {fetch_result.result}")
+        for uid, header_data in iter_fetched_messages(fetch_result.lines):
+            fetched.add(uid)
+            try:
+                if await header_filter(email_from_headers(header_data, str(uid))):
+                    keep.append(uid)
+            except Exception as e:
+                #keep anything we could not judge, the full filter runs again later
+                print(f'Error filtering headers of email {uid}: {e}')
+                keep.append(uid)
+    keep.extend(uid for uid in map(int, email_ids) if uid not in fetched)
+    return keep
+
+def select_status(select_result):
+    #UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ from the response codes of a SELECT
+    status = {}
+    for line in select_result.lines:
+        if not isinstance(line, bytes):
+            continue
+        for name in (b'UIDVALIDITY', b'UIDNEXT', b'HIGHESTMODSEQ'):
+            match = re.search(rb'\[' + name + rb' (\d+)\]', line)
+            if match:
+                status[name.decode().lower()] = int(match.group(1))
+    return status
+
+async def search_uids(imap_client, query, sync_state, status):
+    #uids to download. with a sync state for the same UIDVALIDITY only uids
+    #above the last one seen are searched for, otherwise query is used
+    if status.get('uidvalidity') is None or sync_state.get('uidvalidity') != status['uidvalidity']:
+        if sync_state.get('uidvalidity') is not None:
+            print("UIDVALIDITY changed, falling back to a full search")
+        search_result = await imap_client.uid_search(query)
+        last_uid = 0
+    else:
+        last_uid = sync_state.get('last_uid') or 0
+        if 'uidnext' in status and status['uidnext'] <= last_uid + 1:
+            return []
+        if status.get('highestmodseq') and status['highestmodseq'] == sync_state.get('highest_modseq'):
+            #nothing in the mailbox changed since the last poll
+            return []
+        search_result = await imap_client.uid_search(f'UID {last_uid + 1}:*')
+    if search_result.result != 'OK':
+        raise ValueError(f"Search failed: {search_result.result}")
+    #n:* always matches the highest uid, even when it is below n
+    return [uid for uid in (int(uid) for uid in search_result.lines[0].split()) if uid > last_uid]
+
+async def connect_imap(user, password, host=HOST, port=PORT, use_ssl=True):
+    #open a connection and log in
+    if use_ssl:
+        imap_client = aioimaplib.IMAP4_SSL(host=host, port=port)
     else:
-        print(f"Search failed: {search_result.result}")
-    
+        imap_client = aioimaplib.IMAP4(host=host, port=port)
+    await imap_client.wait_hello_from_server()
+
+    login_result = await imap_client.login(user, password)
+    if login_result.result != 'OK':
+        raise ValueError(f"Login failed for {user}: {login_result.result}")
+    return imap_client
+
+async def logout_imap(imap_client):
     print("logging out")
     try:
         await imap_client.logout()
@@ -70,10 +245,73 @@ async def retrieve_emails(query, user, password):
         print(f"Note: Connection cleanup warning (harmless): {type(e).__name__}")
     except Exception as e:
         print(f"Warning: Unexpected error during logout: {e}")
+
+async def retrieve_from_client(imap_client, query, header_filter=None, sync_state=None):
+    #retrieve new emails over an open connection, see retrieve_emails.
+    #errors are raised so a long-lived connection can be replaced
+    if sync_state is None:
+        sync_state = {}
+    if 'CONDSTORE' in imap_client.protocol.capabilities:
+        select_result = await imap_client.select('INBOX (CONDSTORE)')
+    else:
+        select_result = await imap_client.select('INBOX')
+    if select_result.result != 'OK':
+        raise ValueError(f"Select failed: {select_result.result}")
+    status = select_status(select_result)
+
+    emails = []
+    failed = []
+    email_ids = await search_uids(imap_client, query, sync_state, status)
+    print(f"search result retrieved, {len(email_ids)} new uids")
+    if email_ids and header_filter is not None:
+        matched_ids = await filter_by_headers(imap_client, email_ids, header_filter)
+        print(f"{len(matched_ids)} of {len(email_ids)} emails passed the header filter")
+    else:
+        matched_ids = email_ids
+    if matched_ids:
+        emails = await fetch_emails(imap_client, matched_ids, failed=failed)
+    else:
+        print("No new emails found")
+    #uids the header filter rejected count as seen too
+    last_uid = max(email_ids, default=0)
+    highest_modseq = status.get('highestmodseq')
+    same_mailbox = sync_state.get('uidvalidity') == status.get('uidvalidity')
+    if failed:
+        #hold the position below the first message that could not be fetched
+        #so the next poll retries it, refetching the ones above it too
+        print(f"{len(failed)} emails could not be fetched, retrying from uid {min(failed)}")
+        last_uid = min(failed) - 1
+        highest_modseq = sync_state.get('highest_modseq') if same_mailbox else None
+    if same_mailbox:
+        last_uid = max(last_uid, sync_state.get('last_uid') or 0)
+    if 'uidnext' in status and not failed:
+        last_uid = max(last_uid, status['uidnext'] - 1)
+    sync_state.update({
+        'uidvalidity': status.get('uidvalidity'),
+        'last_uid': last_uid,
+        'highest_modseq': highest_modseq,
+    })
     return emails
 
-def send_email(email, draft_text, user, password):
-    print(f"Sending email: {email.id} {draft_text}")
+async def retrieve_emails(query, user, password, host=HOST, port=PORT, use_ssl=True, header_filter=None, sync_state=None):
+    #one-off retrieval on a new connection.
+    #header_filter is an async function given a header-only Email, bodies
+    #are only downloaded for messages it returns True for.
+    #sync_state is a dict of uidvalidity, last_uid and highest_modseq from the
+    #previous poll, it is updated in place so the caller can store it
+    imap_client = await connect_imap(user, password, host, port, use_ssl)
+    print("imap client retrieved")
+
+    emails = []
+    try:
+        emails = await retrieve_from_client(imap_client, query, header_filter, sync_state)
+    except Exception as e:
+        print(f"Error retrieving emails: {e}")
+    await logout_imap(imap_client)
+    return emails
+
+def build_reply(email, draft_text, user):
+    #the reply to email as an EmailMessage, and its recipient
     from_data = email.from_
     reply_to_email = from_data[0][1]
     reply_subject = email.subject
@@ -86,16 +324,23 @@ def send_email(email, draft_text, user, password):
     msg['In-Reply-To'] = email.id
     msg['References'] = email.id
     msg.set_content(draft_text)
-    
-    try:
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT)
+    return msg, reply_to_email
+
+def connect_smtp(user, password, host=SMTP_HOST, port=SMTP_PORT, use_tls=True):
+    server = smtplib.SMTP(host, port, timeout=30)
+    if use_tls:
         server.starttls()
-        server.login(user, password)
+    server.login(user, password)
+    return server
+
+def send_email(email, draft_text, user, password):
+    #send on a new connection, the outbox (smtp_outbox.py) is used by the api instead
+    print(f"Sending email: {email.id} {draft_text}")
+    msg, reply_to_email = build_reply(email, draft_text, user)
+    try:
+        server = connect_smtp(user, password)
         server.send_message(msg)
         server.quit()
         print(f"Email sent successfully from {user} to {reply_to_email}")
     except Exception as e:
         print(f"Error sending email: {e}")
-
-    email.state = ['sent']
-    email.drafted_response = draft_text
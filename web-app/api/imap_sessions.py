@@ -0,0 +1,214 @@
+import asyncio
+import threading
+import time
+import aioimaplib
+import gmail
+import config_reader
+from rate_limiter import backoff_delay
+
+# IMAP connections live on one background event loop owned by the
+# SessionManager. Flask handlers each run their own asyncio.run, so a
+# connection opened there would die with the request; here it is kept
+# logged in between polls, and a second connection per account sits in
+# IDLE to report new mail as soon as it arrives.
+
+#pushed to an idling connection's queue when its socket closes
+CONNECTION_LOST = 'connection lost'
+
+class ImapSession:
+    #one logged in connection for an account, replaced when it fails
+    def __init__(self, user, password, host, port, use_ssl):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.client = None
+        self.last_used = 0
+        self.connects = 0
+        self.lock = asyncio.Lock()
+
+    async def connect(self, max_attempts=None):
+        #log in, backing off between failed attempts
+        attempt = 0
+        while True:
+            try:
+                self.client = await gmail.connect_imap(self.user, self.password, self.host, self.port, self.use_ssl)
+                self.connects += 1
+                self.last_used = time.monotonic()
+                return self.client
+            except Exception as e:
+                attempt += 1
+                if max_attempts is not None and attempt >= max_attempts:
+                    raise
+                delay = backoff_delay(attempt, cap=config_reader.IMAP_RECONNECT_MAX_SECONDS)
+                print(f"IMAP connect for {self.user} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    @property
+    def closed(self):
+        transport = self.client.protocol.transport if self.client is not None else None
+        return transport is None or transport.is_closing()
+
+    async def connection(self):
+        #the open connection, checked with a NOOP if it has been unused for a while
+        if self.client is not None and self.closed:
+            await self.close()
+        if self.client is not None and time.monotonic() - self.last_used > config_reader.IMAP_KEEPALIVE_SECONDS:
+            try:
+                await self.client.noop()
+            except Exception as e:
+                print(f"IMAP connection for {self.user} went stale: {e}")
+                await self.close()
+        if self.client is None:
+            await self.connect(max_attempts=3)
+        self.last_used = time.monotonic()
+        return self.client
+
+    async def retrieve(self, query, header_filter=None, sync_state=None):
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    client = await self.connection()
+                    try:
+                        return await gmail.retrieve_from_client(client, query, header_filter, sync_state)
+                    except Exception as e:
+                        #the connection may have dropped, retry once on a new one
+                        print(f"Error retrieving emails for {self.user}: {type(e).__name__} {e}")
+                        await self.close()
+                        if attempt:
+                            raise
+                except asyncio.CancelledError:
+                    #a timeout cancelled a command part way, its reply would
+                    #be read by the next one, so the connection is not reused
+                    self.drop()
+                    raise
+
+    async def close(self):
+        #log out if the connection is still up, otherwise just drop it
+        if self.client is None:
+            return
+        client, closed, self.client = self.client, self.closed, None
+        if not closed:
+            try:
+                await asyncio.wait_for(client.logout(), 5)
+            except Exception:
+                pass
+        if client.protocol.transport is not None:
+            client.protocol.transport.close()
+
+    def drop(self):
+        #close the socket without logging out
+        client, self.client = self.client, None
+        if client is not None and client.protocol.transport is not None:
+            client.protocol.transport.close()
+
+class SessionManager:
+    def __init__(self, host=gmail.HOST, port=gmail.PORT, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        #called with the account from a worker thread when IDLE reports new mail
+        self.on_new_mail = None
+        self.sessions = {}
+        self.watchers = {}
+        self.idle_events = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='imap-sessions', daemon=True)
+        self.thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def retrieve_emails(self, query, user, password, header_filter=None, sync_state=None, raise_errors=False):
+        #drop-in for gmail.retrieve_emails that reuses the account's connection,
+        #it can be awaited from any event loop. errors are printed and give no
+        #emails unless raise_errors is set
+        return await asyncio.wrap_future(self.submit(self._retrieve(query, user, password, header_filter, sync_state, raise_errors)))
+
+    async def _retrieve(self, query, user, password, header_filter, sync_state, raise_errors):
+        session = self.sessions.get(user)
+        if session is None or session.password != password:
+            if session is not None:
+                await session.close()
+            session = ImapSession(user, password, self.host, self.port, self.use_ssl)
+            self.sessions[user] = session
+        try:
+            return await session.retrieve(query, header_filter, sync_state)
+        except Exception as e:
+            if raise_errors:
+                raise
+            print(f"Error retrieving emails: {e}")
+            return []
+
+    def watch(self, user, password):
+        #start pushing new mail events for the account, replacing an older watcher
+        self.submit(self._start_watch(user, password))
+
+    async def _start_watch(self, user, password):
+        watcher = self.watchers.get(user)
+        if watcher is not None:
+            if watcher[0] == password and not watcher[1].done():
+                return
+            watcher[1].cancel()
+        self.watchers[user] = (password, asyncio.ensure_future(self._watch(user, password)))
+
+    async def _watch(self, user, password):
+        session = ImapSession(user, password, self.host, self.port, self.use_ssl)
+        try:
+            while True:
+                try:
+                    client = await session.connect()
+                    #wake wait_server_push if the socket closes rather than waiting out the idle period
+                    client.protocol.conn_lost_cb = lambda exc, queue=client.protocol.idle_queue: queue.put_nowait(CONNECTION_LOST)
+                    if 'IDLE' not in client.protocol.capabilities:
+                        print(f"IMAP server for {user} does not support IDLE, not watching")
+                        return
+                    await client.select('INBOX')
+                    print(f"Watching {user} for new mail")
+                    while True:
+                        await self._idle_once(client, user)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"IDLE for {user} stopped ({type(e).__name__} {e}), reconnecting")
+                    await session.close()
+        finally:
+            await session.close()
+
+    async def _idle_once(self, client, user):
+        #idle until the server pushes something or the idle period ends, re-idling
+        #regularly keeps the connection from being dropped as inactive
+        idle = await client.idle_start(timeout=config_reader.IMAP_IDLE_SECONDS)
+        push = await client.wait_server_push(timeout=config_reader.IMAP_IDLE_SECONDS + 30)
+        if push == CONNECTION_LOST:
+            idle.cancel()
+            raise ConnectionError("connection closed by server")
+        client.idle_done()
+        await asyncio.wait_for(idle, 30)
+        if push == aioimaplib.STOP_WAIT_SERVER_PUSH:
+            return
+        if any(isinstance(line, bytes) and line.endswith(b'EXISTS') for line in push):
+            self.idle_events += 1
+            print(f"New mail for {user}")
+            if self.on_new_mail is not None:
+                self.loop.run_in_executor(None, self.on_new_mail, user)
+
+    def stop(self, user):
+        self.submit(self._stop(user))
+
+    async def _stop(self, user):
+        watcher = self.watchers.pop(user, None)
+        if watcher is not None:
+            watcher[1].cancel()
+        session = self.sessions.pop(user, None)
+        if session is not None:
+            await session.close()
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "connects": sum(session.connects for session in self.sessions.values()),
+            "watching": [user for user, (_, task) in self.watchers.items() if not task.done()],
+            "idle_events": self.idle_events,
+        }
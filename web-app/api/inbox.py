@@ -1,40 +1,296 @@
 from datetime import datetime, timedelta, timezone
 import time
-from agent import Agent
+from agent import Agent, MODEL
 import asyncio
 import json
 import uuid
+import hashlib
+from string import Template
 import asyncio
+import threading
+import calendar
+import sys
+from collections import OrderedDict, deque
+import config_reader
 
 def convert_to_datetime_from_string(date_str):
     #convert a datetime string to a datetime object
     #date_str is in the format "2025-07-22 19:39:58"
-    return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+    try:
+        return datetime.fromisoformat(date_str)
+    except ValueError:
+        return datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+
+def to_timestamp(date):
+    #epoch seconds for a date string, datetime or timestamp, naive datetimes are utc
+    if date is None or date == '':
+        return None
+    if isinstance(date, int):
+        return date
+    if isinstance(date, str):
+        date = convert_to_datetime_from_string(date)
+    return calendar.timegm(date.utctimetuple())
+
+def intern_addresses(addresses):
+    #(name, address) pairs as tuples of interned strings, senders repeat a lot
+    if not addresses:
+        return ()
+    if isinstance(addresses, str):
+        return addresses
+    return tuple((sys.intern(name or ''), sys.intern(address or '')) for name, address in addresses)
+
+def intern_strings(values):
+    return tuple(sys.intern(str(value)) for value in values or ())
+
+# Persisted Email attributes mapped to their column in the emails table
+DB_COLUMNS = {
+    'id': 'message_id',
+    'subject': 'subject',
+    'body': 'body',
+    'full_body': 'full_body',
+    'html': 'html',
+    'from_': 'from_',
+    'to': 'to_',
+    'date': 'date',
+    'processed': 'processed',
+    'state': 'state',
+    'drafted_response': 'drafted_response',
+    'sent_response': 'sent_response',
+    'sent_date': 'sent_date',
+    'sent_to': 'sent_to',
+    'sent_subject': 'sent_subject',
+    'sent_body': 'sent_body',
+    'tags': 'tags',
+    'fingerprint': 'fingerprint',
+    'attachments': 'attachments',
+    'preview': 'preview',
+}
+#attributes stored as json text, and ones stored as-is rather than defaulting to ''
+JSON_COLUMNS = {'html', 'from_', 'to', 'state', 'tags', 'attachments', 'sent_to'}
+RAW_COLUMNS = {'id', 'subject', 'body', 'processed'}
+#one bit per persisted attribute, used to track which ones changed
+DIRTY_BITS = {name: 1 << i for i, name in enumerate(DB_COLUMNS)}
+ALL_DIRTY = (1 << len(DB_COLUMNS)) - 1
+
+#large fields that can stay in the db until an email is opened
+HEAVY_FIELDS = ('body', 'full_body', 'html')
+#columns loaded when hydrating without the heavy fields
+LIST_COLUMNS = ['subject', 'from_', 'to_', 'date', 'processed', 'state', 'drafted_response', 'tags', 'fingerprint', 'attachments', 'preview']
+#characters of the body shown in the list view
+PREVIEW_CHARS = 200
+#placeholder for a heavy field that has not been read from the db
+NOT_LOADED = object()
+
+class BodyCache:
+    #LRU cache of heavy fields for emails hydrated without them,
+    #bounded by the approximate size of the cached text in bytes
+    def __init__(self, db, account, max_bytes):
+        self.db = db
+        self.account = account
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, message_id):
+        with self.lock:
+            if message_id in self.entries:
+                self.entries.move_to_end(message_id)
+                self.hits += 1
+                return self.entries[message_id][0]
+        self.prefetch([message_id])
+        with self.lock:
+            if message_id in self.entries:
+                return self.entries[message_id][0]
+        return {'body': '', 'full_body': '', 'html': []}
+
+    def prefetch(self, message_ids):
+        #load any uncached ids with a single query
+        with self.lock:
+            missing = [message_id for message_id in message_ids if message_id not in self.entries]
+        if not missing:
+            return
+        rows = self.db.get_emails(missing, self.account, columns=list(HEAVY_FIELDS))
+        with self.lock:
+            for message_id, row in rows.items():
+                self.misses += 1
+                fields = {
+                    'body': row['body'],
+                    'full_body': row['full_body'],
+                    'html': json.loads(row['html']) if row['html'] else [],
+                }
+                size = len(row['body'] or '') + len(row['full_body'] or '') + len(row['html'] or '')
+                self._put(message_id, fields, size)
+
+    def _put(self, message_id, fields, size):
+        if message_id in self.entries:
+            self.size -= self.entries.pop(message_id)[1]
+        self.entries[message_id] = (fields, size)
+        self.size += size
+        #always keep the newest entry, even if it is over budget on its own
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+def make_preview(body):
+    #the start of the body on one line
+    return ' '.join((body or '')[:PREVIEW_CHARS * 2].split())[:PREVIEW_CHARS]
+
+class LazyField:
+    #an Email attribute that reads through the body cache while NOT_LOADED
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.attr = '_' + name
+
+    def __get__(self, email, owner=None):
+        if email is None:
+            return self
+        value = getattr(email, self.attr)
+        if value is NOT_LOADED:
+            return email.body_cache.get(email.id)[self.name]
+        return value
+
+    def __set__(self, email, value):
+        object.__setattr__(email, self.attr, value)
 
 class Email:
-    def __init__(self, id, subject, body, full_body='', html='', from_='', to='', date='', processed=False, state=[], drafted_response=None, tags=[]):
-        self.id = id
-        self.subject = subject
-        self.body = body
-        self.full_body = full_body
-        self.html = html
-        self.from_ = from_
-        self.to = to
-        if isinstance(date, str):
-            self.date = convert_to_datetime_from_string(date)
-        else:
-            self.date = date
-        self.processed = processed
-        self.state = state #list of states to show
-        self.drafted_response = drafted_response
-        self.sent_response = None
-        self.sent_date = None
-        self.sent_to = None
-        self.sent_subject = None
-        self.sent_body = None
-        self.action = 'drafted' #testing
-        self.tags = tags
-        
+    #emails are held for the whole inbox, so they use slots instead of a
+    #per-instance __dict__ and keep compact values: interned sender and tag
+    #strings, tuples for state and tags, and the date as epoch seconds
+    __slots__ = (
+        '_dirty', 'persisted', 'body_cache',
+        'id', 'subject', '_body', '_full_body', '_html', '_from', '_to', '_date',
+        'processed', '_state', 'drafted_response', 'sent_response', 'sent_date',
+        'sent_to', 'sent_subject', 'sent_body', '_tags', 'fingerprint', 'attachments', '_preview',
+    )
+
+    body = LazyField()
+    full_body = LazyField()
+    html = LazyField()
+    action = 'drafted' #testing
+
+    def __init__(self, id, subject, body, full_body='', html='', from_='', to='', date='', processed=False, state=(), drafted_response=None, tags=(), fingerprint='', attachments=(), preview='', body_cache=None):
+        #fields are set directly rather than through __setattr__ since
+        #a new email starts with every persisted attribute dirty
+        set_ = object.__setattr__
+        set_(self, '_dirty', ALL_DIRTY)
+        set_(self, 'persisted', False)
+        set_(self, 'body_cache', body_cache)
+        set_(self, 'id', id)
+        set_(self, 'subject', subject)
+        set_(self, '_body', body)
+        set_(self, '_full_body', full_body)
+        set_(self, '_html', html)
+        set_(self, '_from', intern_addresses(from_))
+        set_(self, '_to', intern_addresses(to))
+        set_(self, '_date', to_timestamp(date))
+        set_(self, 'processed', processed)
+        set_(self, '_state', intern_strings(state)) #states to show
+        set_(self, 'drafted_response', drafted_response)
+        set_(self, 'sent_response', None)
+        set_(self, 'sent_date', None)
+        set_(self, 'sent_to', None)
+        set_(self, 'sent_subject', None)
+        set_(self, 'sent_body', None)
+        set_(self, '_tags', intern_strings(tags))
+        set_(self, 'fingerprint', fingerprint) #inputs of the last processing run
+        set_(self, 'attachments', tuple(attachments)) #name, type and size of parts not downloaded
+        set_(self, '_preview', preview) #stored preview, used while the body is not loaded
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        bit = DIRTY_BITS.get(name)
+        if bit:
+            if name == 'body':
+                #the preview is derived from the body
+                bit |= DIRTY_BITS['preview']
+            object.__setattr__(self, '_dirty', self._dirty | bit)
+
+    @property
+    def preview(self):
+        if self._body is NOT_LOADED:
+            return self._preview
+        return make_preview(self._body)
+
+    @property
+    def from_(self):
+        return self._from
+
+    @from_.setter
+    def from_(self, value):
+        object.__setattr__(self, '_from', intern_addresses(value))
+
+    @property
+    def to(self):
+        return self._to
+
+    @to.setter
+    def to(self, value):
+        object.__setattr__(self, '_to', intern_addresses(value))
+
+    @property
+    def timestamp(self):
+        return self._date
+
+    @property
+    def date(self):
+        if self._date is None:
+            return None
+        return datetime.fromtimestamp(self._date, timezone.utc).replace(tzinfo=None)
+
+    @date.setter
+    def date(self, value):
+        object.__setattr__(self, '_date', to_timestamp(value))
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        object.__setattr__(self, '_state', intern_strings(value))
+
+    @property
+    def tags(self):
+        return self._tags
+
+    @tags.setter
+    def tags(self, value):
+        object.__setattr__(self, '_tags', intern_strings(value))
+
+    @property
+    def is_dirty(self):
+        return self._dirty != 0
+
+    @property
+    def dirty_fields(self):
+        return {name for name, bit in DIRTY_BITS.items() if self._dirty & bit}
+
+    def mark_clean(self):
+        #called once the email matches what is stored in the db
+        object.__setattr__(self, '_dirty', 0)
+        object.__setattr__(self, 'persisted', True)
+
+    def add_state(self, state):
+        #state is a tuple, so adding one is an assignment that gets tracked
+        if state not in self.state:
+            self.state = self.state + (state,)
+
+    def remove_state(self, *states):
+        if any(state in self.state for state in states):
+            self.state = tuple(state for state in self.state if state not in states)
+
     async def update(self):
         pass
 
@@ -55,13 +311,10 @@ class Email:
         return email_str
 
     #jsonify the email
-    def to_dict(self):
-        return {
+    def to_dict(self, include_bodies=True):
+        data = {
             "id": self.id,
             "subject": self.subject,
-            "body": self.body,
-            "html": self.html,
-            "full_body": self.full_body,
             "from": self.from_,
             "to": self.to,
             "date": self.date,
@@ -69,54 +322,309 @@ class Email:
             "state": self.state,
             "drafted_response": self.drafted_response,
             "tags": self.tags,
+            "attachments": self.attachments,
+            "preview": self.preview,
         }
+        if include_bodies:
+            data["body"] = self.body
+            data["html"] = self.html
+            data["full_body"] = self.full_body
+        return data
+
+    def db_value(self, name):
+        value = getattr(self, name)
+        if name in JSON_COLUMNS:
+            return json.dumps(value)
+        if name in RAW_COLUMNS:
+            return value
+        return value or ''
+
+    def to_db_dict(self, fields=None):
+        #fields limits the output to those attributes (plus the id)
+        if fields is None:
+            fields = DB_COLUMNS
+        else:
+            fields = ['id'] + [name for name in DB_COLUMNS if name in fields and name != 'id']
+        return {DB_COLUMNS[name]: self.db_value(name) for name in fields}
+
+AI_FILTER_TEMPLATE = Template("""
+You are given an email and instructions to determine if the email should be whitelisted (True) or filtered out (False).
+Answer with only True or False.
+The email is:
+From: $sender
+Subject: $subject
 
-    def to_db_dict(self):
+$email
+The instructions are:
+$instructions
+""")
+
+def ai_rule_hash(instructions):
+    #identifies an AI rule's verdicts, so editing the rule or its prompt asks again
+    payload = json.dumps([MODEL, AI_FILTER_TEMPLATE.template, instructions])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class VerdictCache:
+    #AI rule verdicts per (rule hash, message id), stored in the
+    #filter_verdicts table so resyncs and restarts reuse them
+    def __init__(self, db, account):
+        self.db = db
+        self.account = account
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, rule_hash, message_ids):
+        verdicts = self.db.get_filter_verdicts(self.account, rule_hash, message_ids)
+        self.hits += len(verdicts)
+        self.misses += len(message_ids) - len(verdicts)
+        return verdicts
+
+    def put(self, rule_hash, verdicts):
+        if verdicts:
+            self.db.put_filter_verdicts(self.account, rule_hash, verdicts)
+
+    def prune(self, rule_hashes):
+        return self.db.prune_filter_verdicts(self.account, rule_hashes)
+
+    def stats(self):
+        lookups = self.hits + self.misses
         return {
-            "message_id": self.id,
-            "subject": self.subject,
-            "body": self.body,
-            "full_body": self.full_body or '',
-            "html": json.dumps(self.html) or '',
-            "from_": json.dumps(self.from_) or '',
-            "to_": json.dumps(self.to) or '',
-            "date": self.date or '',
-            "processed": self.processed,
-            "state": json.dumps(self.state),
-            "drafted_response": self.drafted_response or '',
-            "sent_response": self.sent_response or '',
-            "sent_date": self.sent_date or '',
-            "sent_to": self.sent_to or '',
-            "sent_subject": self.sent_subject or '',
-            "sent_body": self.sent_body or '',
-            "tags": json.dumps(self.tags),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0,
         }
 
+def sender_matches(address, sender_rule):
+    #sender rules are a whole address, or a domain written as @example.com
+    address = address.lower()
+    if sender_rule.startswith('@'):
+        return address.rpartition('@')[2] == sender_rule[1:]
+    return address == sender_rule
+
+class SubstringMatcher:
+    #Aho-Corasick automaton telling whether any of the patterns occurs in a
+    #text, in one pass over the text however many patterns there are
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.fail = [0]
+        self.terminal = [False]
+        self.match_all = False
+        for pattern in patterns:
+            if not pattern:
+                #'' is in every string
+                self.match_all = True
+                continue
+            state = 0
+            for char in pattern:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.terminal.append(False)
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.terminal[state] = True
+        #breadth first, so a state's fail link is set before its children's
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0) if state else 0
+                self.terminal[next_state] = self.terminal[next_state] or self.terminal[self.fail[next_state]]
+        self.empty = len(self.goto) == 1
+
+    def search(self, text):
+        if self.match_all:
+            return True
+        if self.empty:
+            return False
+        goto, fail, terminal = self.goto, self.fail, self.terminal
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if terminal[state]:
+                return True
+        return False
+
+class CompiledRules:
+    #the whitelist compiled for lookups: sender addresses and domains in
+    #sets, subject substrings in one automaton, and the AI rules left over
+    def __init__(self, filters):
+        self.senders = set()
+        self.domains = set()
+        self.ai_filters = []
+        subjects = []
+        for filter in filters:
+            if filter.type == 'email':
+                value = filter.text_value.strip().lower()
+                if value.startswith('@'):
+                    self.domains.add(value[1:])
+                else:
+                    self.senders.add(value)
+            elif filter.type == 'subject':
+                subjects.append(filter.text_value.lower())
+            else:
+                self.ai_filters.append(filter)
+        self.subjects = SubstringMatcher(subjects)
+        self.empty = len(filters) == 0
+
+    def matches_headers(self, email):
+        for _, address in email.from_:
+            address = address.lower()
+            if address in self.senders or address.rpartition('@')[2] in self.domains:
+                return True
+        return self.subjects.search((email.subject or '').lower())
+
+def rule_key(filter):
+    #rules are compared by what they match, so re-saving a rule unchanged
+    #is not seen as removing and adding it
+    if filter.type == 'classification':
+        return (filter.type, filter.text_value.strip())
+    return (filter.type, filter.text_value.strip().lower())
+
+class RuleChanges:
+    #the rules a whitelist update added and removed, so a resync only looks
+    #at emails that could have changed sides
+    def __init__(self, added, removed, was_empty, now_empty):
+        self.added = CompiledRules(added)
+        self.removed = CompiledRules(removed)
+        self.was_empty = was_empty
+        self.now_empty = now_empty
+
+    @property
+    def changed(self):
+        return not (self.added.empty and self.removed.empty)
+
+    @property
+    def needs_fetch(self):
+        #an empty whitelist keeps everything, so mail we do not have can
+        #only pass after rules are added to a non-empty list or all removed
+        if self.was_empty:
+            return False
+        return self.now_empty or not self.added.empty
+
+    async def prefilter(self, email):
+        #download bodies only for mail an added rule could keep
+        return self.now_empty or bool(self.added.ai_filters) or self.added.matches_headers(email)
+
+    def may_drop(self, email):
+        #only emails a removed rule kept can fail now, and every email once
+        #an empty whitelist gets its first rules
+        if self.now_empty:
+            return False
+        if self.was_empty:
+            return True
+        return bool(self.removed.ai_filters) or self.removed.matches_headers(email)
+
 class FilterList:
-    def __init__(self):
+    def __init__(self, agent=None, verdicts=None):
         self.filters = {}
+        #compiled on first use after the rules change
+        self.rules = None
+        #the agent AI rules ask, and a VerdictCache to remember their answers
+        self.agent = agent
+        self.verdicts = verdicts
     
     def add_filter(self, filter):
         print(f"Adding filter {filter.uid}")
-        print(type(filter))
         self.filters[filter.uid] = filter
+        self.rules = None
     
     def remove_filter(self, filter_uid):
         del self.filters[filter_uid]
+        self.rules = None
+
+    @property
+    def compiled(self):
+        if self.rules is None:
+            self.rules = CompiledRules(list(self.filters.values()))
+        return self.rules
 
     async def filter(self, email):
-        tasks = []
-        if len(self.filters) == 0:
-            return True
-        for filter in self.filters.values():
-            tasks.append(filter.matches(email))
-        results = await asyncio.gather(*tasks)
-        return any(results)
+        return (await self.filter_many([email]))[0]
+
+    async def filter_many(self, emails, limit=None):
+        #whether each email passes. header rules are plain lookups, AI rules
+        #only run for the emails those did not keep
+        rules = self.compiled
+        if rules.empty:
+            return [True] * len(emails)
+        verdicts = [rules.matches_headers(email) for email in emails]
+        if rules.ai_filters:
+            undecided = [email for email, kept in zip(emails, verdicts) if not kept]
+            kept_ids = await self.ai_verdicts(rules.ai_filters, undecided, limit)
+            verdicts = [kept or email.id in kept_ids for email, kept in zip(emails, verdicts)]
+        return verdicts
+
+    async def filter_chunks(self, emails, chunk_size):
+        #yield (chunk, verdicts) for chunks of emails in the order they are
+        #decided. chunks run concurrently and share one limit on AI calls
+        limit = asyncio.Semaphore(config_reader.AI_FILTER_MAX_CONCURRENCY)
+
+        async def decide(chunk):
+            return chunk, await self.filter_many(chunk, limit)
+
+        chunks = [emails[start:start + chunk_size] for start in range(0, len(emails), chunk_size)]
+        for decided in asyncio.as_completed([decide(chunk) for chunk in chunks]):
+            yield await decided
+
+    async def ai_verdicts(self, ai_filters, emails, limit=None):
+        #ids of the emails an AI rule keeps. stored verdicts are used where
+        #there are some, the rest are asked concurrently, at most
+        #AI_FILTER_MAX_CONCURRENCY at a time
+        kept_ids = set()
+        if limit is None:
+            limit = asyncio.Semaphore(config_reader.AI_FILTER_MAX_CONCURRENCY)
+        pending = []
+        for filter in ai_filters:
+            rule_hash = ai_rule_hash(filter.text_value)
+            remaining = [email for email in emails if email.id not in kept_ids]
+            cached = self.verdicts.get(rule_hash, [email.id for email in remaining]) if self.verdicts else {}
+            kept_ids.update(email_id for email_id, kept in cached.items() if kept)
+            pending.extend((filter, rule_hash, email) for email in remaining if email.id not in cached)
+
+        async def ask(filter, email):
+            async with limit:
+                return await filter.matches(email)
+
+        #an email another rule already keeps from the cache needs no call
+        pending = [(filter, rule_hash, email) for filter, rule_hash, email in pending if email.id not in kept_ids]
+        results = await asyncio.gather(*(ask(filter, email) for filter, _, email in pending), return_exceptions=True)
+        answered = {}
+        for (filter, rule_hash, email), result in zip(pending, results):
+            if isinstance(result, Exception):
+                #keep anything we could not judge rather than drop it, and
+                #leave it out of the cache so it is asked again next time
+                print(f"Error running AI filter on email {email.id}: {result}")
+                kept_ids.add(email.id)
+                continue
+            answered.setdefault(rule_hash, {})[email.id] = bool(result)
+            if result:
+                kept_ids.add(email.id)
+        if self.verdicts:
+            for rule_hash, rule_verdicts in answered.items():
+                self.verdicts.put(rule_hash, rule_verdicts)
+        return kept_ids
+
+    async def prefilter(self, email):
+        #used on header-only emails before the body is downloaded. True if a
+        #header rule matches or a rule that needs the body could still match
+        rules = self.compiled
+        return rules.empty or bool(rules.ai_filters) or rules.matches_headers(email)
     
     def update_from_json(self, json_data):
+        #update the whitelist from a json object, returning the RuleChanges
         print('updating whitelist from json')
-        #update the whitelist from a json object
+        previous = {rule_key(filter): filter for filter in self.filters.values()}
         self.filters = {}
+        self.rules = None
         #json_data is a string, so we need to load it
         if isinstance(json_data, str):
             rules = json.loads(json_data)['rules']
@@ -134,19 +642,23 @@ class FilterList:
                 elif rule['type'] == 'classification':
                     self.create_ai_filter(rule['value'])
         print(f"Updating whitelist from json: {json_data}")
+        current = {rule_key(filter): filter for filter in self.filters.values()}
+        return RuleChanges(
+            [filter for key, filter in current.items() if key not in previous],
+            [filter for key, filter in previous.items() if key not in current],
+            not previous, not current)
 
 
     def create_from_filter(self, from_filter):
+        sender_rule = from_filter.strip().lower()
         async def filter_func(email):
             for from_ in email.from_:
                 #from is a tupple of (name, email)
-                if from_[1] == from_filter:
+                if sender_matches(from_[1], sender_rule):
                     return True
             return False
         filter = Filter(filter_func, 'email', from_filter)
-        print(filter_func)
         print(f"Created filter from {from_filter}")
-        print(filter.uid)
         self.add_filter(filter)
 
     def create_subject_filter(self, subject_filter):
@@ -156,31 +668,26 @@ class FilterList:
         self.add_filter(filter)
 
     def create_ai_filter(self, prompt):
-        #create a filter that uses the ai to filter the email
-        #the filter should be a function that takes an email and returns a boolean
+        #create a filter that asks the agent whether the email should be kept
         async def filter_func(email):
-            instructions = prompt
-            filter_template = """
-                You are a helpful assistant that can help with email. 
-                You are given an email and instructions to determine if the email should be whitelist (True) or filtered out (False).
-                The email is a string.
-                The instructions are a string.
-                The output should be a boolean.
-                The email is:
-                $email
-                The instructions are:
-                $instructions
-            """
-            filter_prompt = filter_template.format(email=email, instructions=instructions)
-            response = await self.agent.get_openai_response(filter_prompt)
+            if self.agent is None:
+                raise ValueError("no agent set for AI filters")
+            filter_prompt = AI_FILTER_TEMPLATE.substitute(
+                sender=', '.join(address for _, address in email.from_),
+                subject=email.subject or '',
+                email=email.body or email.full_body or '',
+                instructions=prompt)
+            #the filled in prompt covers the sender, subject and body
+            cache_key = self.agent.cache_key(AI_FILTER_TEMPLATE.template, prompt, filter_prompt)
+            response = await self.agent.get_openai_response(filter_prompt, cache_key)
             #make the response a boolean
-            if response.lower() == "true":
-                return True
-            else:
-                return False
+            return bool(response) and response['text'].strip().lower().startswith('true')
         filter = Filter(filter_func, 'classification', prompt)
         self.add_filter(filter)
 
+    def rule_hashes(self):
+        return [ai_rule_hash(filter.text_value) for filter in self.compiled.ai_filters]
+
     def to_json(self):
         return {
             "rules": [
@@ -236,6 +743,9 @@ class Inbox:
     def __init__(self):
         self.LOOKBACK_DAYS = 1
         self.BATCH_SIZE = 5
+        self.HYDRATE_HEADERS_ONLY = config_reader.HYDRATE_HEADERS_ONLY
+        self.BODY_CACHE_BYTES = config_reader.BODY_CACHE_BYTES
+        self.body_cache = None
         #key is the message id, value is the email object
         self.emails = {}
         self.agent = None
@@ -243,13 +753,23 @@ class Inbox:
         self.unprocessed_message_ids = []
         self.retrieve_function = None
         self.send_function = None
+        #starts background processing of unprocessed_message_ids, when set
+        #it replaces running one batch per PROCESSING update
+        self.process_function = None
         self.last_retrieved_date = None
         self.user = None
         self.app_password = None
         self.agent = Agent("openai")
+        self.whitelist.agent = self.agent
         self.state = self.State.UNINITIALIZED
         self.db = None
+        #guards emails and unprocessed_message_ids, which the processing
+        #worker, the outbox and the sync threads change alongside flask. it
+        #is never held across an await or a call into the worker
+        self.lock = threading.RLock()
         self.update_delta = None
+        self.batch_stats = None
+        self.filter_stats = None
 
     def update_state(self, new_state):
         print(f"Updating state from {self.state} to {new_state}")
@@ -279,9 +799,11 @@ class Inbox:
             if self.state == self.State.UNINITIALIZED or self.state == self.State.HYDRATING:
                 print('skipping processing because not hydrated')
             else:
-                print('processing batch')
-                #this is a reset of the unprocessed message ids
                 self.state = self.State.PROCESSING
+                if self.process_function is not None:
+                    self.process_function()
+                    return
+                print('processing batch')
                 asyncio.run(self.continue_processing())
                 self.save_emails()
         elif new_state == self.State.DONE:
@@ -293,20 +815,32 @@ class Inbox:
         #in hydrating state, we load all emails from the db
         #this is a reset of the local inbox, pulling from save state
         self.state = self.State.HYDRATING
-        self.emails = {}
-        self.unprocessed_message_ids = []
         self.last_retrieved_date = None
+        emails = {}
+        unprocessed = []
         print(f"Scanning emails for {self.user}")
-        results = self.db.scan_emails({'account': self.user})
-        print(f"Found {len(results)} emails")
-        for email in results:
+        if self.HYDRATE_HEADERS_ONLY:
+            #leave bodies in the db until an email is opened
+            self.body_cache = BodyCache(self.db, self.user, self.BODY_CACHE_BYTES)
+            rows = self.db.iter_emails(self.user, columns=LIST_COLUMNS)
+        else:
+            self.body_cache = None
+            rows = self.db.iter_emails(self.user)
+        self.whitelist.verdicts = VerdictCache(self.db, self.user)
+        for email in rows:
             try:
-                self.emails[email['message_id']] = Email(
+                if self.body_cache is not None:
+                    body = full_body = html = NOT_LOADED
+                else:
+                    body = email['body']
+                    full_body = email['full_body']
+                    html = json.loads(email['html'])
+                emails[email['message_id']] = Email(
                     id=email['message_id'],
                     subject=email['subject'],
-                    body=email['body'],
-                    full_body=email['full_body'],
-                    html=json.loads(email['html']),
+                    body=body,
+                    full_body=full_body,
+                    html=html,
                     from_=json.loads(email['from_']),
                     to=json.loads(email['to_']),
                     date=email['date'],
@@ -314,14 +848,43 @@ class Inbox:
                     state=json.loads(email['state']),
                     drafted_response=email['drafted_response'],
                     tags=json.loads(email['tags']),
+                    fingerprint=email['fingerprint'] or '',
+                    attachments=json.loads(email['attachments'] or '[]'),
+                    preview=email['preview'] or '',
+                    body_cache=self.body_cache,
                     )
+                emails[email['message_id']].mark_clean()
                 if not email['processed']:
-                    self.unprocessed_message_ids.append(email['message_id'])
+                    unprocessed.append(email['message_id'])
             except Exception as e:
                 print(f"Error adding email to inbox: {e}")
-                print(email)
+                print(dict(email))
+        with self.lock:
+            self.emails = emails
+            self.unprocessed_message_ids = unprocessed
+            #rows come back in message_id order, the queue is worked from the end
+            self.sort_unprocessed()
+        print(f"Found {len(self.emails)} emails")
         self.update_state(self.State.HYDRATED)
 
+    def sort_unprocessed(self):
+        #oldest first, so the newest emails are the next to be processed
+        with self.lock:
+            self.unprocessed_message_ids.sort(key=lambda email_id: (self.emails[email_id].timestamp or 0, email_id))
+
+    def email_dicts(self, include_bodies=True):
+        #serialize every email, prefetching lazily loaded bodies a page at a time
+        with self.lock:
+            emails = list(self.emails.values())
+        if not include_bodies or self.body_cache is None:
+            return [email.to_dict(include_bodies) for email in emails]
+        results = []
+        for start in range(0, len(emails), 200):
+            page = emails[start:start + 200]
+            self.body_cache.prefetch([email.id for email in page if email._body is NOT_LOADED])
+            results.extend(email.to_dict() for email in page)
+        return results
+
     def update_writing_prompt(self, prompt):
         self.agent.response_prompt = prompt
     
@@ -330,11 +893,15 @@ class Inbox:
 
     async def reretrieve_all(self):
         self.last_retrieved_date = None
-        self.emails = {}
-        self.unprocessed_message_ids = []
-        await self.update()
+        with self.lock:
+            self.emails = {}
+            self.unprocessed_message_ids = []
+        await self.update(full=True)
 
-    async def update(self):
+    async def update(self, full=False, prefilter=None):
+        #polls only uids above the stored sync position, full searches the
+        #whole window again (needed when the whitelist changes). prefilter
+        #replaces the whitelist's header check before bodies are downloaded
         print('Updating update')
         self.state = self.State.UPDATING
         print(self.last_retrieved_date)
@@ -348,54 +915,133 @@ class Inbox:
             since_dt = self.last_retrieved_date
         since_str = since_dt.strftime('%d-%b-%Y')
         query = f'SINCE "{since_str}"'
-        print(f"Retrieving emails since {since_str}")
-        new_emails = await self.retrieve_function(query, self.user, self.app_password)
-        num_new_emails = 0
-        for email in new_emails:
-            print(self.whitelist)
-            if await self.whitelist.filter(email): 
-                if email.id not in self.emails:
-                    self.emails[email.id] = email
-                    self.unprocessed_message_ids.append(email.id)
-                    num_new_emails += 1
+        sync_state = {} if full else (self.db.get_sync_state(self.user) or {})
+        if sync_state:
+            print(f"Retrieving emails after uid {sync_state.get('last_uid')}")
+        else:
+            print(f"Retrieving emails since {since_str}")
+        new_emails = await self.retrieve_function(query, self.user, self.app_password, header_filter=prefilter or self.whitelist.prefilter, sync_state=sync_state)
+        num_new_emails = await self.ingest(new_emails)
         # Only update last_retrieved_date if we have emails
-        if self.emails:
-            self.last_retrieved_date = self.get_latest_email().date
+        latest = self.get_latest_email()
+        if latest is not None:
+            self.last_retrieved_date = latest.date
         self.save_emails()
+        #advance the sync position only once the new emails are stored
+        if sync_state.get('uidvalidity') is not None:
+            self.db.put_sync_state(self.user, sync_state)
         self.update_state(self.State.UPDATED)
         return num_new_emails
     
-    async def resync(self):
+    async def ingest(self, new_emails):
+        #run the whitelist over fetched emails a chunk at a time, adding and
+        #storing each chunk's kept emails as soon as it is decided
+        start = time.perf_counter()
+        first_result = None
+        num_new_emails = 0
+        chunks = 0
+        async for chunk, verdicts in self.whitelist.filter_chunks(new_emails, config_reader.WHITELIST_CHUNK_SIZE):
+            if first_result is None:
+                first_result = time.perf_counter() - start
+            chunks += 1
+            added = []
+            with self.lock:
+                for email, kept in zip(chunk, verdicts):
+                    if kept and email.id not in self.emails:
+                        self.emails[email.id] = email
+                        self.unprocessed_message_ids.append(email.id)
+                        added.append(email)
+                self.persist(added)
+            num_new_emails += len(added)
+        wall_seconds = time.perf_counter() - start
+        self.filter_stats = {
+            "emails": len(new_emails),
+            "kept": num_new_emails,
+            "chunks": chunks,
+            "wall_seconds": wall_seconds,
+            "first_result_seconds": first_result or 0,
+            "emails_per_second": len(new_emails) / wall_seconds if wall_seconds else 0,
+        }
+        if new_emails:
+            print(f"Filtered {len(new_emails)} emails in {wall_seconds:.2f}s, kept {num_new_emails}")
+        return num_new_emails
+
+    async def resync(self, changes=None):
+        #bring the inbox in line with the whitelist after it changed. with the
+        #RuleChanges from update_from_json only mail an added rule could keep
+        #is downloaded and only emails a removed rule kept are checked again,
+        #without them every email is
         self.state = self.State.UPDATING
-        #resync the inbox based on the current whitelist
-        #first get any new emails
-        num_new_emails = await self.update()
-        #then rerun all emails against the whitelist
-        emails_to_delete = []
-        for email_id in self.emails:
-            if not await self.whitelist.filter(self.emails[email_id]): 
-                #no longer passed the whitelist, delete it
-                emails_to_delete.append(email_id)
-        
-        
-        #delete any emails that are on the delete list
-        for email_id in emails_to_delete:
-            del self.emails[email_id]
-            if email_id in self.unprocessed_message_ids:
-                self.unprocessed_message_ids.remove(email_id)
-        self.db.bulk_delete_emails(emails_to_delete, self.user)
+        if changes is None:
+            #search the whole window, emails the old whitelist rejected may pass now
+            await self.update(full=True)
+            with self.lock:
+                candidates = list(self.emails.values())
+        elif not changes.changed:
+            self.update_state(self.State.UPDATED)
+            return
+        else:
+            if changes.needs_fetch:
+                await self.update(full=True, prefilter=changes.prefilter)
+            with self.lock:
+                candidates = [email for email in self.emails.values() if changes.may_drop(email)]
+        print(f"Rechecking {len(candidates)} of {len(self.emails)} emails against the whitelist")
+        verdicts = await self.whitelist.filter_many(candidates)
+        #emails that no longer pass the whitelist are deleted
+        self.remove_emails({email.id for email, kept in zip(candidates, verdicts) if not kept})
         self.update_state(self.State.UPDATED)
 
+    def remove_emails(self, email_ids):
+        if not email_ids:
+            return
+        queued = False
+        with self.lock:
+            for email_id in email_ids:
+                email = self.emails.pop(email_id, None)
+                queued = queued or (email is not None and not email.processed)
+            #the batch path looks every queued id up, so removed ones are filtered
+            #out, in one pass and only when one of them could still be queued
+            if queued:
+                self.unprocessed_message_ids = [email_id for email_id in self.unprocessed_message_ids if email_id not in email_ids]
+        self.db.bulk_delete_emails(list(email_ids), self.user)
+
     def save_emails(self):
         print('in save_emails')
-        emails_to_put = [email.to_db_dict() for email in self.emails.values()]
-        if len(emails_to_put) > 0:
-            self.db.bulk_put_emails(emails_to_put, self.user)
+        self.persist(self.emails.values())
+
+    def persist(self, emails):
+        #write new emails in full, and only the changed columns of stored ones
+        with self.lock:
+            self._persist(emails)
+
+    def _persist(self, emails):
+        new_emails = []
+        changed_emails = []
+        for email in emails:
+            if not email.is_dirty:
+                continue
+            if email.persisted:
+                changed_emails.append(email)
+            else:
+                new_emails.append(email)
+        if new_emails:
+            if self.db.bulk_put_emails([email.to_db_dict() for email in new_emails], self.user):
+                for email in new_emails:
+                    email.mark_clean()
+        if changed_emails:
+            updates = [email.to_db_dict(email.dirty_fields) for email in changed_emails]
+            if self.db.bulk_update_emails(updates, self.user):
+                for email in changed_emails:
+                    email.mark_clean()
+        print(f"Saved {len(new_emails)} new and {len(changed_emails)} changed emails")
 
     def save_whitelist(self):
         whitelist_to_put = self.whitelist.to_json()
         whitelist_to_put = json.dumps(whitelist_to_put)
         self.db.put_metadata(self.user, {'rules': whitelist_to_put})
+        #verdicts of rules that were removed or edited will not be asked for again
+        if self.whitelist.verdicts is not None:
+            self.whitelist.verdicts.prune(self.whitelist.rule_hashes())
 
     def get_prompt(self, prompt_type):
         if prompt_type == 'research':
@@ -425,13 +1071,29 @@ class Inbox:
             self.agent.instructions = prompts['processing']
 
     def clear_all_processed(self):
-        #reprocess all emails
-        for email_id in self.emails:
-            email = self.emails[email_id]
-            email.processed = False
-            email.state = []
-            email.drafted_response = None
-        self.unprocessed_message_ids = list(self.emails.keys())
+        #reprocess emails whose processing inputs changed since they were processed
+        #bodies are needed for the fingerprint, so they are prefetched a page at a time
+        with self.lock:
+            self._clear_all_processed()
+
+    def _clear_all_processed(self):
+        emails = list(self.emails.values())
+        stale = []
+        for start in range(0, len(emails), 200):
+            page = emails[start:start + 200]
+            if self.body_cache is not None:
+                self.body_cache.prefetch([email.id for email in page if email._body is NOT_LOADED])
+            for email in page:
+                if email.processed and email.fingerprint == self.agent.fingerprint(email):
+                    continue
+                email.processed = False
+                email.state = []
+                email.drafted_response = None
+                email.fingerprint = ''
+                stale.append(email.id)
+        print(f"Reprocessing {len(stale)} of {len(emails)} emails with changed inputs")
+        self.unprocessed_message_ids = stale
+        self.sort_unprocessed()
 
     async def continue_processing(self):
         #create the next batch of emails to process
@@ -441,9 +1103,12 @@ class Inbox:
             return
 
         #always batch the last self.BATCH_SIZE emails instead of the first
-        batch = self.unprocessed_message_ids[-self.BATCH_SIZE:]
-        await self.process_batch(batch)
-        self.unprocessed_message_ids = self.unprocessed_message_ids[:-self.BATCH_SIZE]
+        with self.lock:
+            batch = self.unprocessed_message_ids[-self.BATCH_SIZE:]
+        failed = await self.process_batch(batch)
+        #failed emails go to the front so they are retried after everything else
+        with self.lock:
+            self.unprocessed_message_ids = failed + [email_id for email_id in self.unprocessed_message_ids if email_id not in batch]
         email_data = []
         for email_id in batch:
             email = self.emails[email_id]
@@ -452,35 +1117,86 @@ class Inbox:
 
     def get_latest_email(self):
         #get the latest email
-        if not self.emails:
-            return None
-        return max(self.emails.values(), key=lambda x: str(x.date))
+        with self.lock:
+            if not self.emails:
+                return None
+            return max(self.emails.values(), key=lambda x: x.timestamp or 0)
 
     def generate_draft(self, email_id):
         email = self.emails[email_id]
         draft_text = asyncio.run(self.agent.generate_draft(email))
         if draft_text:
-            email.drafted_response = draft_text
-            email.state.append('drafted_response')
-            self.db.put_email(email.to_db_dict(), self.user)
+            with self.lock:
+                email.drafted_response = draft_text
+                email.add_state('drafted_response')
+                self.persist([email])
             return draft_text
         else:
             return None
 
     def send(self, email_id, draft_text):
         email = self.emails[email_id]
-        self.send_function(email, draft_text, self.user, self.app_password)
-        email.sent_response = draft_text
-        email.sent_date = datetime.now()
-        email.sent_to = email.to
-        email.sent_subject = email.subject
-        email.sent_body = email.body
+        result = self.send_function(email, draft_text, self.user, self.app_password)
+        #sent while the outbox delivers it, other states like tags stay
+        with self.lock:
+            email.drafted_response = draft_text
+            email.remove_state('drafted_response', 'send_failed')
+            email.add_state('sent')
+            email.add_state('queued')
+            email.sent_response = draft_text
+            email.sent_date = datetime.now().isoformat()
+            email.sent_to = email.to
+            email.sent_subject = email.subject
+            email.sent_body = email.body
+            self.persist([email])
+        return result
+
+    def mark_delivery(self, email_id, delivered):
+        #called by the outbox once a queued reply is sent or given up on,
+        #a failed reply goes back to awaiting review with its draft
+        with self.lock:
+            email = self.emails.get(email_id)
+            if email is None:
+                return
+            if delivered:
+                email.remove_state('queued')
+            else:
+                email.remove_state('sent', 'queued')
+                email.add_state('drafted_response')
+                email.add_state('send_failed')
+            self.persist([email])
 
     async def process_batch(self, batch):
         #process the batch of emails
         #create a list of tasks and run them in parallel
+        #returns the ids of emails that failed, which are left unprocessed
+        async def timed_process(email):
+            start = time.perf_counter()
+            await self.agent.process_email(email)
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
         tasks = []
         for email_id in batch:
             email = self.emails[email_id]
-            tasks.append(self.agent.process_email(email))
-        await asyncio.gather(*tasks)
\ No newline at end of file
+            tasks.append(timed_process(email))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        wall_seconds = time.perf_counter() - start
+        failed = []
+        durations = []
+        for email_id, result in zip(batch, results):
+            if isinstance(result, Exception):
+                print(f"Error processing email {email_id}: {result}")
+                failed.append(email_id)
+            else:
+                durations.append(result)
+        #speedup compares against running the same calls one after another
+        self.batch_stats = {
+            "size": len(batch),
+            "failed": len(failed),
+            "wall_seconds": wall_seconds,
+            "sequential_seconds": sum(durations),
+            "speedup": sum(durations) / wall_seconds if wall_seconds else 0,
+        }
+        print(f"Processed batch of {len(batch)} in {wall_seconds:.2f}s ({self.batch_stats['speedup']:.1f}x)")
+        return failed
\ No newline at end of file
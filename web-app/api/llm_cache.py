@@ -0,0 +1,56 @@
+import hashlib
+import json
+import threading
+
+class LLMCache:
+    #content addressed cache of llm responses, stored in the llm_cache table
+    #entries are keyed by model, prompt template, instructions and a hash of
+    #the email body, so any change to one of them is a miss
+
+    #number of stores between eviction passes
+    EVICT_EVERY = 100
+
+    def __init__(self, db, ttl, max_bytes):
+        self.db = db
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model, template, instructions, body):
+        body_hash = hashlib.sha256((body or '').encode('utf-8')).hexdigest()
+        payload = json.dumps([model, template, instructions, body_hash], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        response = self.db.get_llm_response(key, self.ttl)
+        with self.lock:
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(response)
+
+    def put(self, key, model, value):
+        self.db.put_llm_response(key, model, json.dumps(value))
+        with self.lock:
+            self.stores += 1
+            evict = self.stores % self.EVICT_EVERY == 0
+        if evict:
+            removed = self.db.evict_llm_responses(self.ttl, self.max_bytes)
+            print(f"Evicted {removed} cached llm responses")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "saved_calls": self.hits,
+            "hit_rate": self.hits / lookups if lookups else 0,
+            "ttl_seconds": self.ttl,
+            "max_bytes": self.max_bytes,
+            **self.db.llm_cache_size(),
+        }
@@ -0,0 +1,120 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import mailparser
+import config_reader
+
+# Parsing a message with mailparser is CPU bound, so it is done in worker
+# processes instead of on the event loop. Workers only see this module's
+# top-level functions and return plain dicts, the Email objects are built
+# back in the calling process.
+
+#messages sent to a worker per task, to keep pickling overhead down
+CHUNK_SIZE = 16
+
+#the pool is started from a background thread of a process running several
+#others, and a forked child can inherit a lock another thread held. workers
+#are started from a clean process instead, and import parse_chunk by name
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def parse_fields(email_data):
+    #the Email constructor arguments for a raw rfc822 message
+    parsed_email = mailparser.parse_from_bytes(email_data)
+    return {
+        'id': parsed_email.id,
+        'subject': parsed_email.subject or '',
+        'body': parsed_email.text_plain[0] if parsed_email.text_plain else '',
+        'full_body': parsed_email.body,
+        'html': parsed_email.text_html,
+        'from_': parsed_email.from_,
+        'to': parsed_email.to,
+        'date': parsed_email.date,
+    }
+
+def parse_chunk(messages):
+    #runs in a worker: [(fallback id, raw message[, extra fields])] -> [(fallback id, fields or error)].
+    #extra fields are known before parsing, like the attachments of a message
+    #fetched without them
+    results = []
+    for fallback_id, email_data, *extra in messages:
+        try:
+            fields = parse_fields(email_data)
+            if extra:
+                fields.update(extra[0])
+            results.append((fallback_id, fields))
+        except Exception as e:
+            results.append((fallback_id, e))
+    return results
+
+def build_email(fields, fallback_id):
+    from inbox import Email
+    fields = dict(fields)
+    fields['id'] = fields['id'] or fallback_id
+    return Email(**fields)
+
+class MimeParser:
+    def __init__(self, workers=None):
+        #workers=0 parses on the calling thread
+        self.workers = config_reader.MIME_PARSER_WORKERS if workers is None else workers
+        self.executor = None
+        self.parsed = 0
+        self.failed = 0
+
+    def pool(self):
+        #started on first use so importing this module never starts processes
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(START_METHOD))
+        return self.executor
+
+    async def iter_parse(self, messages, failed=None):
+        #yield an Email for each (fallback id, raw message[, extra fields]) as its chunk finishes.
+        #the fallback ids of messages that did not parse are added to failed, as ints
+        messages = list(messages)
+        chunks = [messages[i:i + CHUNK_SIZE] for i in range(0, len(messages), CHUNK_SIZE)]
+        if self.workers == 0:
+            for chunk in chunks:
+                for email in self.emails(parse_chunk(chunk), failed):
+                    yield email
+            return
+        pending = [self.parse_in_pool(chunk) for chunk in chunks]
+        for future in asyncio.as_completed(pending):
+            for email in self.emails(await future, failed):
+                yield email
+
+    async def parse_in_pool(self, chunk):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.pool(), parse_chunk, chunk)
+        except BrokenProcessPool:
+            #a worker died, start a new pool next time and parse this chunk here
+            print('MIME parser pool broke, restarting it')
+            self.executor = None
+            return parse_chunk(chunk)
+
+    def emails(self, results, failed=None):
+        for fallback_id, fields in results:
+            if isinstance(fields, Exception):
+                self.failed += 1
+                print(f'Error processing email {fallback_id}: {fields}')
+                if failed is not None:
+                    failed.append(int(fallback_id))
+                continue
+            self.parsed += 1
+            yield build_email(fields, fallback_id)
+
+    async def parse(self, messages, failed=None):
+        return [email async for email in self.iter_parse(messages, failed)]
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "parsed": self.parsed,
+            "failed": self.failed,
+        }
+
+parser = MimeParser()
@@ -0,0 +1,213 @@
+import asyncio
+import concurrent.futures
+import threading
+import time
+from collections import deque
+import config_reader
+from rate_limiter import backoff_delay
+
+# Works through the inbox's unprocessed emails on a background event loop,
+# keeping up to PROCESSING_CONCURRENCY of them with the agent at once, so
+# throughput no longer depends on how often the ui asks for a batch. Once
+# started it keeps draining as new mail arrives until it is paused or
+# cancelled; the ui polls for the emails finished since its last call.
+
+class ProcessingWorker:
+
+    class State:
+        STOPPED = 'stopped'
+        RUNNING = 'running'
+        PAUSED = 'paused'
+
+    #how often the queue is checked for mail added without a notify
+    POLL_SECONDS = 2
+
+    def __init__(self, inbox, concurrency=None):
+        self.inbox = inbox
+        self.concurrency = concurrency or config_reader.PROCESSING_CONCURRENCY
+        self.state = self.State.STOPPED
+        #email id -> task processing it
+        self.in_flight = {}
+        #ids finished since the ui last collected them
+        self.finished = []
+        self.results = threading.Condition()
+        self.processed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.started_at = None
+        self.processed_at_start = 0
+        self.durations = deque(maxlen=500)
+        self.wake = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='email-processing', daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+
+    @property
+    def remaining(self):
+        return len(self.inbox.unprocessed_message_ids)
+
+    @property
+    def busy(self):
+        return self.state == self.State.RUNNING and bool(self.in_flight or self.remaining)
+
+    def call(self, function):
+        #run function on the worker loop and wait for it, so a poll right
+        #after a control call already sees its effect
+        if threading.current_thread() is self.thread:
+            return function()
+        future = concurrent.futures.Future()
+        def run():
+            try:
+                future.set_result(function())
+            except Exception as e:
+                future.set_exception(e)
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+    def start(self):
+        def start():
+            if self.state != self.State.RUNNING:
+                self.state = self.State.RUNNING
+                self.started_at = time.time()
+                self.processed_at_start = self.processed
+            self.notify()
+        self.call(start)
+
+    def pause(self):
+        #emails already with the agent finish, no new ones are started
+        def pause():
+            if self.state == self.State.RUNNING:
+                self.state = self.State.PAUSED
+        self.call(pause)
+
+    def resume(self):
+        def resume():
+            if self.state == self.State.PAUSED:
+                self.state = self.State.RUNNING
+            self.notify()
+        self.call(resume)
+
+    def cancel(self):
+        #stop and abandon the emails in flight, they stay unprocessed. the
+        #api requests already sent for them still run to completion on the
+        #agent's executor and use quota, their answers are discarded; pause
+        #instead to let them finish and keep the results
+        def cancel():
+            self.state = self.State.STOPPED
+            for task in self.in_flight.values():
+                task.cancel()
+            self.notify()
+        self.call(cancel)
+
+    def set_concurrency(self, concurrency):
+        def set_concurrency():
+            self.concurrency = max(1, int(concurrency))
+            self.notify()
+        self.call(set_concurrency)
+
+    def notify(self):
+        #called on the worker loop
+        if self.wake is not None:
+            self.wake.set()
+        with self.results:
+            self.results.notify_all()
+
+    def collect(self, timeout=None):
+        #ids of the emails finished since the last call, waiting up to timeout
+        #for one if the worker is still busy
+        with self.results:
+            if not self.finished and self.busy:
+                self.results.wait(timeout)
+            finished, self.finished = self.finished, []
+        return finished
+
+    async def run(self):
+        self.wake = asyncio.Event()
+        while True:
+            while self.state == self.State.RUNNING and len(self.in_flight) < self.concurrency:
+                email = self.next_email()
+                if email is None:
+                    break
+                self.in_flight[email.id] = asyncio.ensure_future(self.process(email))
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+    def next_email(self):
+        #newest first, as the batches were. the inbox list may be replaced by
+        #a resync or reprocess meanwhile, so it is read afresh each time
+        with self.inbox.lock:
+            while True:
+                try:
+                    email_id = self.inbox.unprocessed_message_ids.pop()
+                except IndexError:
+                    return None
+                if email_id in self.inbox.emails and email_id not in self.in_flight:
+                    return self.inbox.emails[email_id]
+
+    async def process(self, email):
+        email_id = email.id
+        start = time.perf_counter()
+        try:
+            await self.inbox.agent.process_email(email)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            with self.inbox.lock:
+                self.inbox.unprocessed_message_ids.append(email_id)
+            return
+        except Exception as e:
+            self.failed += 1
+            self.consecutive_failures += 1
+            self.last_error = f"{type(e).__name__} {e}".strip()
+            print(f"Error processing email {email_id}: {self.last_error}")
+            #repeated failures slow the worker down, and failed emails go to
+            #the front so they are retried after everything else. they are
+            #queued once out of the backoff, while still counted in flight
+            try:
+                await asyncio.sleep(backoff_delay(self.consecutive_failures, cap=60.0))
+            except asyncio.CancelledError:
+                pass
+            with self.inbox.lock:
+                self.inbox.unprocessed_message_ids.insert(0, email_id)
+            return
+        else:
+            #reported before leaving in_flight, so a poll never sees the
+            #worker idle with a result still to come
+            self.durations.append(time.perf_counter() - start)
+            self.processed += 1
+            self.consecutive_failures = 0
+            #the email may have been removed by a resync while it was processed
+            with self.inbox.lock:
+                if email_id in self.inbox.emails:
+                    self.inbox.persist([email])
+                    with self.results:
+                        self.finished.append(email_id)
+        finally:
+            self.in_flight.pop(email_id, None)
+            self.notify()
+        with self.inbox.lock:
+            if not self.in_flight and not self.remaining:
+                self.inbox.update_state(self.inbox.State.DONE)
+
+    def stats(self):
+        durations = sorted(self.durations)
+        elapsed = time.time() - self.started_at if self.started_at else 0
+        processed_since_start = self.processed - self.processed_at_start
+        return {
+            "state": self.state,
+            "concurrency": self.concurrency,
+            "in_flight": len(self.in_flight),
+            "remaining": self.remaining,
+            "processed": self.processed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "last_error": self.last_error,
+            "emails_per_minute": processed_since_start / elapsed * 60 if elapsed else 0,
+            "avg_seconds": sum(durations) / len(durations) if durations else 0,
+            "p95_seconds": durations[int(len(durations) * 0.95)] if durations else 0,
+        }
@@ -0,0 +1,140 @@
+import asyncio
+import random
+import threading
+import time
+
+# Limiter state is guarded by threading locks and waits are plain
+# asyncio.sleep calls, so one limiter can be shared by every event loop
+# (each Flask request runs its own asyncio.run).
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    #full jitter exponential backoff for a 0-based retry attempt
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def retry_after_seconds(error):
+    #the Retry-After header of an http error, if the server sent one
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    #refills per_minute units each minute, up to capacity
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self, amount):
+        #take amount if available and return 0, otherwise return the seconds to wait
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    async def acquire(self, amount=1):
+        #a request larger than the bucket could never be served, so cap it
+        amount = min(amount, self.capacity)
+        while True:
+            wait = self.try_acquire(amount)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+class AdaptiveConcurrency:
+    #additive increase, multiplicative decrease: the limit grows by one after
+    #a full window of fast successes and halves when the provider throttles
+    def __init__(self, initial, maximum, minimum=1, target_latency=20.0):
+        self.limit = initial
+        self.maximum = maximum
+        self.minimum = minimum
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.successes = 0
+        self.lock = threading.Lock()
+
+    async def acquire(self):
+        while True:
+            with self.lock:
+                if self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+            await asyncio.sleep(0.05)
+
+    def release(self, latency=None, throttled=False):
+        with self.lock:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.successes = 0
+            elif latency is not None and latency > self.target_latency:
+                self.limit = max(self.minimum, self.limit - 1)
+                self.successes = 0
+            elif latency is not None:
+                self.successes += 1
+                if self.successes >= self.limit:
+                    self.limit = min(self.maximum, self.limit + 1)
+                    self.successes = 0
+
+class RateLimiter:
+    #request and token buckets, adaptive concurrency and retries around a call
+    def __init__(self, requests_per_minute, tokens_per_minute, max_concurrency,
+                 max_retries=5, target_latency=20.0, retry_on=(), throttle_on=()):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(max_concurrency, max_concurrency, target_latency=target_latency)
+        self.max_retries = max_retries
+        #exception types worth retrying, and the subset that means we were rate limited
+        self.retry_on = tuple(retry_on) + tuple(throttle_on)
+        self.throttle_on = tuple(throttle_on)
+        self.retries = 0
+        self.throttled = 0
+        self.failures = 0
+
+    async def run(self, make_call, tokens=1):
+        #make_call returns a fresh awaitable for each attempt
+        attempt = 0
+        while True:
+            await self.requests.acquire(1)
+            await self.tokens.acquire(tokens)
+            await self.concurrency.acquire()
+            start = time.monotonic()
+            try:
+                result = await make_call()
+            except asyncio.CancelledError:
+                #the caller gave up on the call, its slot is free again
+                self.concurrency.release()
+                raise
+            except Exception as e:
+                throttled = isinstance(e, self.throttle_on)
+                self.concurrency.release(throttled=throttled)
+                if throttled:
+                    self.throttled += 1
+                if not isinstance(e, self.retry_on) or attempt >= self.max_retries:
+                    self.failures += 1
+                    raise
+                delay = retry_after_seconds(e) or backoff_delay(attempt)
+                print(f"Retrying after {type(e).__name__} in {delay:.1f}s (attempt {attempt + 1}/{self.max_retries})")
+                self.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self.concurrency.release(latency=time.monotonic() - start)
+            return result
+
+    def stats(self):
+        return {
+            "concurrency_limit": self.concurrency.limit,
+            "in_flight": self.concurrency.in_flight,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "failures": self.failures,
+        }
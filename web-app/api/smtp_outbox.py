@@ -0,0 +1,205 @@
+import smtplib
+import threading
+import time
+from email.policy import SMTP
+import gmail
+import config_reader
+from rate_limiter import backoff_delay
+
+# Replies are written to the outbox table and sent by a background thread,
+# so /api/send returns as soon as the message is stored. The sender keeps a
+# logged in SMTP connection per account, sends everything queued for the
+# account over it, and retries failures with backoff up to
+# OUTBOX_MAX_ATTEMPTS. Queued messages survive a restart.
+
+def is_permanent(error):
+    #the server refused the message itself, sending it again will not help
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        #the password may be fixed before the retries run out
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+class SmtpConnection:
+    #one logged in connection for an account, closed after SMTP_IDLE_SECONDS unused
+    def __init__(self, user, password, host, port, use_tls):
+        self.user = user
+        self.password = password
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.server = None
+        self.last_used = 0
+        self.connects = 0
+
+    @property
+    def idle(self):
+        return self.server is not None and time.monotonic() - self.last_used > config_reader.SMTP_IDLE_SECONDS
+
+    def get(self):
+        if self.idle:
+            #servers drop idle connections, start over rather than find out mid-send
+            self.close()
+        if self.server is None:
+            self.server = gmail.connect_smtp(self.user, self.password, self.host, self.port, self.use_tls)
+            self.connects += 1
+        self.last_used = time.monotonic()
+        return self.server
+
+    def close(self):
+        if self.server is None:
+            return
+        server, self.server = self.server, None
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+class Outbox:
+    def __init__(self, db, host=gmail.SMTP_HOST, port=gmail.SMTP_PORT, use_tls=True):
+        self.db = db
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        #called with (account, message_id, delivered) from the sender thread
+        #once a message is sent or given up on
+        self.on_delivery = None
+        self.passwords = {}
+        self.connections = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        requeued = self.db.requeue_outbox()
+        if requeued:
+            print(f"Requeued {requeued} outbox messages from the last run")
+        self.thread = threading.Thread(target=self.run, name='smtp-outbox', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join(timeout=30)
+        for connection in self.connections.values():
+            connection.close()
+
+    def send(self, email, draft_text, user, password):
+        #drop-in for gmail.send_email: queue the reply and return its outbox id
+        msg, recipient = gmail.build_reply(email, draft_text, user)
+        self.passwords[user] = password
+        outbox_id = self.db.enqueue_outbox(user, email.id, user, [recipient], msg.as_bytes(policy=SMTP))
+        if outbox_id is None:
+            raise RuntimeError(f"Could not queue the reply to {email.id}")
+        self.wake.set()
+        return outbox_id
+
+    def retry(self, outbox_id, account):
+        #send a failed message again now
+        if not self.db.retry_outbox(outbox_id, account):
+            return False
+        self.wake.set()
+        return True
+
+    def run(self):
+        while not self.stopping:
+            rows = self.db.claim_outbox(config_reader.OUTBOX_BATCH_SIZE)
+            if rows:
+                self.send_batch(rows)
+                continue
+            for connection in self.connections.values():
+                if connection.idle:
+                    connection.close()
+            #sleep until the next retry is due or a send wakes us
+            timeout = config_reader.SMTP_IDLE_SECONDS
+            next_attempt = self.db.next_outbox_attempt()
+            if next_attempt is not None:
+                timeout = min(timeout, max(0, next_attempt - time.time()))
+            self.wake.wait(timeout)
+            self.wake.clear()
+
+    def send_batch(self, rows):
+        by_account = {}
+        for row in rows:
+            by_account.setdefault(row['account'], []).append(row)
+        for account, group in by_account.items():
+            try:
+                connection = self.connection(account)
+                connection.get()
+            except Exception as e:
+                print(f"SMTP connect for {account} failed: {e}")
+                for row in group:
+                    self.failed_attempt(row, e)
+                continue
+            for row in group:
+                self.deliver(connection, row)
+
+    def connection(self, account):
+        password = self.passwords.get(account) or self.stored_password(account)
+        connection = self.connections.get(account)
+        if connection is None or connection.password != password:
+            if connection is not None:
+                connection.close()
+            connection = SmtpConnection(account, password, self.host, self.port, self.use_tls)
+            self.connections[account] = connection
+        return connection
+
+    def stored_password(self, account):
+        #messages queued before a restart have no password in memory yet
+        for user in self.db.get_users():
+            if user.get('user') == account:
+                password = user.get('password')
+                return password.decode('utf-8') if isinstance(password, bytes) else password
+        raise ValueError(f"No password stored for {account}")
+
+    def deliver(self, connection, row):
+        try:
+            try:
+                connection.get().sendmail(row['sender'], row['recipients'], row['message'])
+            except smtplib.SMTPServerDisconnected:
+                #the server closed the pooled connection, retry once on a new one
+                connection.close()
+                connection.get().sendmail(row['sender'], row['recipients'], row['message'])
+        except Exception as e:
+            if not isinstance(e, smtplib.SMTPResponseException):
+                connection.close()
+            self.failed_attempt(row, e)
+            return
+        self.db.finish_outbox(row['id'], 'sent')
+        self.sent += 1
+        self.notify(row, True)
+
+    def failed_attempt(self, row, error):
+        attempts = row['attempts'] + 1
+        if is_permanent(error) or attempts >= config_reader.OUTBOX_MAX_ATTEMPTS:
+            print(f"Giving up on outbox message {row['id']} to {row['recipients']}: {error}")
+            self.db.finish_outbox(row['id'], 'failed', str(error))
+            self.failed += 1
+            self.notify(row, False)
+            return
+        delay = backoff_delay(attempts, base=5.0, cap=config_reader.OUTBOX_RETRY_MAX_SECONDS)
+        print(f"Sending outbox message {row['id']} failed ({error}), retrying in {delay:.0f}s")
+        self.db.finish_outbox(row['id'], 'queued', str(error), time.time() + delay)
+        self.retried += 1
+
+    def notify(self, row, delivered):
+        if self.on_delivery is None:
+            return
+        try:
+            self.on_delivery(row['account'], row['message_id'], delivered)
+        except Exception as e:
+            print(f"Error reporting delivery of outbox message {row['id']}: {e}")
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "connects": sum(connection.connects for connection in self.connections.values()),
+            "queue": self.db.outbox_counts(),
+        }
@@ -0,0 +1,230 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+import gmail
+import config_reader
+from inbox import FilterList, VerdictCache
+from imap_sessions import SessionManager
+from rate_limiter import backoff_delay
+
+# Polls every active account in the users table from one background event
+# loop. Each account is synced on its own schedule, so a slow mailbox only
+# holds up itself; at most SYNC_MAX_CONNECTIONS_PER_HOST accounts of the
+# same server sync at once, and waiting accounts get the next free slot in
+# order of how long they have gone without a successful sync.
+
+def split_host(host):
+    #users.host may carry a port ("imap.example.com:1993")
+    host = host or gmail.HOST
+    name, _, port = host.rpartition(':')
+    if name and port.isdigit():
+        return name, int(port)
+    return host, gmail.PORT
+
+class AccountSync:
+    #the coordinator's view of one account
+    def __init__(self, account, host, password, agent=None, db=None):
+        self.account = account
+        self.host = host
+        self.password = password
+        self.whitelist = FilterList(agent, VerdictCache(db, account) if db is not None else None)
+        self.rules = None
+        self.next_due = 0
+        self.task = None
+        self.last_success = None
+        self.last_duration = None
+        self.last_new = 0
+        self.last_error = None
+        self.syncs = 0
+        self.failures = 0
+
+    @property
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def load_rules(self, rules):
+        #rebuild the whitelist only when the stored rules change
+        if rules != self.rules:
+            self.whitelist.update_from_json(rules or {'rules': []})
+            self.rules = rules
+
+    def stats(self):
+        return {
+            "host": self.host,
+            "running": self.running,
+            "last_success": self.last_success,
+            "lag_seconds": None if self.last_success is None else round(time.time() - self.last_success, 1),
+            "last_duration": self.last_duration,
+            "last_new": self.last_new,
+            "last_error": self.last_error,
+            "syncs": self.syncs,
+            "failures": self.failures,
+        }
+
+class SyncCoordinator:
+    def __init__(self, db, sessions=None, use_ssl=True, agent=None):
+        self.db = db
+        self.use_ssl = use_ssl
+        #answers the whitelist AI rules of accounts synced here
+        self.agent = agent
+        #one SessionManager per (host, port), seeded with ones already running
+        self.sessions = dict(sessions or {})
+        self.accounts = {}
+        #account -> blocking function that syncs it instead, used for the
+        #account open in the ui so its in-memory inbox stays current
+        self.attached = {}
+        self.host_limits = {}
+        self.accounts_loaded = 0
+        self.wake = None
+        self.stopping = False
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='sync-coordinator', daemon=True)
+        self.thread.start()
+
+    def start(self):
+        asyncio.run_coroutine_threadsafe(self.run(), self.loop)
+
+    def stop(self):
+        self.stopping = True
+        self.loop.call_soon_threadsafe(self.notify)
+
+    def notify(self):
+        if self.wake is not None:
+            self.wake.set()
+
+    def attach(self, account, sync_function):
+        self.attached[account] = sync_function
+
+    def detach(self, account):
+        self.attached.pop(account, None)
+
+    def sync_now(self, account=None):
+        #move one account, or all of them, to the front of the schedule
+        def schedule():
+            for state in self.accounts.values():
+                if account is None or state.account == account:
+                    state.next_due = 0
+            self.notify()
+        self.loop.call_soon_threadsafe(schedule)
+
+    def sync_all(self, timeout=None):
+        #sync every active account once and wait for them, from any thread
+        return asyncio.run_coroutine_threadsafe(self._sync_all(), self.loop).result(timeout)
+
+    async def _sync_all(self):
+        self.load_accounts()
+        tasks = [self.start_sync(state) for state in self.by_lag(self.accounts.values())]
+        await asyncio.gather(*(task for task in tasks if task is not None), return_exceptions=True)
+        return self.stats()
+
+    def load_accounts(self):
+        users = {user['user']: user for user in self.db.get_users() if user.get('active', True)}
+        for account in list(self.accounts):
+            if account not in users and not self.accounts[account].running:
+                del self.accounts[account]
+        for account, user in users.items():
+            password = user.get('password')
+            if isinstance(password, bytes):
+                password = password.decode('utf-8')
+            state = self.accounts.get(account)
+            if state is None:
+                state = self.accounts[account] = AccountSync(account, user.get('host') or gmail.HOST, password, self.agent, self.db)
+            state.host = user.get('host') or gmail.HOST
+            state.password = password
+        self.accounts_loaded = time.monotonic()
+
+    @staticmethod
+    def by_lag(states):
+        #accounts that have waited longest for a successful sync go first
+        return sorted(states, key=lambda state: (state.last_success or 0, state.next_due))
+
+    async def run(self):
+        self.wake = asyncio.Event()
+        while not self.stopping:
+            if time.monotonic() - self.accounts_loaded > config_reader.SYNC_INTERVAL_SECONDS:
+                self.load_accounts()
+            now = time.monotonic()
+            due = [state for state in self.accounts.values() if not state.running and state.next_due <= now]
+            for state in self.by_lag(due):
+                self.start_sync(state)
+            next_due = min((state.next_due for state in self.accounts.values() if not state.running),
+                           default=now + config_reader.SYNC_INTERVAL_SECONDS)
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(1, next_due - now))
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+    def start_sync(self, state):
+        if state.running:
+            return None
+        state.task = asyncio.ensure_future(self.sync_account(state))
+        return state.task
+
+    def host_limit(self, host):
+        #semaphores wake waiters in order, so the order syncs start in is kept
+        if host not in self.host_limits:
+            self.host_limits[host] = asyncio.Semaphore(config_reader.SYNC_MAX_CONNECTIONS_PER_HOST)
+        return self.host_limits[host]
+
+    def session_manager(self, host):
+        address = split_host(host)
+        if address not in self.sessions:
+            self.sessions[address] = SessionManager(address[0], address[1], self.use_ssl)
+        return self.sessions[address]
+
+    async def sync_account(self, state):
+        async with self.host_limit(state.host):
+            start = time.monotonic()
+            try:
+                attached = self.attached.get(state.account)
+                if attached is not None:
+                    await asyncio.wait_for(self.loop.run_in_executor(None, attached), config_reader.SYNC_ACCOUNT_TIMEOUT_SECONDS)
+                    state.last_new = 0
+                else:
+                    state.last_new = await asyncio.wait_for(self.retrieve(state), config_reader.SYNC_ACCOUNT_TIMEOUT_SECONDS)
+            except Exception as e:
+                state.failures += 1
+                state.last_error = f"{type(e).__name__} {e}".strip()
+                print(f"Sync of {state.account} failed: {state.last_error}")
+                state.next_due = time.monotonic() + backoff_delay(state.failures, base=10.0, cap=config_reader.SYNC_INTERVAL_SECONDS)
+                return
+            finally:
+                state.last_duration = round(time.monotonic() - start, 3)
+                #let the scheduler see the account's new due time
+                self.notify()
+            state.syncs += 1
+            state.failures = 0
+            state.last_error = None
+            state.last_success = time.time()
+            state.next_due = time.monotonic() + config_reader.SYNC_INTERVAL_SECONDS
+
+    async def retrieve(self, state):
+        #fetch new mail for an account that is not open in the ui and store
+        #what its whitelist keeps, returning how many were new
+        metadata = self.db.get_metadata(state.account) or {}
+        state.load_rules(metadata.get('rules'))
+        sync_state = self.db.get_sync_state(state.account) or {}
+        since = (datetime.now() - timedelta(days=config_reader.LOOKBACK_DAYS)).strftime('%d-%b-%Y')
+        emails = await self.session_manager(state.host).retrieve_emails(
+            f'SINCE "{since}"', state.account, state.password,
+            header_filter=state.whitelist.prefilter, sync_state=sync_state, raise_errors=True)
+        verdicts = await state.whitelist.filter_many(emails)
+        kept = [email for email, passed in zip(emails, verdicts) if passed]
+        stored = self.db.store_emails([email.to_db_dict() for email in kept], state.account, replace=False) if kept else 0
+        if stored is None:
+            raise ValueError("could not store emails")
+        if stored < len(kept):
+            #skipped rows must already be the account's, or the sync position
+            #would move past mail that was never stored
+            present = self.db.get_emails([email.id for email in kept], state.account, columns=['message_id'])
+            missing = [email.id for email in kept if email.id not in present]
+            if missing:
+                raise ValueError(f"{len(missing)} emails were not stored")
+        if sync_state.get('uidvalidity') is not None:
+            self.db.put_sync_state(state.account, sync_state)
+        return stored
+
+    def stats(self):
+        return {account: state.stats() for account, state in sorted(self.accounts.items())}
@@ -130,7 +130,7 @@ function App() {
     const fetchEmails = async () => {
       setIsRefreshing(true);
       try {
-        const response = await fetch('/api/emails');
+        const response = await fetch('/api/emails?summary=true');
         const data = await response.json();
         console.log('Data:', data);
         const emailsData = data || [];
@@ -232,7 +232,7 @@ function App() {
       console.log('Fetching emails');
       setIsRefreshing(true);
       try {
-        const response = await fetch('/api/emails');
+        const response = await fetch('/api/emails?summary=true');
         console.log('Response:', response);
         const data = await response.json();
         console.log('Data:', data);
@@ -546,7 +546,7 @@ function App() {
     setSyncMessage('');
     
     try {
-      const emailResponse = await fetch('/api/get_updates');
+      const emailResponse = await fetch('/api/get_updates?summary=true');
       console.log('Email response:', emailResponse);
       const emailData = await emailResponse.json();
       console.log('Email data:', emailData);
@@ -574,6 +574,18 @@ function App() {
     return null;
   };
 
+  // The list holds summaries only, bodies are fetched when an email is opened
+  const loadFullEmail = async (email) => {
+    try {
+      const response = await fetch(`/api/emails/${encodeURIComponent(email.id)}`);
+      if (!response.ok) return email;
+      return { ...email, ...(await response.json()) };
+    } catch (error) {
+      console.error('Failed to load email:', error);
+      return email;
+    }
+  };
+
   const EmailItem = ({ email }) => {
     const isProcessingEmail = email.processing === true;
     const isDrafted = email.state.includes('drafted_response');
@@ -582,13 +594,17 @@ function App() {
     const isProcessed = email.processed && !isDrafted;
     const isUnprocessed = !email.processed;
     
-    const handleClick = () => {
+    const handleClick = async () => {
+      let select = null;
       if (isAwaitingHuman) {
-        setSelectedAwaitingHuman(email);
+        select = setSelectedAwaitingHuman;
       } else if (isProcessed) {
-        setSelectedProcessedEmail(email);
+        select = setSelectedProcessedEmail;
       } else if (email.drafted_response && !email.processed) {
-        setSelectedDraft(email);
+        select = setSelectedDraft;
+      }
+      if (select) {
+        select(await loadFullEmail(email));
       }
     };
 
@@ -604,8 +620,9 @@ function App() {
     
     // Get preview of message content
     const getMessagePreview = () => {
-      if (email.body && typeof email.body === 'string') {
-        const text = email.body.replace(/<[^>]*>/g, '').trim();
+      const content = email.preview || email.body;
+      if (content && typeof content === 'string') {
+        const text = content.replace(/<[^>]*>/g, '').trim();
         return text.length > 100 ? text.substring(0, 100) + '...' : text;
       }
       return '';
@@ -853,7 +870,7 @@ function App() {
             // Force refresh after saving settings
             const fetchEmails = async () => {
               console.log('Fetching emails after settings update');
-              const response = await fetch('/api/get_updates');
+              const response = await fetch('/api/get_updates?summary=true');
               const data = await response.json();
               updateEmailsAndCounts(data || [], data.last_modified);
               setLastUpdated(new Date());
@@ -877,7 +894,7 @@ function App() {
               // Force immediate refresh
               const fetchEmails = async () => {
                 console.log('Fetching emails after reset');
-                const response = await fetch('/api/emails');
+                const response = await fetch('/api/emails?summary=true');
                 const data = await response.json();
                 updateEmailsAndCounts(data || [], data.last_modified);
                 setLastUpdated(new Date());
@@ -902,7 +919,7 @@ function App() {
             // Force refresh after sending
             setLastModified('');
             console.log('Fetching emails after sending');
-            const response = await fetch('/api/emails');
+            const response = await fetch('/api/emails?summary=true');
             const data = await response.json();
             updateEmailsAndCounts(data || [], data.last_modified);
             setLastUpdated(new Date());
@@ -918,7 +935,7 @@ function App() {
             
             // Force refresh after deleting
             setLastModified('');
-            const response = await fetch('/api/emails');
+            const response = await fetch('/api/emails?summary=true');
             const data = await response.json();
             updateEmailsAndCounts(data.emails || [], data.last_modified);
             setLastUpdated(new Date());
@@ -926,7 +943,7 @@ function App() {
           onRerun={async () => {
             // Force refresh after rerunning
             setLastModified('');
-            const response = await fetch('/api/emails');
+            const response = await fetch('/api/emails?summary=true');
             const data = await response.json();
             updateEmailsAndCounts(data.emails || [], data.last_modified);
             setLastUpdated(new Date());
@@ -948,7 +965,7 @@ function App() {
             
             // Force refresh after sending
             setLastModified('');
-            const response = await fetch('/api/emails');
+            const response = await fetch('/api/emails?summary=true');
             const data = await response.json();
             updateEmailsAndCounts(data || [], data.last_modified);
             setLastUpdated(new Date());
@@ -964,7 +981,7 @@ function App() {
             
             // Force refresh after deleting
             setLastModified('');
-            const response = await fetch('/api/emails');
+            const response = await fetch('/api/emails?summary=true');
             const data = await response.json();
             updateEmailsAndCounts(data.emails || [], data.last_modified);
             setLastUpdated(new Date());
@@ -972,7 +989,7 @@ function App() {
           onRerun={async () => {
             // Force refresh after rerunning
             setLastModified('');
-            const response = await fetch('/api/emails');
+            const response = await fetch('/api/emails?summary=true');
             const data = await response.json();
             updateEmailsAndCounts(data.emails || [], data.last_modified);
             setLastUpdated(new Date());
@@ -994,7 +1011,7 @@ function App() {
             
             // Force refresh after sending
             setLastModified('');
-            const response = await fetch('/api/emails');
+            const response = await fetch('/api/emails?summary=true');
             const data = await response.json();
             updateEmailsAndCounts(data.emails || [], data.last_modified);
             setLastUpdated(new Date());